@@ -2,13 +2,27 @@ VERSION = (3, 1, 2)
 __version__ = '.'.join(map(str, VERSION if VERSION[-1] else VERSION[:2]))
 
 
+import sys
 from django.apps import AppConfig
 
+from .conf import settings
 from .simple import *
 from .query import *
 from .invalidation import *
 from .templatetags.cacheops import *
 from .transaction import install_cacheops_transaction_support
+from .warmup import warm_up
+from .refresh import *
+from .reaper import *
+
+# asyncio support needs Python 3.5+ and redis-py 4.2+
+try:
+    if sys.version_info < (3, 5):
+        raise ImportError
+    from .aio import *
+    from .aio import install_cacheops_async
+except ImportError:
+    install_cacheops_async = None
 
 
 class CacheopsConfig(AppConfig):
@@ -17,5 +31,11 @@ class CacheopsConfig(AppConfig):
     def ready(self):
         install_cacheops()
         install_cacheops_transaction_support()
+        if install_cacheops_async:
+            install_cacheops_async()
+        if settings.CACHEOPS_WARM_UP:
+            warm_up()
+        if settings.CACHEOPS_REAP_INTERVAL:
+            Reaper().start(settings.CACHEOPS_REAP_INTERVAL)
 
 default_app_config = 'cacheops.CacheopsConfig'
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterparts of cached querysets, functions and invalidation.
+
+Built on redis.asyncio and the same Lua scripts as the sync API, so both could be used together.
+Only cache operations are asynchronous: Django ORM is synchronous, so db queries on cache misses
+are run in another thread, see run_sync().
+
+NOTE: needs Python 3.5+ and redis-py 4.2+.
+"""
+import os
+import copy
+import asyncio
+import time
+import threading
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from funcy import identity, wraps
+import redis
+from redis import asyncio as aioredis
+from django.db import connections, close_old_connections
+from django.db.models.query import QuerySet
+# Runs sync code in the thread of a request with Django 3.0+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+from .conf import settings
+from .redis import redis_client, script_code, primary_window, LOCK_TIMEOUT
+from .invalidation import invalidate_dict, invalidate_dicts_args, get_obj_dict, no_invalidation, \
+                          mark_invalidated, drop_local
+from .local import local_cache, local_cache_enabled
+from .utils import monkey_mix, non_proxy
+from .simple import CacheMiss, RedisCache
+from .transaction import transaction_state
+from .signals import cache_read, cache_computed
+from .metrics import record_fanout
+from .serializers import loads
+from .chunks import chunk_key, parse_header, unsign_chunk
+from .tree import dnfs, query_tables
+from .generations import generation_keys, fold
+from .sharding import node_for, data_nodes, group_by_node, delta_key, meta_triple, needs_refresh
+from .query import cached_as, cache_thing_calls, MAX_GET_RESULTS
+
+
+__all__ = ('ainvalidate_obj', 'ainvalidate_dict', 'async_client')
+
+
+if settings.CACHEOPS_DEGRADE_ON_FAILURE:
+    def handle_connection_failure(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except redis.ConnectionError as e:
+                warnings.warn("The cacheops cache is unreachable! Error: %s" % e, RuntimeWarning)
+            except redis.TimeoutError as e:
+                warnings.warn("The cacheops cache timed out! Error: %s" % e, RuntimeWarning)
+        return wrapper
+else:
+    handle_connection_failure = identity
+
+
+### Clients and scripts
+
+_clients = weakref.WeakKeyDictionary()
+_scripts = weakref.WeakKeyDictionary()
+
+def async_client(client=redis_client):
+    """
+    Returns an asyncio client connecting to the same redis as given sync one.
+    Connections are bound to event loop, so there is a client per loop.
+    """
+    clients = _clients.setdefault(asyncio.get_event_loop(), {})
+    if client not in clients:
+        pool = client.connection_pool
+        connection_class = getattr(aioredis.connection, pool.connection_class.__name__)
+        clients[client] = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+            connection_class=connection_class, **pool.connection_kwargs))
+    return clients[client]
+
+def load_script(name, strip=False):
+    scripts = _scripts.setdefault(async_client(), {})
+    if (name, strip) not in scripts:
+        scripts[name, strip] = async_client().register_script(script_code(name, strip))
+    return scripts[name, strip]
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Runs blocking code, i.e. db queries, not to block event loop.
+    With asgiref it goes to the thread of sync code, sharing its connections and transaction.
+    Otherwise to a single cacheops thread, which keeps its own ones, unless there is
+    a transaction open in this thread, then code is run right away to see its changes.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(partial(func, *args, **kwargs), thread_sensitive=True)()
+    # No asgiref means Django older than 3.0, which has no async safety checks
+    if any(conn.in_atomic_block for conn in connections.all()):
+        return func(*args, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(
+        _db_executor(), partial(_run_in_db_thread, func, *args, **kwargs))
+
+_executor, _executor_pid = None, None
+_executor_mutex = threading.Lock()
+
+def _db_executor():
+    global _executor, _executor_pid
+    with _executor_mutex:
+        # Threads don't survive fork
+        if _executor_pid != os.getpid():
+            _executor, _executor_pid = ThreadPoolExecutor(max_workers=1), os.getpid()
+        return _executor
+
+def _run_in_db_thread(func, *args, **kwargs):
+    # Same as Django does around requests, drops broken and expired connections of this thread
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+### Reading and writing
+
+async def _read(client, func, primary=False):
+    """
+    Awaits func called with an async client to read from, see CacheopsRedis.read().
+    """
+    # Plain redis clients, i.e. passed to RedisCache, have no replicas
+    reader = client.reader(primary) if hasattr(client, 'reader') else client
+    try:
+        return await func(async_client(reader))
+    except (redis.ConnectionError, redis.TimeoutError):
+        # Fall back to primary if a replica is down or slow
+        if reader is client:
+            raise
+        return await func(async_client(client))
+
+@handle_connection_failure
+async def _get(key, client=redis_client, primary=False):
+    return await _read(client, lambda aclient: aclient.get(key), primary)
+
+@handle_connection_failure
+async def _mget(node_keys, primary=False):
+    """
+    Gets values for a list of (node, key) pairs, see sharding.mget().
+    """
+    results = [None] * len(node_keys)
+    for node, indexes in group_by_node(node_keys):
+        keys = [node_keys[i][1] for i in indexes]
+        values = await _read(node, lambda aclient: aclient.mget(keys), primary)
+        for i, value in zip(indexes, values):
+            results[i] = value
+    return results
+
+@handle_connection_failure
+async def _exist(key, nodes, primary=False):
+    for node in nodes:
+        if not await _read(node, lambda aclient: aclient.exists(key), primary):
+            return False
+    return True
+
+@handle_connection_failure
+async def _get_meta(key, nodes, primary=False):
+    """
+    Gets data as (data, ttl, delta) triple, see sharding.get_meta().
+    """
+    data, pttl, delta = await _read(
+        nodes[0],
+        lambda aclient: aclient.pipeline(transaction=False).get(key).pttl(key)
+                               .get(delta_key(key)).execute(),
+        primary)
+    if data is None or data == b'LOCK':
+        return None
+    pttls = [pttl]
+    for node in nodes[1:]:
+        pttls.append(await _read(node, lambda aclient: aclient.pttl(key), primary))
+    return meta_triple(data, pttls, delta)
+
+@handle_connection_failure
+async def _start_refresh(key, node):
+    return await async_client(node).set(key + ':refresh', 1, nx=True, ex=LOCK_TIMEOUT)
+
+@handle_connection_failure
+async def _end_refresh(key, node):
+    await async_client(node).delete(key + ':refresh')
+
+async def fold_generations(cache_key, db_tables):
+    primary = primary_window.covers(db_tables)
+    return fold(cache_key, await _mget(generation_keys(db_tables), primary))
+
+
+class getting(object):
+    """
+    An async counterpart of sharding.getting(), waits for a lock without blocking event loop.
+    """
+    def __init__(self, key, nodes, lock=False, primary=False, grace=None, beta=None):
+        self.key = key
+        self.nodes = nodes
+        self.lock = lock
+        self.primary = primary
+        self.grace = grace
+        self.beta = beta
+        self.locked = False
+        self.refreshing = False
+
+    async def __aenter__(self):
+        if self.grace or self.beta:
+            data, ttl, delta = await _get_meta(self.key, self.nodes, self.primary) \
+                or (None, None, None)
+            if data is not None:
+                if not needs_refresh(ttl, delta, self.grace, self.beta) \
+                        or not await _start_refresh(self.key, self.nodes[0]):
+                    return data
+                self.refreshing = True
+                return None
+
+        if not self.lock:
+            data = await _get(self.key, self.nodes[0], self.primary)
+        else:
+            data = await _get_or_lock(self.key, self.nodes[0])
+            self.locked = data is None
+        if data is not None and len(self.nodes) > 1 \
+                and not await _exist(self.key, self.nodes[1:], self.primary):
+            data = None
+        return data
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.refreshing:
+            await _end_refresh(self.key, self.nodes[0])
+        if self.locked:
+            await _release_lock(self.key, self.nodes[0])
+
+@handle_connection_failure
+async def _get_or_lock(key, node):
+    client = async_client(node)
+    signal_key = key + ':signal'
+
+    while True:
+        data = await client.get(key)
+        if data is None:
+            if await load_script('lock')(keys=[key, signal_key], args=[LOCK_TIMEOUT],
+                                         client=client):
+                return None
+        elif data != b'LOCK':
+            return data
+
+        # No data and not locked, wait
+        await client.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
+
+@handle_connection_failure
+async def _release_lock(key, node):
+    await load_script('unlock')(keys=[key, key + ':signal'], client=async_client(node))
+
+
+@handle_connection_failure
+async def cache_thing(cache_key, data, cond_dnfs, timeout, serializer='pickle', chunk_size=None,
+                      grace=None, delta=None):
+    # Could have changed after last check, sometimes superficially
+    if transaction_state.is_dirty(db_table for db_table, _ in cond_dnfs):
+        return
+    calls = cache_thing_calls(cache_key, data, cond_dnfs, timeout, serializer, chunk_size,
+                              grace, delta)
+    for node, keys, args in calls:
+        await load_script('cache_thing', settings.CACHEOPS_LRU)(keys=keys, args=args,
+                                                                client=async_client(node))
+
+
+### Querysets
+
+class AsyncQuerySetMixin(object):
+    async def afetch(self):
+        """
+        Evaluates queryset, returns a list of results.
+        """
+        if not self._cacheprofile or 'fetch' not in self._cacheprofile['ops'] \
+                or self._in_dirty_transaction() or not settings.CACHEOPS_ENABLED:
+            return await run_sync(list, self)
+
+        if self._result_cache is None:
+            cache_key = self._cache_key(generations=False)
+            if settings.CACHEOPS_GENERATIONS:
+                cache_key = await fold_generations(cache_key, query_tables(self))
+            lock = self._cacheprofile['lock']
+
+            if self._cacheprofile['write_only'] or self._for_write:
+                self._result_cache = await run_sync(_fetch_from_db, self)
+                await self._acache_results(cache_key, self._result_cache)
+            elif not self._local_cache_get(cache_key):
+                epoch = local_cache.epoch()
+                nodes, primary = self._data_nodes(), self._read_primary()
+                async with getting(cache_key, nodes, lock=lock, primary=primary,
+                                   grace=self._cacheprofile['grace'],
+                                   beta=self._cacheprofile['xfetch_beta']) as cache_data:
+                    results = await self._aload_results(cache_key, cache_data)
+                    cache_read.send(sender=self.model, func=None, hit=results is not None)
+                    if results is not None:
+                        self._result_cache = results
+                    else:
+                        start = time.time()
+                        self._result_cache = await run_sync(_fetch_from_db, self)
+                        await self._acache_results(cache_key, self._result_cache,
+                                                   duration=time.time() - start)
+                self._local_cache_set(cache_key, epoch)
+
+        if self._prefetch_related_lookups and not self._prefetch_done:
+            await run_sync(self._no_monkey._fetch_all, self)
+        return list(self._result_cache)
+
+    async def acount(self):
+        if self._cacheprofile and 'count' in self._cacheprofile['ops']:
+            if self._result_cache is not None:
+                return len(self._result_cache)
+
+            async def count():
+                return await run_sync(self._no_monkey.count, self)
+            return await cached_as(self)(count)()
+        else:
+            return await run_sync(self.count)
+
+    async def aget(self, *args, **kwargs):
+        # Local gets are not stored in redis, so there is nothing to wait for
+        if not self._cacheprofile or 'get' not in self._cacheprofile['ops'] \
+                or self._cacheprofile['local_get']:
+            return await run_sync(self.get, *args, **kwargs)
+
+        qs = self if 'fetch' in self._cacheprofile['ops'] else self._clone().cache()
+        clone = qs.filter(*args, **kwargs)
+        if qs.query.can_filter() and not qs.query.distinct_fields:
+            clone = clone.order_by()
+        if MAX_GET_RESULTS:
+            clone = clone[:MAX_GET_RESULTS + 1]
+
+        results = await clone.afetch()
+        if len(results) == 1:
+            return results[0]
+        if not results:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % self.model._meta.object_name)
+        raise self.model.MultipleObjectsReturned(
+            "get() returned more than one %s -- it returned %s!"
+            % (self.model._meta.object_name, len(results)))
+
+    async def _acache_results(self, cache_key, results, duration=None):
+        if duration is not None:
+            cache_computed.send(sender=self.model, func=None, duration=duration)
+        await cache_thing(cache_key, self._pack_results(results), dnfs(self),
+                          self._cacheprofile['timeout'],
+                          serializer=self._cacheprofile['serializer'],
+                          chunk_size=self._cacheprofile['chunk_size'],
+                          grace=self._cacheprofile['grace'],
+                          delta=duration if self._cacheprofile['xfetch_beta'] else None)
+
+    async def _aload_results(self, cache_key, cache_data):
+        if cache_data is None:
+            return None
+        serializer = self._cacheprofile['serializer']
+        header = parse_header(cache_data)
+        if header is None:
+            return self._unpack_results(loads(cache_data, serializer))
+
+        # All chunks should be signed with header token, see _get_chunks()
+        count, token = header
+        node = self._data_nodes()[0]
+        keys = [chunk_key(cache_key, i) for i in range(count)]
+        chunks = [unsign_chunk(token, payload)
+                  for payload in await _mget([(node, key) for key in keys], self._read_primary())]
+        if not chunks or None in chunks:
+            return None
+        return self._unpack_results([obj for chunk in chunks for obj in loads(chunk, serializer)])
+
+
+def _fetch_from_db(qs):
+    return list(qs._no_monkey.iterator(qs))
+
+
+def install_cacheops_async():
+    # Django 4.1+ own async methods are kept in QuerySet._no_monkey
+    monkey_mix(QuerySet, AsyncQuerySetMixin)
+
+
+### Decorators, see cached_as() and BaseCache.cached()
+
+def cached_as_coroutine(func, key_func, key_extra, cond_dnfs, timeout, lock, use_local,
+                        serializer, db_tables, dirty_tables, grace, beta):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if transaction_state.is_dirty(dirty_tables) or not settings.CACHEOPS_ENABLED:
+            return await func(*args, **kwargs)
+
+        cache_key = settings.CACHEOPS_NAMESPACE + 'as:' + key_func(func, args, kwargs, key_extra)
+        if settings.CACHEOPS_GENERATIONS:
+            cache_key = await fold_generations(cache_key, db_tables)
+
+        local = use_local and local_cache_enabled()
+        if local:
+            try:
+                result = local_cache.get(cache_key)
+                cache_read.send(sender=None, func=func, hit=True)
+                return copy.deepcopy(result)
+            except CacheMiss:
+                epoch = local_cache.epoch()
+
+        primary = primary_window.covers(db_tables)
+        async with getting(cache_key, data_nodes(db_tables), lock=lock,
+                           primary=primary, grace=grace, beta=beta) as cache_data:
+            cache_read.send(sender=None, func=func, hit=cache_data is not None)
+            if cache_data is not None:
+                result = loads(cache_data, serializer)
+            else:
+                start = time.time()
+                result = await func(*args, **kwargs)
+                duration = time.time() - start
+                cache_computed.send(sender=None, func=func, duration=duration)
+                await cache_thing(cache_key, result, cond_dnfs, timeout, serializer=serializer,
+                                  grace=grace, delta=duration if beta else None)
+
+        if local:
+            local_cache.set(cache_key, copy.deepcopy(result), timeout, db_tables, epoch)
+        return result
+    return wrapper
+
+
+def cached_coroutine(cache, func, make_key, timeout):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not settings.CACHEOPS_ENABLED:
+            return await func(*args, **kwargs)
+
+        cache_key = make_key(args, kwargs)
+        try:
+            result = await _cache_get(cache, cache_key)
+        except CacheMiss:
+            result = await func(*args, **kwargs)
+            await _cache_set(cache, cache_key, result, timeout)
+
+        return result
+    return wrapper
+
+async def _cache_get(cache, cache_key):
+    # Other caches are local, so there is no point in making them async
+    if not isinstance(cache, RedisCache):
+        return cache.get(cache_key)
+    data = await _get(cache_key, client=cache.conn)
+    if data is None:
+        raise CacheMiss
+    return cache._loads(data)
+
+@handle_connection_failure
+async def _cache_set(cache, cache_key, data, timeout=None):
+    if not isinstance(cache, RedisCache):
+        return cache.set(cache_key, data, timeout)
+    client = async_client(cache.conn)
+    if timeout is not None:
+        await client.setex(cache_key, timeout, cache._dumps(data))
+    else:
+        await client.set(cache_key, cache._dumps(data))
+
+
+### Invalidation
+
+async def ainvalidate_dict(model, obj_dict):
+    # Queued till commit same way as sync one
+    if transaction_state.in_transaction():
+        invalidate_dict(model, obj_dict)
+    else:
+        await _invalidate_dict(model, obj_dict)
+
+@handle_connection_failure
+async def _invalidate_dict(model, obj_dict):
+    if no_invalidation.active or not settings.CACHEOPS_ENABLED:
+        return
+    mark_invalidated(model)
+    db_table = non_proxy(model)._meta.db_table
+    stats = await load_script('invalidate')(args=invalidate_dicts_args(model, [obj_dict]),
+                                            client=async_client(node_for(db_table)))
+    record_fanout(db_table, stats)
+    drop_local([db_table])
+
+async def ainvalidate_obj(obj):
+    """
+    Invalidates caches that can possibly be influenced by object
+    """
+    model = non_proxy(obj.__class__)
+    await ainvalidate_dict(model, get_obj_dict(model, obj))
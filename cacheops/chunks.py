@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked storage of large querysets results.
+
+Results longer than chunk size are stored as a header at the cache key, telling the number
+of chunks and a write token, and the chunks themselves at <cache key>:<index> keys.
+All of them are registered in the same invalidators, so they are invalidated together.
+
+Each chunk is prefixed with the token of its write, so chunks could be read one by one
+and still never mix with the ones of other results written after an invalidation.
+"""
+import os
+from binascii import hexlify
+import six
+
+
+__all__ = ('chunk_key', 'new_token', 'chunks_header', 'parse_header',
+           'sign_chunk', 'unsign_chunk', 'split_chunks')
+
+
+# Doesn't clash with serialized data or compression headers
+CHUNKED = b'\x03'
+TOKEN_LENGTH = 16
+
+
+def chunk_key(cache_key, index):
+    return '%s:%d' % (cache_key, index)
+
+def new_token():
+    return hexlify(os.urandom(TOKEN_LENGTH // 2))
+
+def chunks_header(count, token):
+    return CHUNKED + six.text_type(count).encode('ascii') + b':' + token
+
+def parse_header(cache_data):
+    """
+    Returns a (number of chunks, token) pair if cache data is a chunks header, None otherwise.
+    """
+    if cache_data[:1] == CHUNKED:
+        count, _, token = cache_data[1:].partition(b':')
+        return int(count), token
+
+def sign_chunk(token, data):
+    return token + data
+
+def unsign_chunk(token, payload):
+    """
+    Strips token from a chunk payload, returns None if chunk is missing or from another write.
+    """
+    if token and payload is not None and payload[:len(token)] == token:
+        return payload[len(token):]
+
+def split_chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of large serialized payloads.
+
+Compressed payloads are prefixed with a header byte designating compression method,
+this way compressed and uncompressed ones could be read interchangeably.
+"""
+import time
+import zlib
+# lzma is not available in Python 2
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .conf import settings
+from .signals import cache_compressed
+
+
+__all__ = ('compress', 'decompress')
+
+
+ZLIB = b'\x01'
+LZMA = b'\x02'
+
+
+def compress(data):
+    method = settings.CACHEOPS_COMPRESSION
+    if not method or len(data) < settings.CACHEOPS_COMPRESSION_THRESHOLD:
+        return data
+
+    start = time.time()
+    if method == 'zlib':
+        compressed = ZLIB + zlib.compress(data)
+    elif method == 'lzma' and lzma is not None:
+        compressed = LZMA + lzma.compress(data)
+    else:
+        raise ImproperlyConfigured('Unsupported CACHEOPS_COMPRESSION "%s"' % method)
+    cache_compressed.send(sender=None, method=method, size=len(data),
+                          compressed_size=len(compressed), duration=time.time() - start)
+
+    # Not everything compresses well
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompress(data):
+    header = data[:1]
+    if header == ZLIB:
+        return zlib.decompress(data[1:])
+    elif header == LZMA:
+        if lzma is None:
+            raise ImproperlyConfigured('Can\'t decompress lzma payload, no lzma module')
+        return lzma.decompress(data[1:])
+    else:
+        return data
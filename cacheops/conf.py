@@ -16,6 +16,18 @@ class Settings(object):
     CACHEOPS = {}
     CACHEOPS_LRU = False
     CACHEOPS_DEGRADE_ON_FAILURE = False
+    CACHEOPS_NAMESPACE = ''
+    CACHEOPS_GENERATIONS = False
+    CACHEOPS_WARM_UP = False
+    CACHEOPS_ASYNC_INVALIDATION = False
+    CACHEOPS_ASYNC_INVALIDATION_DELAY = 0.1
+    CACHEOPS_METRICS = False
+    CACHEOPS_REAP_INTERVAL = None
+    CACHEOPS_SERIALIZER = 'pickle'
+    CACHEOPS_COMPRESSION = None
+    CACHEOPS_COMPRESSION_THRESHOLD = 16 * 1024
+    CACHEOPS_LOCAL_CACHE_SIZE = 1000
+    CACHEOPS_LOCAL_CACHE_TIMEOUT = 60
     FILE_CACHE_DIR = '/tmp/cacheops_file_cache'
     FILE_CACHE_TIMEOUT = 60*60*24*30
 
@@ -35,9 +47,16 @@ def prepare_profiles():
     profile_defaults = {
         'ops': (),
         'local_get': False,
+        'local_cache': False,
+        'chunk_size': None,
+        'primary_window': None,
+        'grace': None,
+        'xfetch_beta': None,
         'db_agnostic': True,
         'write_only': False,
         'lock': False,
+        'snapshot': False,
+        'serializer': settings.CACHEOPS_SERIALIZER,
     }
     profile_defaults.update(settings.CACHEOPS_DEFAULTS)
 
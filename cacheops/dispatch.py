@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Off-request invalidation, enabled with CACHEOPS_ASYNC_INVALIDATION.
+
+Object invalidations are queued in process and sent by a background thread
+at most CACHEOPS_ASYNC_INVALIDATION_DELAY seconds later, merged same way as on transaction commit.
+Whatever is left is sent at interpreter exit.
+"""
+import os
+import time
+import atexit
+import threading
+import warnings
+from collections import OrderedDict
+
+import redis
+
+from .conf import settings
+
+
+# Retries while redis is down are spaced out doubling delay up to this many seconds
+MAX_RETRY_DELAY = 30
+# Keys with more items queued are sent as a whole, as None items, to keep memory bounded
+MAX_QUEUED_ITEMS = 10000
+
+
+class InvalidationDispatcher(object):
+    """
+    Collects batches, dicts of key -> items, and passes them merged to func in background.
+    Items of a key overflowing MAX_QUEUED_ITEMS are replaced with None, func should handle
+    that by invalidating the key as a whole.
+    """
+    def __init__(self, func):
+        self.func = func
+        self._reset()
+        # Locks could be copied held by other threads, which don't survive fork
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.shutdown)
+
+    def _reset(self):
+        # Whatever is queued in parent process is sent by it
+        self._batches = OrderedDict()
+        self._mutex = threading.Lock()
+        self._flush_mutex = threading.Lock()
+        self._event = threading.Event()
+        self._pid = None
+
+    def put(self, batches):
+        # Python 2 and older Python 3 can't reset on fork, so check pid instead
+        if self._pid is not None and self._pid != os.getpid():
+            self._reset()
+        with self._mutex:
+            # Threads don't survive fork, so start one per process
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._start()
+            _merge(self._batches, batches)
+        self._event.set()
+
+    def _start(self):
+        thread = threading.Thread(target=self.run, name='cacheops-invalidation')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        retry_delay = 0
+        while True:
+            self._event.wait()
+            # Let more invalidations come to send them together
+            time.sleep(max(settings.CACHEOPS_ASYNC_INVALIDATION_DELAY, retry_delay))
+            self._event.clear()
+            try:
+                self.flush()
+                retry_delay = 0
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                retry_delay = min(2 * max(retry_delay, settings.CACHEOPS_ASYNC_INVALIDATION_DELAY),
+                                  MAX_RETRY_DELAY)
+                warnings.warn("Failed to send cacheops invalidations, will retry in %ss. Error: %s"
+                              % (retry_delay, e), RuntimeWarning)
+            except Exception as e:
+                # Keep the thread alive for further invalidations
+                warnings.warn("Failed to send cacheops invalidations. Error: %r" % e,
+                              RuntimeWarning)
+
+    def flush(self):
+        """
+        Sends all queued batches right away.
+        These are kept queued on redis failure to be retried in background.
+        """
+        with self._flush_mutex:
+            with self._mutex:
+                batches, self._batches = self._batches, OrderedDict()
+            if not batches:
+                return
+            try:
+                self.func(batches)
+            except (redis.ConnectionError, redis.TimeoutError):
+                with self._mutex:
+                    self._batches = _merge(batches, self._batches)
+                self._event.set()
+                raise
+
+    def shutdown(self):
+        try:
+            self.flush()
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            warnings.warn("Lost cacheops invalidations at exit. Error: %s" % e, RuntimeWarning)
+
+
+def _merge(batches, other):
+    """
+    Adds items of other batches to batches, returns them.
+    """
+    for key, items in other.items():
+        queued = batches.setdefault(key, [])
+        if queued is None:
+            continue
+        if items is None or len(queued) + len(items) > MAX_QUEUED_ITEMS:
+            batches[key] = None
+        else:
+            queued.extend(items)
+    return batches
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Cheap query fingerprinting for cache keys.
+
+Compiling a query to SQL is a large share of a cache hit cost. Instead we walk the query
+structure separating it into a hashable fingerprint and a list of lookup values. SQL templates
+are compiled once per fingerprint, so a cache key is just a template plus hashed values.
+Lookups and extra() select params change SQL params, but not the template,
+i.e. __contains and __startswith look the same, so these go to values too.
+Anything we are not sure about is refused and handled by full compilation.
+"""
+import datetime
+from decimal import Decimal
+from uuid import UUID
+
+import six
+from django.db.models import Model, Field
+from django.db.models.fields.related import ForeignObjectRel
+from django.db.models.lookups import Lookup, IsNull
+from django.db.models.sql.where import WhereNode
+from django.db.models.sql.datastructures import EmptyResultSet
+# These things appeared in Django 1.8
+try:
+    from django.db.models.expressions import Col
+    from django.db.models.sql.datastructures import BaseTable, Join
+except ImportError:
+    class Col(object):
+        pass
+    BaseTable = Join = Col
+
+
+__all__ = ('Unfingerprintable', 'sql_template')
+
+
+MAX_TEMPLATES = 1000
+
+SIMPLE_TYPES = six.integer_types + six.string_types + \
+    (six.binary_type, type(None), bool, float, Decimal, UUID, datetime.timedelta)
+DATE_TYPES = (datetime.date, datetime.time)
+# contains_aggregate is a cached property
+_simple_classes = frozenset(SIMPLE_TYPES)
+LOOKUP_ATTRS = {'lhs', 'rhs', 'bilateral_transforms', 'contains_aggregate'}
+
+_templates = {}
+_freezers = {}
+
+
+class Unfingerprintable(Exception):
+    pass
+
+
+def sql_template(query, db):
+    """
+    Returns SQL template for a query and a list of values to distinguish it with.
+    Raises Unfingerprintable if query is too complex to be handled this way.
+    """
+    params = []
+    fingerprint = (db, query_fingerprint(query, params))
+    try:
+        template = _templates[fingerprint]
+    except KeyError:
+        try:
+            template, _ = query.get_compiler(db).as_sql()
+        except EmptyResultSet:
+            # Might depend on values, so we can't remember it
+            raise Unfingerprintable
+        if len(_templates) >= MAX_TEMPLATES:
+            _templates.clear()
+        _templates[fingerprint] = template
+    return template, params
+
+
+def query_fingerprint(query, params):
+    """
+    Freezes everything that affects query SQL except lookup values, which go to params.
+    """
+    items = []
+    # Attribute order is the same for queries constructed the same way,
+    # others will just get their own template
+    for name, value in vars(query).items():
+        if value.__class__ in _simple_classes:
+            items.append((name, value))
+        # Caches are derived from other attributes
+        elif name.endswith('_cache'):
+            continue
+        elif isinstance(value, WhereNode):
+            items.append((name, _freeze_where(value, params)))
+        else:
+            frozen = _freeze(value)
+            items.append((name, frozen))
+            # Select params of extra() are not in the template, older Djangos have no underscore
+            if name in ('extra', '_extra') and frozen:
+                params.append(frozen)
+    return tuple(items)
+
+
+def _freeze_where(node, params):
+    if isinstance(node, WhereNode):
+        return (node.__class__, node.connector, node.negated,
+                tuple(_freeze_where(child, params) for child in node.children))
+    elif isinstance(node, Lookup) and isinstance(node.lhs, Col) \
+            and set(vars(node)) <= LOOKUP_ATTRS and not node.bilateral_transforms:
+        # Null check direction changes SQL, so it's a part of query structure
+        if isinstance(node, IsNull):
+            return (node.__class__, _freeze(node.lhs), bool(node.rhs))
+        # Lookup prepares a value for SQL, e.g. wraps it into % for __contains
+        params.append(_class_name(node.__class__))
+        return (node.__class__, _freeze(node.lhs), _freeze_rhs(node.rhs, params))
+    else:
+        raise Unfingerprintable
+
+
+def _freeze_rhs(rhs, params):
+    if isinstance(rhs, (list, tuple, set, frozenset)):
+        values = list(map(_value, rhs))
+        if isinstance(rhs, (set, frozenset)):
+            try:
+                values.sort()
+            except TypeError:
+                pass
+        params.append(values)
+        # Number of placeholders depends on both lengths, there could be duplicates
+        try:
+            return (rhs.__class__, len(rhs), len(set(rhs)))
+        except TypeError:
+            raise Unfingerprintable
+    else:
+        params.append(_value(rhs))
+        return None
+
+
+def _value(value):
+    if isinstance(value, SIMPLE_TYPES):
+        return value
+    elif isinstance(value, DATE_TYPES):
+        # tzinfo repr is not necessarily stable between processes
+        return (value.__class__.__name__, value.isoformat())
+    elif isinstance(value, Model):
+        return (_class_name(value.__class__), value.pk)
+    else:
+        raise Unfingerprintable
+
+
+def _freeze(value):
+    cls = value.__class__
+    if cls in _simple_classes:
+        return value
+    try:
+        freezer = _freezers[cls]
+    except KeyError:
+        freezer = _freezers[cls] = _find_freezer(cls)
+    return freezer(value)
+
+
+def _find_freezer(cls):
+    if issubclass(cls, SIMPLE_TYPES):
+        return lambda value: value
+    elif issubclass(cls, (list, tuple)):
+        return lambda value: tuple(map(_freeze, value)) if value else ()
+    elif issubclass(cls, (set, frozenset)):
+        return lambda value: frozenset(map(_freeze, value)) if value else frozenset()
+    elif cls is dict:
+        # Plain dicts order is arbitrary in older pythons
+        return lambda value: tuple((k, _freeze(v)) for k, v in sorted(value.items()))
+    elif issubclass(cls, dict):
+        return lambda value: tuple((k, _freeze(v)) for k, v in value.items())
+    elif issubclass(cls, type):
+        return _class_name
+    elif issubclass(cls, Col):
+        return lambda col: (Col, col.alias, _freeze(col.target))
+    elif issubclass(cls, Field):
+        return lambda field: (Field, _class_name(field.model), field.name)
+    elif issubclass(cls, ForeignObjectRel):
+        return lambda rel: (ForeignObjectRel, _freeze(rel.field))
+    elif issubclass(cls, (BaseTable, Join)):
+        return lambda table: (cls, _freeze(vars(table)))
+    else:
+        return _unfreezable
+
+
+def _unfreezable(value):
+    raise Unfingerprintable
+
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Generation counters folded into cache keys, enabled with CACHEOPS_GENERATIONS.
+
+There is a global counter and one per table. Cache keys include current values of the global one
+and of all the tables they depend on, so incrementing a counter makes all the dependent caches
+unreachable at once. Those are not deleted, but simply expire by timeout.
+"""
+import six
+
+from .conf import settings
+from .redis import primary_window
+from .sharding import node_for, all_nodes, mget
+
+
+__all__ = ('generation_key', 'generation_keys', 'fold_generations', 'incr_generation')
+
+
+def generation_key(db_table=None):
+    if db_table is None:
+        return settings.CACHEOPS_NAMESPACE + 'gen'
+    return '%sgen:%s' % (settings.CACHEOPS_NAMESPACE, db_table)
+
+def generation_node(db_table=None):
+    # Global generation is kept on the default node
+    return all_nodes()[0] if db_table is None else node_for(db_table)
+
+def generation_keys(db_tables):
+    """
+    Returns (node, key) pairs of generations for given tables, global one goes first.
+    """
+    return [(generation_node(db_table), generation_key(db_table))
+            for db_table in [None] + sorted(db_tables)]
+
+def fold(cache_key, generations):
+    """
+    Appends generations, as read from redis, to a cache key.
+    """
+    if not generations:
+        return cache_key
+    return cache_key + ':' + '.'.join(six.text_type(int(gen or 0)) for gen in generations)
+
+def fold_generations(cache_key, db_tables):
+    """
+    Makes cache key depend on current generations of given tables.
+    """
+    primary = primary_window.covers(db_tables)
+    return fold(cache_key, mget(generation_keys(db_tables), primary))
+
+def incr_generation(db_table=None):
+    generation_node(db_table).incr(generation_key(db_table))
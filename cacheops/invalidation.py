@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import json
+import time
 import threading
-from funcy import memoize, post_processing, ContextDecorator
+from collections import OrderedDict
+from funcy import memoize, post_processing, chunks, ContextDecorator
 from django.db.models.expressions import F
 # Since Django 1.8, `ExpressionNode` is `Expression`
 try:
@@ -9,25 +11,118 @@ try:
 except ImportError:
     from django.db.models.expressions import Expression
 
-from .conf import settings
+from .conf import settings, model_profile, prepare_profiles
 from .utils import non_proxy, NOT_SERIALIZED_FIELDS
-from .redis import redis_client, handle_connection_failure, load_script
-from .transaction import queue_when_in_transaction
+from .redis import handle_connection_failure, load_script, primary_window
+from .sharding import node_for, all_nodes
+from .local import invalidation_channel, local_cache, local_cache_enabled
+from .transaction import queue_when_in_transaction, batch_when_in_transaction
+from .generations import incr_generation
+from .dispatch import InvalidationDispatcher
+from .metrics import metrics, record_fanout
 
 
-__all__ = ('invalidate_obj', 'invalidate_model', 'invalidate_all', 'no_invalidation')
+__all__ = ('invalidate_obj', 'invalidate_many', 'invalidate_model', 'invalidate_all',
+           'no_invalidation', 'flush_invalidations')
 
 
-@queue_when_in_transaction
-@handle_connection_failure
-def invalidate_dict(model, obj_dict):
+# Objects or conj keys per script call, not to block redis for long
+INVALIDATE_BATCH_SIZE = 1000
+
+
+def invalidate_dicts(model, obj_dicts):
+    """
+    Invalidates caches that can possibly be influenced by any of the objects,
+    passed as dicts of field values, with as few script calls as possible.
+    Calls in a transaction are merged till commit.
+    """
+    _invalidate_batches(non_proxy(model), obj_dicts)
+
+@batch_when_in_transaction
+def _invalidate_batches(batches):
+    """
+    Invalidates for a dict of model -> obj dicts, now or in background, see cacheops.dispatch.
+    """
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
+    for model, obj_dicts in batches.items():
+        mark_invalidated(model)
+        metrics.incr('invalidations', model, 'invalidate', len(obj_dicts))
+    if settings.CACHEOPS_ASYNC_INVALIDATION:
+        dispatcher.put(batches)
+    else:
+        handle_connection_failure(_send_batches)(batches)
+    drop_local(model._meta.db_table for model in batches)
+
+def _send_batches(batches):
+    """
+    Sends invalidations for a dict of model -> obj dicts. Duplicate dicts are dropped
+    and script calls for all models go in one pipeline per node.
+    Models with None for dicts, ones overflowing dispatcher queue, are invalidated as a whole.
+    Raises on redis failure, so that dispatcher could retry.
+    """
+    start = time.time()
+    pipes = []
+    for model, obj_dicts in batches.items():
+        if obj_dicts is None:
+            _invalidate_table(model._meta.db_table)
+            continue
+        node = node_for(model._meta.db_table)
+        pipe, db_tables = next(((p, t) for n, p, t in pipes if n is node), (None, None))
+        if pipe is None:
+            pipe, db_tables = node.pipeline(transaction=False), []
+            pipes.append((node, pipe, db_tables))
+        # Dicts of a model come with fields in the same order, so equal ones encode the same
+        encoded = list(OrderedDict.fromkeys(json.dumps(d, default=str) for d in obj_dicts))
+        for chunk in chunks(INVALIDATE_BATCH_SIZE, encoded):
+            load_script('invalidate')(args=_invalidate_args(model, chunk), client=pipe)
+            db_tables.append(model._meta.db_table)
+    for _, pipe, db_tables in pipes:
+        # Scripts return fan-out per scheme
+        for db_table, stats in zip(db_tables, pipe.execute()):
+            record_fanout(db_table, stats)
+    metrics.observe('redis_seconds', time.time() - start, op='invalidate')
+
+dispatcher = InvalidationDispatcher(_send_batches)
+
+@handle_connection_failure
+def flush_invalidations():
+    """
+    Sends invalidations queued with CACHEOPS_ASYNC_INVALIDATION right away,
+    call it before reading own writes from cache.
+    """
+    dispatcher.flush()
+
+def invalidate_dicts_args(model, obj_dicts):
+    return _invalidate_args(model, [json.dumps(d, default=str) for d in obj_dicts])
+
+def _invalidate_args(model, encoded_dicts):
     model = non_proxy(model)
-    load_script('invalidate')(args=[
+    return [
         model._meta.db_table,
-        json.dumps(obj_dict, default=str)
-    ])
+        '[%s]' % ','.join(encoded_dicts),
+        invalidation_channel(),
+        settings.CACHEOPS_NAMESPACE,
+    ]
+
+def invalidate_dict(model, obj_dict):
+    invalidate_dicts(model, [obj_dict])
+
+def drop_local(db_tables):
+    """
+    Drops data depending on tables from local cache of this process right away,
+    other processes drop invalidated keys as these are published, see cacheops.local.
+    """
+    if local_cache_enabled():
+        local_cache.delete_tables(db_tables)
+
+def mark_invalidated(model):
+    """
+    Makes reads go to primary for a while if model profile asks for that.
+    """
+    model = non_proxy(model)
+    profile = model_profile(model)
+    primary_window.mark(model._meta.db_table, profile and profile['primary_window'])
 
 
 def invalidate_obj(obj):
@@ -37,30 +132,92 @@ def invalidate_obj(obj):
     model = non_proxy(obj.__class__)
     invalidate_dict(model, get_obj_dict(model, obj))
 
+def invalidate_many(model, objs):
+    """
+    Invalidates caches that can possibly be influenced by any of the objects of model
+    """
+    model = non_proxy(model)
+    invalidate_dicts(model, [get_obj_dict(model, obj) for obj in objs])
+
 
 @queue_when_in_transaction
 @handle_connection_failure
 def invalidate_model(model):
     """
     Invalidates all caches for given model.
-    NOTE: This is a heavy artillery which uses redis KEYS request,
-          which could be relatively slow on large datasets.
+    Goes through model conj keys index in batches, so its cost is proportional
+    to model cache footprint and redis is not blocked for long.
+    Falls back to SCAN till all conj keys of the table are indexed.
+    With generations enabled just increments model table generation.
     """
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
     model = non_proxy(model)
-    conjs_keys = redis_client.keys('conj:%s:*' % model._meta.db_table)
-    if conjs_keys:
-        cache_keys = redis_client.sunion(conjs_keys)
-        redis_client.delete(*(list(cache_keys) + conjs_keys))
+    mark_invalidated(model)
+    metrics.incr('invalidations', model, 'invalidate_model')
+    _invalidate_table(model._meta.db_table)
+    drop_local([model._meta.db_table])
+
+def _invalidate_table(db_table):
+    if settings.CACHEOPS_GENERATIONS:
+        incr_generation(db_table)
+        return
+    node = node_for(db_table)
+    # SSCAN guarantees to return members present all the time, newer ones are fresh anyway
+    index = '%sconjs:%s' % (settings.CACHEOPS_NAMESPACE, db_table)
+    _invalidate_conj_keys(node, db_table, node.sscan_iter(index, count=INVALIDATE_BATCH_SIZE))
+    # Conj keys written before the index was kept, i.e. by older processes in a rolling deploy,
+    # are looked up with SCAN till it finds none of them
+    if db_table not in _indexed_tables:
+        match = '%sconj:%s:*' % (settings.CACHEOPS_NAMESPACE, db_table)
+        conj_keys = node.scan_iter(match=match, count=INVALIDATE_BATCH_SIZE)
+        if not _invalidate_conj_keys(node, db_table, conj_keys):
+            _indexed_tables.add(db_table)
+
+# Tables SCAN found no unindexed conj keys of in this process
+_indexed_tables = set()
+
+def _invalidate_conj_keys(node, db_table, conj_keys):
+    """
+    Invalidates conj keys and cache keys they refer to in batches,
+    returns how many of them were not in the table index.
+    """
+    unindexed = 0
+    for batch in chunks(INVALIDATE_BATCH_SIZE, conj_keys):
+        args = [db_table, invalidation_channel(), settings.CACHEOPS_NAMESPACE] + batch
+        unindexed += load_script('invalidate_model')(args=args, client=node)
+    return unindexed
 
 
 @queue_when_in_transaction
 @handle_connection_failure
 def invalidate_all():
+    """
+    Invalidates all caches: increments global generation if generations are enabled,
+    deletes namespace keys if it is set and flushes redis databases otherwise.
+    """
     if no_invalidation.active or not settings.CACHEOPS_ENABLED:
         return
-    redis_client.flushdb()
+    metrics.incr('invalidations', None, 'invalidate_all')
+    primary_window.mark(None, max([0] + [profile['primary_window'] or 0
+                                         for profile in prepare_profiles().values() if profile]))
+    if settings.CACHEOPS_GENERATIONS:
+        incr_generation()
+    else:
+        for node in all_nodes():
+            _flush(node)
+    if invalidation_channel():
+        all_nodes()[0].publish(invalidation_channel(), json.dumps('*'))
+    if local_cache_enabled():
+        local_cache.clear()
+
+def _flush(node):
+    if settings.CACHEOPS_NAMESPACE:
+        keys = node.scan_iter(match=settings.CACHEOPS_NAMESPACE + '*', count=INVALIDATE_BATCH_SIZE)
+        for batch in chunks(INVALIDATE_BATCH_SIZE, keys):
+            node.delete(*batch)
+    else:
+        node.flushdb()
 
 
 class InvalidationState(threading.local):
@@ -100,3 +257,24 @@ def get_obj_dict(model, obj):
             continue
         else:
             yield field.attname, field.get_prep_value(value)
+
+@post_processing(dict)
+def get_values_dict(fields, values):
+    """
+    Same as get_obj_dict() for a row of fields values, i.e. fetched with .values_list()
+    """
+    for field, value in zip(fields, values):
+        yield field.attname, None if value is None else field.get_prep_value(value)
+
+@handle_connection_failure
+def scheme_fields(model):
+    """
+    Returns serializable fields used in invalidation schemes of model,
+    None if nothing is cached for it.
+    """
+    db_table = non_proxy(model)._meta.db_table
+    schemes = node_for(db_table).smembers('%sschemes:%s' % (settings.CACHEOPS_NAMESPACE, db_table))
+    if not schemes:
+        return None
+    attnames = {attname for scheme in schemes for attname in scheme.decode().split(',')}
+    return tuple(f for f in serializable_fields(model) if f.attname in attnames)
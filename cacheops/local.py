@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+In-process cache tier in front of redis.
+
+Stores decoded cache data in a bounded LRU dict with TTL. It's kept coherent by listening
+to cache keys published by invalidation scripts, so enabling it for any profile makes
+all the invalidations publish. Invalidating process also drops affected tables synchronously,
+so it reads its own writes.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+from funcy import memoize
+import redis
+
+from .conf import settings, prepare_profiles
+from .sharding import all_nodes
+from .simple import CacheMiss
+
+
+__all__ = ('local_cache', 'local_cache_enabled', 'invalidation_channel', 'publish_invalidations')
+
+
+INVALIDATION_CHANNEL = 'cacheops:invalidated'
+
+# Set when invalidated keys are listened to by something other than local cache
+_publish = False
+
+
+@memoize
+def local_cache_enabled():
+    return any(profile and profile['local_cache'] for profile in prepare_profiles().values())
+
+def invalidation_channel():
+    """
+    Returns a channel to publish invalidated cache keys to or an empty string.
+    """
+    return INVALIDATION_CHANNEL if _publish or local_cache_enabled() else ''
+
+def publish_invalidations():
+    """
+    Makes invalidations publish keys even with local cache disabled, see cacheops.refresh.
+    """
+    global _publish
+    _publish = True
+
+
+class LocalCache(object):
+    """
+    Bounded LRU dict of decoded cache data with TTL.
+
+    Entries are tagged with tables they depend on, so that a process could drop them right away
+    on its own invalidations, other processes drop them as they get invalidated keys published.
+    Every drop bumps an epoch, pass one got before reading redis to set(),
+    so that data read before an invalidation is not stored after it was handled.
+    """
+    def __init__(self):
+        self._data = OrderedDict()
+        self._tables = defaultdict(set)
+        self._epoch = 0
+        self._mutex = threading.Lock()
+        self._listeners = []
+
+    def epoch(self):
+        return self._epoch
+
+    def get(self, key):
+        """
+        Returns cached data or raises CacheMiss if there is none or it's expired.
+        """
+        with self._mutex:
+            try:
+                expires, data, db_tables = self._data.pop(key)
+            except KeyError:
+                raise CacheMiss
+            if expires < time.time():
+                self._untag(key, db_tables)
+                raise CacheMiss
+            # Mark as recently used
+            self._data[key] = expires, data, db_tables
+            return data
+
+    def set(self, key, data, timeout, db_tables=(), epoch=None):
+        # We can't cache anything locally until we listen to invalidation,
+        # otherwise we could miss some.
+        if not self._listening():
+            return
+
+        timeout = min(timeout, settings.CACHEOPS_LOCAL_CACHE_TIMEOUT)
+        db_tables = frozenset(db_tables)
+        with self._mutex:
+            # Something was invalidated since data was read, it could be stale
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._pop(key)
+            self._data[key] = time.time() + timeout, data, db_tables
+            for db_table in db_tables:
+                self._tables[db_table].add(key)
+            while len(self._data) > settings.CACHEOPS_LOCAL_CACHE_SIZE:
+                old_key, (_, _, old_tables) = self._data.popitem(last=False)
+                self._untag(old_key, old_tables)
+
+    def delete_many(self, keys):
+        with self._mutex:
+            self._epoch += 1
+            for key in keys:
+                self._pop(key)
+
+    def delete_tables(self, db_tables):
+        """
+        Drops everything depending on any of the tables, used by invalidating process itself.
+        """
+        with self._mutex:
+            self._epoch += 1
+            for db_table in db_tables:
+                for key in list(self._tables.get(db_table, ())):
+                    self._pop(key)
+
+    def clear(self):
+        with self._mutex:
+            self._epoch += 1
+            self._data.clear()
+            self._tables.clear()
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._untag(key, item[2])
+
+    def _untag(self, key, db_tables):
+        for db_table in db_tables:
+            keys = self._tables.get(db_table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[db_table]
+
+    def _listening(self):
+        # There is a listener per redis node, see cacheops.sharding
+        listeners = self._listeners
+        if not listeners or not all(listener.is_alive() and listener.pid == os.getpid()
+                                    for listener in listeners):
+            with self._mutex:
+                if self._listeners is listeners:
+                    self._epoch += 1
+                    self._data.clear()
+                    self._tables.clear()
+                    self._listeners = [InvalidationListener(self, node) for node in all_nodes()]
+                    for listener in self._listeners:
+                        listener.start()
+            return False
+        return all(listener.subscribed.is_set() for listener in listeners)
+
+local_cache = LocalCache()
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Drops locally cached keys as they are invalidated in redis.
+    """
+    daemon = True
+
+    def __init__(self, cache, client):
+        super(InvalidationListener, self).__init__(name='cacheops-invalidation-listener')
+        self.cache = cache
+        self.client = client
+        self.pid = os.getpid()
+        self.subscribed = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except (redis.ConnectionError, redis.TimeoutError):
+                # We could have missed some invalidations, so we start anew
+                self.subscribed.clear()
+                self.cache.clear()
+                time.sleep(1)
+
+    def listen(self):
+        pubsub = self.client.pubsub()
+        try:
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            while True:
+                message = pubsub.get_message(timeout=1)
+                if message is None:
+                    continue
+                if message['type'] == 'subscribe':
+                    self.subscribed.set()
+                elif message['type'] == 'message':
+                    keys = json.loads(message['data'].decode())
+                    if keys == '*':
+                        self.cache.clear()
+                    else:
+                        self.cache.delete_many(keys)
+        finally:
+            pubsub.close()
@@ -2,10 +2,30 @@ local key = KEYS[1]
 local data = ARGV[1]
 local dnfs = cjson.decode(ARGV[2])
 local timeout = tonumber(ARGV[3])
+local namespace = ARGV[4]
+local grace = tonumber(ARGV[5])
+local delta = ARGV[6]
+
+
+-- Data could be kept stale for a grace period after expiration or invalidation,
+-- such keys are registered in invalidators as '~<grace>:<key>', see invalidate.lua
+local ttl = timeout + grace
+local members = {}
+for i, k in ipairs(KEYS) do
+    members[i] = grace > 0 and '~' .. grace .. ':' .. k or k
+end
 
 
 -- Write data to cache
-redis.call('setex', key, timeout, data)
+redis.call('setex', key, ttl, data)
+-- Chunks of large data go as extra keys and arguments
+for i = 2, #KEYS do
+    redis.call('setex', KEYS[i], ttl, ARGV[i + 5])
+end
+-- Time it took to compute data, used to recompute it early, see sharding.needs_refresh()
+if delta ~= '' then
+    redis.call('setex', key .. ':delta', ttl, delta)
+end
 
 
 -- A pair of funcs
@@ -24,7 +44,7 @@ local conj_cache_key = function (db_table, conj)
         table.insert(parts, eq[1] .. '=' .. tostring(eq[2]))
     end
 
-    return 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return namespace .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
 end
 
 
@@ -34,21 +54,30 @@ for _, disj_pair in ipairs(dnfs) do
     local disj = disj_pair[2]
     for _, conj in ipairs(disj) do
         -- Ensure scheme is known
-        redis.call('sadd', 'schemes:' .. db_table, conj_schema(conj))
+        redis.call('sadd', namespace .. 'schemes:' .. db_table, conj_schema(conj))
 
-        -- Add new cache_key to list of dependencies
+        -- Add new cache_key and its chunks to list of dependencies
         local conj_key = conj_cache_key(db_table, conj)
-        redis.call('sadd', conj_key, key)
+        for _, member in ipairs(members) do
+            redis.call('sadd', conj_key, member)
+        end
+        -- Index conj keys by table for invalidate_model()
+        local conjs_key = namespace .. 'conjs:' .. db_table
+        redis.call('sadd', conjs_key, conj_key)
         -- NOTE: an invalidator should live longer than any key it references.
         --       So we update its ttl on every key if needed.
         -- NOTE: if CACHEOPS_LRU is True when invalidators should be left persistent,
         --       so we strip next section from this script.
         -- TOSTRIP
         local conj_ttl = redis.call('ttl', conj_key)
-        if conj_ttl < timeout then
+        if conj_ttl < ttl then
             -- We set conj_key life with a margin over key life to call expire rarer
             -- And add few extra seconds to be extra safe
-            redis.call('expire', conj_key, timeout * 2 + 10)
+            redis.call('expire', conj_key, ttl * 2 + 10)
+            -- Index should outlive any conj key in it
+            if redis.call('ttl', conjs_key) < ttl * 2 + 10 then
+                redis.call('expire', conjs_key, ttl * 2 + 10)
+            end
         end
         -- /TOSTRIP
     end
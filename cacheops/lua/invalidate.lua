@@ -1,5 +1,7 @@
 local db_table = ARGV[1]
-local obj = cjson.decode(ARGV[2])
+local objs = cjson.decode(ARGV[2])
+local channel = ARGV[3]
+local namespace = ARGV[4]
 
 
 -- Utility functions
@@ -9,34 +11,109 @@ local conj_cache_key = function (db_table, scheme, obj)
         table.insert(parts, field .. '=' .. tostring(obj[field]))
     end
 
-    return 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
+    return namespace .. 'conj:' .. db_table .. ':' .. table.concat(parts, '&')
 end
 
-local call_in_chunks = function (command, args)
+-- Optional key goes before each chunk of args, i.e. for srem. Returns sum of results
+local call_in_chunks = function (command, args, key)
     local step = 1000
+    local total = 0
     for i = 1, #args, step do
-        redis.call(command, unpack(args, i, math.min(i + step - 1, #args)))
+        local chunk = {unpack(args, i, math.min(i + step - 1, #args))}
+        if key then
+            table.insert(chunk, 1, key)
+        end
+        total = total + redis.call(command, unpack(chunk))
     end
+    return total
+end
+
+-- Keys kept stale for a grace period are registered as '~<grace>:<key>',
+-- those only get their ttl cut down to grace, which marks them stale, see cache_thing.lua
+local expire_or_del = function (members)
+    local keys, to_del = {}, {}
+    for _, member in ipairs(members) do
+        local grace, key = string.match(member, '^~(%d+):(.*)$')
+        if grace then
+            if redis.call('pttl', key) > grace * 1000 then
+                redis.call('expire', key, grace)
+            end
+        else
+            key = member
+            table.insert(to_del, key)
+        end
+        table.insert(keys, key)
+    end
+    call_in_chunks('del', to_del)
+    return keys
+end
+
+local union_in_chunks = function (keys)
+    local step = 1000
+    local union, seen = {}, {}
+    for i = 1, #keys, step do
+        local members = redis.call('sunion', unpack(keys, i, math.min(i + step - 1, #keys)))
+        for _, member in ipairs(members) do
+            if not seen[member] then
+                seen[member] = true
+                table.insert(union, member)
+            end
+        end
+    end
+    return union
 end
 
 
--- Calculate conj keys
-local conj_keys = {}
-local schemes = redis.call('smembers', 'schemes:' .. db_table)
+-- Calculate conj keys, schemes are read once for all objects
+local conj_keys, scheme_conj_keys, seen = {}, {}, {}
+local schemes = redis.call('smembers', namespace .. 'schemes:' .. db_table)
 for _, scheme in ipairs(schemes) do
-    table.insert(conj_keys, conj_cache_key(db_table, scheme, obj))
+    scheme_conj_keys[scheme] = {}
+end
+for _, obj in ipairs(objs) do
+    for _, scheme in ipairs(schemes) do
+        local conj_key = conj_cache_key(db_table, scheme, obj)
+        if not seen[conj_key] then
+            seen[conj_key] = true
+            table.insert(conj_keys, conj_key)
+            table.insert(scheme_conj_keys[scheme], conj_key)
+        end
+    end
 end
 
 
--- Delete cache keys and refering conj keys
+-- Delete cache keys and refering conj keys.
+-- Returns fan-out per scheme as flat triples: scheme, conj keys hit, cache keys invalidated
+local stats = {}
 if next(conj_keys) ~= nil then
-    local cache_keys = redis.call('sunion', unpack(conj_keys))
-    -- we delete cache keys since they are invalid
-    -- and conj keys as they will refer only deleted keys
-    redis.call('del', unpack(conj_keys))
-    if next(cache_keys) ~= nil then
+    local members, seen_members = {}, {}
+    for _, scheme in ipairs(schemes) do
+        local keys = scheme_conj_keys[scheme]
+        local scheme_members = union_in_chunks(keys)
+        for _, member in ipairs(scheme_members) do
+            if not seen_members[member] then
+                seen_members[member] = true
+                table.insert(members, member)
+            end
+        end
+        -- we delete cache keys since they are invalid
+        -- and conj keys as they will refer only deleted keys
+        local hit = call_in_chunks('del', keys)
+        if hit > 0 then
+            table.insert(stats, scheme)
+            table.insert(stats, hit)
+            table.insert(stats, #scheme_members)
+        end
+    end
+    call_in_chunks('srem', conj_keys, namespace .. 'conjs:' .. db_table)
+    if next(members) ~= nil then
         -- NOTE: can't just do redis.call('del', unpack(...)) cause there is limit on number
         --       of return values in lua.
-        call_in_chunks('del', cache_keys)
+        local cache_keys = expire_or_del(members)
+        -- Let local caches know what was invalidated
+        if channel ~= '' then
+            redis.call('publish', channel, cjson.encode(cache_keys))
+        end
     end
 end
+return stats
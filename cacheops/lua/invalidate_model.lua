@@ -0,0 +1,48 @@
+local db_table = ARGV[1]
+local channel = ARGV[2]
+local namespace = ARGV[3]
+-- The rest of ARGV are conj keys of the table, a batch read from its index or found by SCAN
+
+
+-- Drop conj keys from table index, counting ones not there, i.e. written before it was kept
+local index = namespace .. 'conjs:' .. db_table
+local conj_keys = {}
+local unindexed = 0
+for i = 4, #ARGV do
+    table.insert(conj_keys, ARGV[i])
+    unindexed = unindexed + 1 - redis.call('srem', index, ARGV[i])
+end
+if next(conj_keys) == nil then
+    return 0
+end
+
+local members = redis.call('sunion', unpack(conj_keys))
+redis.call('del', unpack(conj_keys))
+if next(members) ~= nil then
+    -- Stale-able keys only get their ttl cut down to grace, see invalidate.lua
+    local cache_keys, to_del = {}, {}
+    for _, member in ipairs(members) do
+        local grace, key = string.match(member, '^~(%d+):(.*)$')
+        if grace then
+            if redis.call('pttl', key) > grace * 1000 then
+                redis.call('expire', key, grace)
+            end
+        else
+            key = member
+            table.insert(to_del, key)
+        end
+        table.insert(cache_keys, key)
+    end
+    -- NOTE: can't just do redis.call('del', unpack(...)) cause there is limit on number
+    --       of return values in lua.
+    local step = 1000
+    for i = 1, #to_del, step do
+        redis.call('del', unpack(to_del, i, math.min(i + step - 1, #to_del)))
+    end
+    -- Let local caches know what was invalidated
+    if channel ~= '' then
+        redis.call('publish', channel, cjson.encode(cache_keys))
+    end
+end
+
+return unindexed
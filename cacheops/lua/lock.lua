@@ -0,0 +1,5 @@
+local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
+if locked then
+    redis.call('del', KEYS[2])
+end
+return locked
@@ -0,0 +1,16 @@
+local set_key = KEYS[1]
+
+
+-- Removes members referring to missing keys from a conj set or a table index of conj keys.
+-- Caller passes members in small batches, so that redis is not blocked for long.
+-- Checking and removing in one script makes sure a key written meanwhile is not orphaned.
+local removed = 0
+for _, member in ipairs(ARGV) do
+    -- Keys kept stale for a grace period are registered as '~<grace>:<key>', see cache_thing.lua
+    local key = string.match(member, '^~%d+:(.*)$') or member
+    if redis.call('exists', key) == 0 then
+        removed = removed + redis.call('srem', set_key, member)
+    end
+end
+-- Redis deletes emptied sets itself
+return removed
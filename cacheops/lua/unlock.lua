@@ -0,0 +1,5 @@
+if redis.call('get', KEYS[1]) == 'LOCK' then
+    redis.call('del', KEYS[1])
+end
+redis.call('lpush', KEYS[2], 1)
+redis.call('expire', KEYS[2], 1)
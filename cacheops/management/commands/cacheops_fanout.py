@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from cacheops.metrics import metrics, KEYS_BUCKETS
+
+
+COLUMNS = ('table', 'scheme', 'calls', 'conj keys', 'cache keys', 'avg keys', 'max keys')
+
+
+class Command(BaseCommand):
+    help = 'Shows table schemes invalidating most cache keys, '\
+           'as collected with CACHEOPS_METRICS enabled'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Number of worst schemes to show')
+
+    def handle(self, **options):
+        collected = metrics.collect()
+        offenders = sorted(((counts[-1], db_table, scheme, counts)
+                            for (name, db_table, scheme), counts in collected.items()
+                            if name == 'invalidated_keys'), reverse=True)
+        rows = [COLUMNS]
+        for total, db_table, scheme, counts in offenders[:options['limit']]:
+            calls = sum(counts[:-1])
+            rows.append((
+                db_table, scheme or '(all)', str(calls),
+                str(collected.get(('invalidated_conjs', db_table, scheme), 0)),
+                str(total), '%.1f' % (float(total) / calls), max_keys(counts),
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+        for row in rows:
+            self.stdout.write('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def max_keys(counts):
+    """
+    Tells the bucket of the largest invalidation from histogram counts.
+    """
+    last = max(i for i, count in enumerate(counts[:-1]) if count)
+    return '<= %d' % KEYS_BUCKETS[last] if last < len(KEYS_BUCKETS) else '> %d' % KEYS_BUCKETS[-1]
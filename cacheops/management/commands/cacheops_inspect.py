@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import json
+from bisect import bisect_left
+
+import redis
+from django.core.management.base import BaseCommand, CommandError
+
+from cacheops.conf import settings
+from cacheops.sharding import all_nodes
+
+
+# Cache data kinds, keys of others start with a table name
+DATA_KINDS = {'q', 'as', 'c'}
+TABLE_KINDS = {'conj', 'conjs', 'schemes', 'gen'}
+# Auxiliary keys of cached data, see cacheops.sharding and cacheops.redis
+SUFFIXES = ('delta', 'refresh', 'signal')
+
+CARDINALITY_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class Command(BaseCommand):
+    help = 'Samples cacheops keys with SCAN and MEMORY USAGE and reports memory '\
+           'by key kind and table, conj sets cardinality and schemes per table as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100000,
+                            help='Max number of keys to sample per redis node, 0 for all')
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='Keys to inspect per pipeline')
+        parser.add_argument('--indent', type=int, default=2)
+
+    def handle(self, **options):
+        report = Report()
+        try:
+            for node in all_nodes():
+                report.inspect(node, options['limit'], options['batch'])
+        except redis.ResponseError as e:
+            raise CommandError('Failed to inspect keys, MEMORY USAGE needs redis 4.0+: %s' % e)
+        self.stdout.write(json.dumps(report.result(), indent=options['indent'] or None,
+                                     sort_keys=True))
+
+
+class Report(object):
+    def __init__(self):
+        self.scanned = self.total = 0
+        self.sampled = False
+        self.kinds = {}
+        self.tables = {}
+        self.cardinalities = []
+
+    def inspect(self, node, limit, batch):
+        prefix = settings.CACHEOPS_NAMESPACE
+        self.total += node.dbsize()
+        keys, count = [], 0
+        for key in node.scan_iter(match=prefix + '*', count=batch):
+            keys.append(key.decode('utf-8', 'replace')[len(prefix):])
+            count += 1
+            if len(keys) >= batch:
+                self.inspect_keys(node, prefix, keys)
+                keys = []
+            if limit and count >= limit:
+                self.sampled = True
+                break
+        self.inspect_keys(node, prefix, keys)
+
+    def inspect_keys(self, node, prefix, keys):
+        kinds = [classify(key) for key in keys]
+        pipe = node.pipeline(transaction=False)
+        for key, (kind, _) in zip(keys, kinds):
+            pipe.execute_command('MEMORY', 'USAGE', prefix + key)
+            # Cardinality of conj and schemes sets is reported
+            if kind in ('conj', 'schemes'):
+                pipe.scard(prefix + key)
+        results = iter(pipe.execute())
+
+        self.scanned += len(keys)
+        for key, (kind, db_table) in zip(keys, kinds):
+            memory = next(results) or 0  # Key could expire meanwhile
+            cardinality = next(results) if kind in ('conj', 'schemes') else None
+            stats = self.kinds.setdefault(kind, {'keys': 0, 'memory': 0})
+            stats['keys'] += 1
+            stats['memory'] += memory
+            if db_table is None:
+                continue
+            table = self.tables.setdefault(db_table, {
+                'keys': 0, 'memory': 0, 'conj_keys': 0, 'cache_keys': 0, 'schemes': 0})
+            table['keys'] += 1
+            table['memory'] += memory
+            if kind == 'conj':
+                table['conj_keys'] += 1
+                table['cache_keys'] += cardinality
+                self.cardinalities.append(cardinality)
+            elif kind == 'schemes':
+                table['schemes'] = cardinality
+
+    def result(self):
+        # Scale sampled numbers up to the whole db, which is assumed to be used by cacheops only
+        scale = float(self.total) / self.scanned if self.sampled else 1
+        for stats in self.kinds.values():
+            stats['estimated_memory'] = int(stats['memory'] * scale)
+        return {
+            'keys': {'scanned': self.scanned, 'total': self.total, 'scale': scale},
+            'kinds': self.kinds,
+            'tables': self.tables,
+            'conj_cardinality': cardinality_stats(self.cardinalities),
+        }
+
+
+def classify(key):
+    """
+    Returns (kind, db_table) for a key without namespace, db_table is None for cached data.
+    """
+    kind, _, rest = key.partition(':')
+    if kind in TABLE_KINDS:
+        return kind, rest.split(':', 1)[0] or None
+    if kind in DATA_KINDS:
+        suffix = key.rsplit(':', 1)[-1]
+        if suffix in SUFFIXES:
+            return suffix, None
+        # Views cached with cached_view() or cached_view_as()
+        return 'v' if rest.startswith('v:') else kind, None
+    return ('metrics' if kind == 'metrics' else 'other'), None
+
+def cardinality_stats(cardinalities):
+    buckets = [0] * (len(CARDINALITY_BUCKETS) + 1)
+    for cardinality in cardinalities:
+        buckets[bisect_left(CARDINALITY_BUCKETS, cardinality)] += 1
+    labels = ['<=%d' % b for b in CARDINALITY_BUCKETS] + ['>%d' % CARDINALITY_BUCKETS[-1]]
+    return {
+        'sets': len(cardinalities),
+        'max': max(cardinalities) if cardinalities else 0,
+        'mean': float(sum(cardinalities)) / len(cardinalities) if cardinalities else 0,
+        'distribution': dict(zip(labels, buckets)),
+    }
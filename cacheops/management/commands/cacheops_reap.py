@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from cacheops.reaper import Reaper
+
+
+class Command(BaseCommand):
+    help = 'Removes references to evicted cache keys from invalidation structures, '\
+           'useful with CACHEOPS_LRU'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=100,
+                            help='Members checked per script call')
+        parser.add_argument('--pause', type=float, default=0.01,
+                            help='Seconds to sleep after each call')
+        parser.add_argument('--loop', type=float, default=None,
+                            help='Keep reaping with this many seconds between passes')
+
+    def handle(self, **options):
+        reaper = Reaper(batch=options['batch'], pause=options['pause'])
+        if options['loop']:
+            reaper.run(options['loop'])
+        else:
+            stats = reaper.reap()
+            self.stdout.write('Checked %(checked)d members of %(sets)d sets, '
+                              'removed %(removed)d' % stats)
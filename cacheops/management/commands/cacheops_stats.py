@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from cacheops.metrics import metrics
+
+
+COLUMNS = ('model', 'op', 'hits', 'misses', 'hit %', 'invalidated',
+           'redis ms', 'lock waits', 'avg bytes')
+
+
+class Command(BaseCommand):
+    help = 'Shows cache metrics of all processes running with CACHEOPS_METRICS enabled'
+
+    def handle(self, **options):
+        rows = [COLUMNS] + [self.row(model, op, values)
+                            for (model, op), values in sorted(group(metrics.collect()).items())]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+        for row in rows:
+            self.stdout.write('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+    def row(self, model, op, values):
+        hits, misses = values.get('hits', 0), values.get('misses', 0)
+        redis_ms = mean(values.get('redis_seconds'))
+        return (
+            model or '-', op or '-', str(hits), str(misses),
+            '%.1f' % (100.0 * hits / (hits + misses)) if hits + misses else '-',
+            str(values.get('invalidations', 0)),
+            '%.2f' % (redis_ms * 1000) if redis_ms is not None else '-',
+            str(sum(values.get('lock_wait_seconds', [0])[:-1])),
+            '%d' % mean(values['payload_bytes']) if 'payload_bytes' in values else '-',
+        )
+
+
+def group(collected):
+    """
+    Groups metrics by (model, op) into dicts name -> value.
+    """
+    groups = {}
+    for (name, model, op), value in collected.items():
+        groups.setdefault((model, op), {})[name] = value
+    return groups
+
+def mean(counts):
+    # Histogram counts per bucket are followed by sum
+    if not counts or not sum(counts[:-1]):
+        return None
+    return counts[-1] / sum(counts[:-1])
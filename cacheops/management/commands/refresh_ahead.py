@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from cacheops.refresh import RefreshWorker
+
+
+class Command(BaseCommand):
+    help = 'Refreshes caches registered with refresh_ahead() as they are invalidated or expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of threads refreshing caches')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='How often to check caches ttls, in seconds')
+        parser.add_argument('--ahead', type=int, default=10,
+                            help='Refresh caches this many seconds before they expire')
+
+    def handle(self, **options):
+        worker = RefreshWorker(workers=options['workers'], interval=options['interval'],
+                               ahead=options['ahead'])
+        worker.run()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics, enabled with CACHEOPS_METRICS.
+
+Counters and histograms are aggregated per metric, model and op in a dict under a lock.
+Cache reads and writes set current model and op with metrics.labels(), so that lower layers
+could record redis latency, serialization time and payload sizes without passing them around.
+
+Each process also saves its metrics to redis now and then and registers its key along with
+publish time in a hash, collect() sums up fresh ones for metrics_view and cacheops_stats command.
+"""
+import os
+import json
+import time
+import socket
+import threading
+from bisect import bisect_left
+
+import six
+import redis
+from django.http import HttpResponse
+
+from .conf import settings
+from .signals import cache_read
+
+
+__all__ = ('metrics', 'metrics_view', 'record_fanout')
+
+
+SECONDS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+KEYS_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+COUNTERS = {
+    'hits': 'Cache hits',
+    'misses': 'Cache misses',
+    'invalidations': 'Invalidated objects, models or whole caches',
+    'invalidated_conjs': 'Conj keys hit by invalidation',
+}
+HISTOGRAMS = {
+    'redis_seconds': ('Redis round trips', SECONDS_BUCKETS),
+    'lock_wait_seconds': ('Waits for other process to fill the cache', SECONDS_BUCKETS),
+    'serialize_seconds': ('Serialization and compression', SECONDS_BUCKETS),
+    'deserialize_seconds': ('Decompression and deserialization', SECONDS_BUCKETS),
+    'payload_bytes': ('Sizes of cached data', BYTES_BUCKETS),
+    'invalidated_keys': ('Cache keys invalidated by a single call', KEYS_BUCKETS),
+}
+# Invalidation fan-out goes by table and scheme instead of model and op, see record_fanout()
+FANOUT = {'invalidated_conjs', 'invalidated_keys'}
+
+# How often each process saves its metrics to redis, these expire if it's gone
+PUBLISH_INTERVAL = 10
+PUBLISH_TTL = PUBLISH_INTERVAL * 3
+
+
+class Labels(object):
+    def __init__(self, local, model, op):
+        self.local = local
+        self.labels = model, op
+
+    def __enter__(self):
+        self.prev = getattr(self.local, 'labels', None)
+        self.local.labels = self.labels
+
+    def __exit__(self, *exc_info):
+        self.local.labels = self.prev
+
+
+class Metrics(object):
+    def __init__(self):
+        self._local = threading.local()
+        self._start_process()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start_process)
+
+    def _start_process(self):
+        # A forked child starts from scratch not to count parent metrics twice,
+        # the lock could also be copied held by some other thread
+        self._mutex = threading.Lock()
+        self._pid = os.getpid()
+        self._publish_at = 0
+        self._values = {}
+
+    def _check_pid(self):
+        # Python 2 and older Python 3 can't reset on fork
+        if not hasattr(os, 'register_at_fork') and self._pid != os.getpid():
+            self._start_process()
+
+    def reset(self):
+        with self._mutex:
+            self._values = {}
+
+    def labels(self, model, op):
+        """
+        Sets model, a class or a function, and op for metrics recorded in this block.
+        """
+        return Labels(self._local, model, op)
+
+    def _key(self, name, model, op):
+        if model is None and op is None:
+            model, op = getattr(self._local, 'labels', None) or (None, None)
+        return name, model, op
+
+    def incr(self, name, model=None, op=None, value=1):
+        if not settings.CACHEOPS_METRICS:
+            return
+        self._check_pid()
+        key = self._key(name, model, op)
+        with self._mutex:
+            self._values[key] = self._values.get(key, 0) + value
+        self._maybe_publish()
+
+    def observe(self, name, value, model=None, op=None):
+        if not settings.CACHEOPS_METRICS:
+            return
+        self._check_pid()
+        key = self._key(name, model, op)
+        buckets = HISTOGRAMS[name][1]
+        with self._mutex:
+            counts = self._values.get(key)
+            if counts is None:
+                # Counts per bucket, the last one is +Inf, followed by sum
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+        self._maybe_publish()
+
+    def snapshot(self):
+        """
+        Returns a dict (name, model label, op) -> value of metrics of this process.
+        Histogram values are lists of counts per bucket, the last one is +Inf, followed by sum.
+        """
+        self._check_pid()
+        with self._mutex:
+            values = list(self._values.items())
+        result = {}
+        for (name, model, op), value in values:
+            # Proxies and a model could go by the same label
+            _add(result, (name, _label(model), op or ''), value)
+        return result
+
+    def _maybe_publish(self):
+        if time.time() >= self._publish_at:
+            self._publish_at = time.time() + PUBLISH_INTERVAL
+            try:
+                self.publish()
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+
+    def publish(self):
+        """
+        Saves metrics of this process to redis for collect().
+        """
+        from .sharding import all_nodes  # sharding depends on redis, which records metrics
+        data = json.dumps([list(key) + [value] for key, value in self.snapshot().items()])
+        key = _process_key()
+        pipe = all_nodes()[0].pipeline(transaction=False)
+        pipe.set(key, data, ex=PUBLISH_TTL)
+        pipe.hset(_registry_key(), key, time.time())
+        pipe.execute()
+
+    def collect(self):
+        """
+        Returns the same as snapshot(), but summed up over all the processes.
+        """
+        from .sharding import all_nodes
+        self.publish()
+        node = all_nodes()[0]
+        registry = node.hgetall(_registry_key())
+        # Forget processes gone long ago, their keys are expired by now
+        stale = [key for key, published in registry.items()
+                 if float(published) < time.time() - PUBLISH_TTL]
+        if stale:
+            node.hdel(_registry_key(), *stale)
+        keys = [key for key in registry if key not in stale]
+        result = {}
+        for data in node.mget(keys) if keys else []:
+            if data is not None:
+                for name, model, op, value in json.loads(data.decode()):
+                    _add(result, (name, model, op), value)
+        return result
+
+metrics = Metrics()
+
+
+def _process_key():
+    return '%smetrics:%s:%d' % (settings.CACHEOPS_NAMESPACE, socket.gethostname(), os.getpid())
+
+def _registry_key():
+    return settings.CACHEOPS_NAMESPACE + 'metrics:procs'
+
+def _label(model):
+    if model is None:
+        return ''
+    if isinstance(model, six.string_types):
+        return model
+    if hasattr(model, '_meta'):
+        return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+    return '%s.%s' % (model.__module__, model.__name__)
+
+def _add(values, key, value):
+    if key not in values:
+        values[key] = value if key[0] in COUNTERS else list(value)
+    elif key[0] in COUNTERS:
+        values[key] += value
+    else:
+        values[key] = [a + b for a, b in zip(values[key], value)]
+
+
+def _record_read(sender, func=None, hit=None, **kwargs):
+    labels = getattr(metrics._local, 'labels', None)
+    op = labels[1] if labels else 'cached_as' if func else 'fetch'
+    model = sender or (labels[0] if labels else func)
+    metrics.incr('hits' if hit else 'misses', model, op)
+
+cache_read.connect(_record_read, weak=False, dispatch_uid='cacheops.metrics')
+
+
+def record_fanout(db_table, stats):
+    """
+    Records flat (scheme, conj keys hit, cache keys) triples returned by invalidate.lua.
+    """
+    if not settings.CACHEOPS_METRICS or not stats:
+        return
+    for i in range(0, len(stats), 3):
+        scheme = stats[i].decode() if isinstance(stats[i], bytes) else stats[i]
+        metrics.incr('invalidated_conjs', db_table, scheme, stats[i + 1])
+        metrics.observe('invalidated_keys', stats[i + 2], db_table, scheme)
+
+
+def prometheus_text(values):
+    """
+    Formats collected metrics in Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(COUNTERS):
+        lines.append('# HELP cacheops_%s_total %s' % (name, COUNTERS[name]))
+        lines.append('# TYPE cacheops_%s_total counter' % name)
+        for (_, model, op), value in _series(values, name):
+            lines.append('cacheops_%s_total{%s} %s' % (name, _labels_text(name, model, op), value))
+    for name in sorted(HISTOGRAMS):
+        description, buckets = HISTOGRAMS[name]
+        lines.append('# HELP cacheops_%s %s' % (name, description))
+        lines.append('# TYPE cacheops_%s histogram' % name)
+        for (_, model, op), counts in _series(values, name):
+            labels = _labels_text(name, model, op)
+            total = 0
+            for le, count in zip([str(b) for b in buckets] + ['+Inf'], counts):
+                total += count
+                lines.append('cacheops_%s_bucket{%s,le="%s"} %d' % (name, labels, le, total))
+            lines.append('cacheops_%s_sum{%s} %r' % (name, labels, float(counts[-1])))
+            lines.append('cacheops_%s_count{%s} %d' % (name, labels, total))
+    return '\n'.join(lines) + '\n'
+
+def _series(values, name):
+    return sorted(item for item in values.items() if item[0][0] == name)
+
+def _labels_text(name, model, op):
+    if name in FANOUT:
+        return 'table="%s",scheme="%s"' % (model, op)
+    return 'model="%s",op="%s"' % (model, op)
+
+
+def metrics_view(request):
+    """
+    Exports metrics of all processes for Prometheus, wire it into your urls.
+    """
+    return HttpResponse(prometheus_text(metrics.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
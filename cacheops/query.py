@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 import sys
+import copy
 import json
 import threading
+import time
+from itertools import islice
 import six
-from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk
+from funcy import select_keys, cached_property, once, once_per, monkey, wraps, walk, partial, \
+    memoize
 from funcy.py2 import mapcat, map
-from .cross import pickle, md5
+from .cross import md5
 
 import django
 from django.utils.encoding import smart_str, force_text
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models import Manager, Model
+from django.db.models import Manager, Model, Q, F
 from django.db.models.query import QuerySet
 from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
@@ -19,37 +23,102 @@ try:
     from django.db.models.query import MAX_GET_RESULTS
 except ImportError:
     MAX_GET_RESULTS = None
+# Iterable classes appeared in Django 1.9
+try:
+    from django.db.models.query import ModelIterable, ValuesListIterable
+except ImportError:
+    ModelIterable = ValuesListIterable = None
 
 from .conf import model_profile, model_is_fake, settings, ALL_OPS
-from .utils import monkey_mix, stamp_fields, func_cache_key, cached_view_fab, family_has_profile
-from .redis import redis_client, handle_connection_failure, load_script
-from .tree import dnfs
-from .invalidation import invalidate_obj, invalidate_dict, no_invalidation
+from .utils import monkey_mix, stamp_fields, func_cache_key, cached_view_fab, family_has_profile, \
+                   iscoroutinefunction, non_proxy
+from .redis import redis_client, handle_connection_failure, load_script, primary_window
+from .tree import dnfs, query_tables, read_tables
+from .generations import fold_generations
+from .sharding import MARKER, is_sharded, data_nodes, split_dnfs, getting, get, markers_exist, \
+                      mget
+from .fingerprint import sql_template, Unfingerprintable
+from .invalidation import invalidate_obj, invalidate_dict, invalidate_dicts, invalidate_many, \
+                          no_invalidation, scheme_fields, serializable_fields, get_obj_dict, \
+                          get_values_dict, Expression
+from .local import local_cache, local_cache_enabled
+from .simple import CacheMiss
 from .transaction import transaction_state
-from .signals import cache_read
+from .signals import cache_read, cache_computed
+from .metrics import metrics
+from .serializers import dumps, loads
+from .chunks import chunk_key, new_token, chunks_header, parse_header, sign_chunk, unsign_chunk, \
+    split_chunks
 
 
-__all__ = ('cached_as', 'cached_view_as', 'install_cacheops')
+__all__ = ('cached_as', 'cached_view_as', 'fetch_many', 'install_cacheops')
 
 _local_get_cache = {}
 
 
 @handle_connection_failure
-def cache_thing(cache_key, data, cond_dnfs, timeout):
+def cache_thing(cache_key, data, cond_dnfs, timeout, client=None, serializer='pickle',
+                chunk_size=None, grace=None, delta=None):
     """
     Writes data to cache and creates appropriate invalidators.
+    Pass a pipeline as client to queue the write instead of executing it, not when sharding.
+    Lists longer than chunk_size are stored in chunks, see cacheops.chunks.
+    Data is kept stale for grace seconds after expiring or being invalidated, see getting().
+    Time it took to compute data, delta, is stored along to recompute it early.
     """
     # Could have changed after last check, sometimes superficially
-    if transaction_state.is_dirty():
+    if transaction_state.is_dirty(db_table for db_table, _ in cond_dnfs):
+        return
+    calls = cache_thing_calls(cache_key, data, cond_dnfs, timeout, serializer, chunk_size,
+                              grace, delta)
+    start = time.time()
+    for node, keys, args in calls:
+        load_script('cache_thing', settings.CACHEOPS_LRU)(keys=keys, args=args,
+                                                          client=client or node)
+    # Writes to a pipeline are only queued here
+    if client is None:
+        metrics.observe('redis_seconds', time.time() - start)
+
+def cache_thing_calls(cache_key, data, cond_dnfs, timeout, serializer='pickle', chunk_size=None,
+                      grace=None, delta=None):
+    """
+    Prepares cache_thing script calls as (node, keys, args) triples.
+    """
+    if chunk_size and isinstance(data, list) and len(data) > chunk_size:
+        chunks, token = split_chunks(data, chunk_size), new_token()
+        keys = [cache_key] + [chunk_key(cache_key, i) for i in range(len(chunks))]
+        payloads = [chunks_header(len(chunks), token)] \
+            + [sign_chunk(token, dumps(chunk, serializer)) for chunk in chunks]
+    else:
+        keys, payloads = [cache_key], [dumps(data, serializer)]
+    return _payloads_calls(keys, payloads, cond_dnfs, timeout, grace, delta=delta)
+
+def _payloads_calls(keys, payloads, cond_dnfs, timeout, grace=None, markers=True, delta=None):
+    # Data goes to the first node, others only get markers of the first key, see cacheops.sharding
+    shards = split_dnfs(cond_dnfs)
+    (node, node_dnfs), rest = shards[0], shards[1:] if markers else []
+    calls = [(node, keys, _payloads_args(payloads, node_dnfs, timeout, grace, delta))]
+    calls.extend((node, keys[:1], _payloads_args([MARKER], node_dnfs, timeout, grace))
+                 for node, node_dnfs in rest)
+    return calls
+
+def _payloads_args(payloads, cond_dnfs, timeout, grace=None, delta=None):
+    return [payloads[0], json.dumps(cond_dnfs, default=str), timeout,
+            settings.CACHEOPS_NAMESPACE, int(grace or 0),
+            '' if delta is None else '%.6f' % delta] + payloads[1:]
+
+@handle_connection_failure
+def _cache_payloads(keys, payloads, cond_dnfs, timeout, grace=None, markers=True):
+    """
+    Writes serialized payloads to keys all depending on the same conditions.
+    """
+    if transaction_state.is_dirty(db_table for db_table, _ in cond_dnfs):
         return
-    load_script('cache_thing', settings.CACHEOPS_LRU)(
-        keys=[cache_key],
-        args=[
-            pickle.dumps(data, -1),
-            json.dumps(cond_dnfs, default=str),
-            timeout
-        ]
-    )
+    calls = _payloads_calls(keys, payloads, cond_dnfs, timeout, grace, markers)
+    start = time.time()
+    for node, keys, args in calls:
+        load_script('cache_thing', settings.CACHEOPS_LRU)(keys=keys, args=args, client=node)
+    metrics.observe('redis_seconds', time.time() - start)
 
 
 def cached_as(*samples, **kwargs):
@@ -61,6 +130,8 @@ def cached_as(*samples, **kwargs):
     extra = kwargs.pop('extra', None)
     key_func = kwargs.pop('key_func', func_cache_key)
     lock = kwargs.pop('lock', None)
+    use_local = kwargs.pop('local_cache', None)
+    serializer = kwargs.pop('serializer', None)
     if not samples:
         raise TypeError('Pass a queryset, a model or an object to cache like')
     if kwargs:
@@ -85,30 +156,94 @@ def cached_as(*samples, **kwargs):
 
     querysets = map(_get_queryset, samples)
     cond_dnfs = mapcat(dnfs, querysets)
-    key_extra = [qs._cache_key() for qs in querysets]
+    key_extra = [qs._cache_key(generations=False) for qs in querysets]
     key_extra.append(extra)
     if not timeout:  # TODO: switch to is None on major release
         timeout = min(qs._cacheprofile['timeout'] for qs in querysets)
     if lock is None:
         lock = any(qs._cacheprofile['lock'] for qs in querysets)
+    # Could only serve stale data if all the querysets allow that
+    grace = min(qs._cacheprofile['grace'] or 0 for qs in querysets)
+    beta = max(qs._cacheprofile['xfetch_beta'] or 0 for qs in querysets)
+    if use_local is None:
+        use_local = any(qs._cacheprofile['local_cache'] for qs in querysets)
+    if serializer is None:
+        serializers = {qs._cacheprofile['serializer'] for qs in querysets}
+        serializer = serializers.pop() if len(serializers) == 1 else settings.CACHEOPS_SERIALIZER
+    if serializer != 'pickle':
+        key_extra.append(serializer)
+    db_tables = {db_table for db_table, _ in cond_dnfs}
+    # Tables of subqueries are not invalidated on, but their changes in transaction still count
+    read = map(read_tables, querysets)
+    dirty_tables = None if None in read else set().union(*read)
+    nodes = data_nodes(db_tables)
 
     def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            if transaction_state.is_dirty() or not settings.CACHEOPS_ENABLED:
-                return func(*args, **kwargs)
+        if iscoroutinefunction(func):
+            from .aio import cached_as_coroutine  # aio depends on this module
+            return cached_as_coroutine(func, key_func, key_extra, cond_dnfs, timeout, lock,
+                                       use_local, serializer, db_tables, dirty_tables,
+                                       grace, beta)
 
+        def make_key(args, kwargs):
             cache_key = 'as:' + key_func(func, args, kwargs, key_extra)
+            cache_key = settings.CACHEOPS_NAMESPACE + cache_key
+            if settings.CACHEOPS_GENERATIONS:
+                cache_key = fold_generations(cache_key, db_tables)
+            return cache_key
+
+        def compute(cache_key, args, kwargs):
+            start = time.time()
+            result = func(*args, **kwargs)
+            duration = time.time() - start
+            cache_computed.send(sender=None, func=func, duration=duration)
+            cache_thing(cache_key, result, cond_dnfs, timeout, serializer=serializer,
+                        grace=grace, delta=duration if beta else None)
+            return result
+
+        # count() and exists() are cached as functions too, but measured as querysets ops
+        labels = getattr(func, '_metrics_labels', (func, 'cached_as'))
 
-            with redis_client.getting(cache_key, lock=lock) as cache_data:
-                cache_read.send(sender=None, func=func, hit=cache_data is not None)
-                if cache_data is not None:
-                    return pickle.loads(cache_data)
-                else:
-                    result = func(*args, **kwargs)
-                    cache_thing(cache_key, result, cond_dnfs, timeout)
-                    return result
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if transaction_state.is_dirty(dirty_tables) or not settings.CACHEOPS_ENABLED:
+                return func(*args, **kwargs)
 
+            with metrics.labels(*labels):
+                cache_key = make_key(args, kwargs)
+                local = use_local and local_cache_enabled()
+                if local:
+                    try:
+                        result = local_cache.get(cache_key)
+                        cache_read.send(sender=None, func=func, hit=True)
+                        # Anything could be returned, so copy it all
+                        return copy.deepcopy(result)
+                    except CacheMiss:
+                        epoch = local_cache.epoch()
+
+                primary = primary_window.covers(db_tables)
+                with getting(cache_key, nodes, lock=lock, primary=primary,
+                             grace=grace, beta=beta) as cache_data:
+                    cache_read.send(sender=None, func=func, hit=cache_data is not None)
+                    if cache_data is not None:
+                        result = loads(cache_data, serializer)
+                    else:
+                        result = compute(cache_key, args, kwargs)
+
+                if local:
+                    local_cache.set(cache_key, copy.deepcopy(result), timeout, db_tables, epoch)
+                return result
+
+        def refresh(*args, **kwargs):
+            """
+            Recomputes result and writes it to cache, used by refresh-ahead.
+            """
+            return compute(make_key(args, kwargs), args, kwargs)
+
+        wrapper.cache_key = lambda *args, **kwargs: make_key(args, kwargs)
+        wrapper.refresh = refresh
+        # Where and how long stale cache is kept, see cacheops.refresh
+        wrapper._cache_nodes, wrapper._cache_grace = nodes, grace
         return wrapper
     return decorator
 
@@ -117,6 +252,102 @@ def cached_view_as(*samples, **kwargs):
     return cached_view_fab(cached_as)(*samples, **kwargs)
 
 
+@handle_connection_failure
+def _execute(pipe):
+    pipe.execute()
+
+def fetch_many(*querysets):
+    """
+    Evaluates several querysets at once.
+    Cached ones are looked up with a single MGET, misses are fetched from db one by one
+    and then written back to cache in one pipeline.
+    Returns a list of results in the same order as querysets passed.
+    NOTE: lock option is ignored here.
+    """
+    to_read, to_write = [], []
+    # Results read after an invalidation was handled are not stored locally, see cacheops.local
+    epoch = local_cache.epoch()
+    for qs in querysets:
+        if qs._result_cache is not None or not qs._cacheprofile \
+                or 'fetch' not in qs._cacheprofile['ops'] \
+                or qs._in_dirty_transaction() or not settings.CACHEOPS_ENABLED:
+            continue
+        cache_key = qs._cache_key()
+        if qs._cacheprofile['write_only'] or qs._for_write:
+            to_write.append((qs, cache_key))
+        elif qs._cacheprofile['grace']:
+            # Stale data needs a separate check and refresh, fetched one by one below
+            continue
+        elif not qs._local_cache_get(cache_key):
+            to_read.append((qs, cache_key, qs._data_nodes(), qs._read_primary()))
+
+    if to_read:
+        node_keys = [(nodes[0], cache_key) for _, cache_key, nodes, _ in to_read]
+        # Recently invalidated tables are rare, so don't bother splitting reads
+        primary = any(primary for _, _, _, primary in to_read)
+        with metrics.labels(None, 'fetch_many'):
+            cache_datas = mget(node_keys, primary) or [None] * len(to_read)
+        for (qs, cache_key, nodes, primary), cache_data in zip(to_read, cache_datas):
+            if cache_data is not None and not markers_exist(cache_key, nodes, primary):
+                cache_data = None
+            results = qs._load_results(cache_key, cache_data)
+            cache_read.send(sender=qs.model, func=None, hit=results is not None)
+            if results is not None:
+                qs._result_cache = results
+                qs._local_cache_set(cache_key, epoch)
+            else:
+                to_write.append((qs, cache_key))
+
+    if to_write:
+        for qs, _ in to_write:
+            # TODO: remove .nocache() when iterator() is dropped
+            qs._result_cache = list(qs.nocache().iterator())
+        # Sharded writes go to different nodes, so these are not pipelined
+        pipe = None if is_sharded() else redis_client.pipeline(transaction=False)
+        for qs, cache_key in to_write:
+            qs._cache_results(cache_key, qs._result_cache, client=pipe)
+        if pipe:
+            _execute(pipe)
+        for qs, cache_key in to_write:
+            qs._local_cache_set(cache_key, epoch)
+
+    # Fetch non-cached querysets and do any prefetching
+    for qs in querysets:
+        qs._fetch_all()
+    return [qs._result_cache for qs in querysets]
+
+
+def _from_row(model, db, fields, row):
+    instance = model.from_db(db, fields, row)
+    # Rows come from cache, not db, so these are not snapshotted
+    instance.__dict__.pop(SNAPSHOT, None)
+    return instance
+
+
+def _copy_results(results):
+    """
+    Copies results going to or coming from local cache, so that callers don't share instances,
+    these get related objects and prefetches cached on them, which are not invalidated.
+    """
+    return [_copy_instance(obj) if isinstance(obj, Model) else
+            obj.copy() if isinstance(obj, dict) else obj for obj in results]
+
+def _copy_instance(obj):
+    new = copy.copy(obj)
+    new._state = copy.copy(obj._state)
+    new.__dict__.pop('_prefetched_objects_cache', None)
+    # Related objects cached in local cache came from select_related() and are copied too,
+    # these are kept in state since Django 2.0 and in attributes before
+    fields_cache = vars(obj._state).get('fields_cache')
+    if fields_cache is not None:
+        new._state.fields_cache = {name: _copy_instance(value) if isinstance(value, Model)
+                                   else value for name, value in fields_cache.items()}
+    for attr, value in vars(obj).items():
+        if attr.startswith('_') and attr.endswith('_cache') and isinstance(value, Model):
+            new.__dict__[attr] = _copy_instance(value)
+    return new
+
+
 class QuerySetMixin(object):
     @cached_property
     def _cacheprofile(self):
@@ -135,9 +366,10 @@ class QuerySetMixin(object):
                 'you can configure it with empty ops.'
                     % (self.model._meta.app_label, self.model._meta.model_name))
 
-    def _cache_key(self):
+    def _cache_key(self, generations=True):
         """
-        Compute a cache key for this queryset
+        Compute a cache key for this queryset,
+        current generations of its tables are folded in if these are enabled
         """
         md = md5()
         md.update('%s.%s' % (self.__class__.__module__, self.__class__.__name__))
@@ -145,19 +377,28 @@ class QuerySetMixin(object):
         md.update('%s.%s' % (self.model.__module__, self.model.__name__))
         # Protect from field list changes in model
         md.update(stamp_fields(self.model))
-        # Use query SQL as part of a key
+        # Use query SQL as part of a key,
+        # a template memoized by query structure and values are enough for most queries
         try:
-            sql, params = self.query.get_compiler(self.db).as_sql()
+            template, params = sql_template(self.query, self.db)
+            md.update(smart_str(template))
+            md.update(repr(params))
+        except Unfingerprintable:
             try:
-                sql_str = sql % params
-            except UnicodeDecodeError:
-                sql_str = sql % walk(force_text, params)
-            md.update(smart_str(sql_str))
-        except EmptyResultSet:
-            pass
+                sql, params = self.query.get_compiler(self.db).as_sql()
+                try:
+                    sql_str = sql % params
+                except UnicodeDecodeError:
+                    sql_str = sql % walk(force_text, params)
+                md.update(smart_str(sql_str))
+            except EmptyResultSet:
+                pass
         # If query results differ depending on database
         if self._cacheprofile and not self._cacheprofile['db_agnostic']:
             md.update(self.db)
+        # Data serialized differently is not interchangeable
+        if self._cacheprofile and self._cacheprofile['serializer'] != 'pickle':
+            md.update(str(self._cacheprofile['serializer']))
         # Thing only appeared in Django 1.9
         it_class = getattr(self, '_iterable_class', None)
         if it_class:
@@ -166,20 +407,202 @@ class QuerySetMixin(object):
         if hasattr(self, 'flat'):
             md.update(str(self.flat))
 
-        return 'q:%s' % md.hexdigest()
+        cache_key = '%sq:%s' % (settings.CACHEOPS_NAMESPACE, md.hexdigest())
+        if generations and settings.CACHEOPS_GENERATIONS:
+            cache_key = fold_generations(cache_key, query_tables(self))
+        return cache_key
+
+    def _data_nodes(self):
+        """
+        Returns redis nodes cached data for this queryset is stored on, see cacheops.sharding.
+        """
+        return data_nodes(query_tables(self)) if is_sharded() else [redis_client]
+
+    def _read_primary(self):
+        """
+        Tells whether cached data should be read from primary, not replicas.
+        """
+        return primary_window.active() and primary_window.covers(query_tables(self))
 
-    def _cache_results(self, cache_key, results):
+    def _in_dirty_transaction(self):
+        """
+        Tells whether current transaction changed any of the tables this queryset reads,
+        subqueries included. Any change counts if these can't be told, i.e. with extra().
+        """
+        return transaction_state.is_dirty() and transaction_state.is_dirty(read_tables(self))
+
+    def _cache_results(self, cache_key, results, client=None, duration=None):
+        """
+        Writes results to cache, duration is the time it took to fetch them from db.
+        """
+        if duration is not None:
+            cache_computed.send(sender=self.model, func=None, duration=duration)
         cond_dnfs = dnfs(self)
-        cache_thing(cache_key, results, cond_dnfs, self._cacheprofile['timeout'])
+        cache_thing(cache_key, self._pack_results(results), cond_dnfs,
+                    self._cacheprofile['timeout'],
+                    client=client, serializer=self._cacheprofile['serializer'],
+                    chunk_size=self._cacheprofile['chunk_size'],
+                    grace=self._cacheprofile['grace'],
+                    delta=duration if self._cacheprofile['xfetch_beta'] else None)
+
+    def _load_results(self, cache_key, cache_data):
+        """
+        Decodes cached results, returns None if there are none or some chunks are missing.
+        """
+        if cache_data is None:
+            return None
+        serializer = self._cacheprofile['serializer']
+        header = parse_header(cache_data)
+        if header is None:
+            return self._unpack_results(loads(cache_data, serializer))
+
+        chunks = self._get_chunks(cache_key, *header)
+        if chunks is None:
+            return None
+        return self._unpack_results(mapcat(partial(loads, serializer=serializer), chunks))
+
+    def _get_chunks(self, cache_key, count, token):
+        """
+        Gets serialized chunks with a single MGET, all of them should be signed with
+        the header token, so that they come from the same results. Returns None otherwise.
+        """
+        node = self._data_nodes()[0]
+        keys = [chunk_key(cache_key, i) for i in range(count)]
+        chunks = [unsign_chunk(token, payload)
+                  for payload in mget([(node, key) for key in keys], self._read_primary())]
+        if not chunks or None in chunks:
+            return None
+        return chunks
+
+    def _row_fields(self):
+        """
+        Returns attnames to store model instances as rows of, None if these are stored as is.
+        Only plain instances are turned into rows and only for serializers other than pickle.
+        """
+        if self._cacheprofile['serializer'] == 'pickle' or ModelIterable is None \
+                or self._iterable_class is not ModelIterable:
+            return None
+        query = self.query
+        if query.select_related or query.deferred_loading[0] or query.annotation_select \
+                or query.extra_select:
+            return None
+        return [f.attname for f in self.model._meta.concrete_fields]
+
+    def _pack_results(self, results):
+        """
+        Turns model instances into rows of field values, these are compact and
+        could be handled by marshal or json. Rows with values serializer can't handle
+        are still pickled, see cacheops.serializers.dumps().
+        """
+        fields = self._row_fields()
+        if fields is None or any(obj.__class__ is not self.model for obj in results):
+            return results
+        return [[getattr(obj, attname) for attname in fields] for obj in results]
 
-    def cache(self, ops=None, timeout=None, write_only=None, lock=None):
+    def _unpack_results(self, results):
+        """
+        Rebuilds model instances from rows made by _pack_results().
+        """
+        if not results or isinstance(results[0], Model):
+            return results
+        fields = self._row_fields()
+        if fields is not None:
+            return [_from_row(self.model, self.db, fields, row) for row in results]
+        # Restore tuples after json
+        if ValuesListIterable is not None and self._iterable_class is ValuesListIterable \
+                and isinstance(results[0], list):
+            return [tuple(row) for row in results]
+        return results
+
+    def _iterate_chunks(self, cache_key, count, token):
+        """
+        Streams cached results fetching and decoding chunks one by one.
+        Falls back to db once a chunk is missing or comes from another write.
+        """
+        serializer = self._cacheprofile['serializer']
+        node, primary = self._data_nodes()[0], self._read_primary()
+        yielded = 0
+        for index in range(count):
+            cache_data = unsign_chunk(token, node.get(chunk_key(cache_key, index), primary))
+            if cache_data is None:
+                break
+            for obj in self._unpack_results(loads(cache_data, serializer)):
+                yield obj
+                yielded += 1
+        else:
+            return
+
+        # Caching results anew, skipping what was already given out
+        for obj in islice(self._iterate_to_chunks(cache_key), yielded, None):
+            yield obj
+
+    def _iterate_to_chunks(self, cache_key):
+        """
+        Streams results from db writing them to cache chunk by chunk.
+        """
+        cond_dnfs = dnfs(self)
+        timeout = self._cacheprofile['timeout']
+        serializer = self._cacheprofile['serializer']
+        chunk_size = self._cacheprofile['chunk_size']
+        grace = self._cacheprofile['grace']
+
+        chunk, count, token = [], 0, new_token()
+        for obj in self._no_monkey.iterator(self):
+            chunk.append(obj)
+            yield obj
+            if len(chunk) >= chunk_size:
+                _cache_payloads([chunk_key(cache_key, count)],
+                                [sign_chunk(token, dumps(self._pack_results(chunk), serializer))],
+                                cond_dnfs, timeout, grace, markers=False)
+                chunk, count = [], count + 1
+
+        # Header goes last, so that no one sees incomplete results
+        if not count:
+            cache_thing(cache_key, self._pack_results(chunk), cond_dnfs, timeout,
+                        serializer=serializer, grace=grace)
+        elif not chunk:
+            _cache_payloads([cache_key], [chunks_header(count, token)], cond_dnfs, timeout, grace)
+        else:
+            _cache_payloads([cache_key, chunk_key(cache_key, count)],
+                            [chunks_header(count + 1, token),
+                             sign_chunk(token, dumps(self._pack_results(chunk), serializer))],
+                            cond_dnfs, timeout, grace)
+
+    def _local_cache_get(self, cache_key):
+        """
+        Fills result cache from local memory, returns whether it succeeded.
+        """
+        if not self._cacheprofile['local_cache'] or not local_cache_enabled():
+            return False
+        try:
+            self._result_cache = _copy_results(local_cache.get(cache_key))
+        except CacheMiss:
+            return False
+        cache_read.send(sender=self.model, func=None, hit=True)
+        return True
+
+    def _local_cache_set(self, cache_key, epoch):
+        """
+        Stores result cache in local memory unless something was invalidated since epoch.
+        """
+        if self._cacheprofile['local_cache'] and local_cache_enabled():
+            # Store a tuple of copies so that no one could mutate it
+            local_cache.set(cache_key, tuple(_copy_results(self._result_cache)),
+                            self._cacheprofile['timeout'], query_tables(self), epoch)
+
+    def cache(self, ops=None, timeout=None, write_only=None, lock=None, local_cache=None,
+              chunk_size=None, grace=None, xfetch_beta=None):
         """
         Enables caching for given ops
-            ops        - a subset of {'get', 'fetch', 'count', 'exists'},
-                         ops caching to be turned on, all enabled by default
-            timeout    - override default cache timeout
-            write_only - don't try fetching from cache, still write result there
-            lock       - use lock to prevent dog-pile effect
+            ops         - a subset of {'get', 'fetch', 'count', 'exists'},
+                          ops caching to be turned on, all enabled by default
+            timeout     - override default cache timeout
+            write_only  - don't try fetching from cache, still write result there
+            lock        - use lock to prevent dog-pile effect
+            local_cache - also cache in process memory
+            chunk_size  - store results in chunks of this many rows
+            grace       - serve stale results for this many seconds while refreshing them
+            xfetch_beta - refresh results early, larger values make it more eager
 
         NOTE: you actually can disable caching by omiting corresponding ops,
               .cache(ops=[]) disables caching for this queryset.
@@ -198,6 +621,14 @@ class QuerySetMixin(object):
             self._cacheprofile['write_only'] = write_only
         if lock is not None:
             self._cacheprofile['lock'] = lock
+        if local_cache is not None:
+            self._cacheprofile['local_cache'] = local_cache
+        if chunk_size is not None:
+            self._cacheprofile['chunk_size'] = chunk_size
+        if grace is not None:
+            self._cacheprofile['grace'] = grace
+        if xfetch_beta is not None:
+            self._cacheprofile['xfetch_beta'] = xfetch_beta
 
         return self
 
@@ -264,18 +695,30 @@ class QuerySetMixin(object):
         # TODO: drop this in next major release
         # If cache is not enabled or in transaction just fall back
         if not self._cacheprofile or 'fetch' not in self._cacheprofile['ops'] \
-                or transaction_state.is_dirty() or not settings.CACHEOPS_ENABLED:
+                or self._in_dirty_transaction() or not settings.CACHEOPS_ENABLED:
             return self._no_monkey.iterator(self)
 
         cache_key = self._cache_key()
         if not self._cacheprofile['write_only'] and not self._for_write:
             # Trying get data from cache
-            cache_data = redis_client.get(cache_key)
-            cache_read.send(sender=self.model, func=None, hit=cache_data is not None)
-            if cache_data is not None:
-                return iter(pickle.loads(cache_data))
+            with metrics.labels(self.model, 'fetch'):
+                cache_data = get(cache_key, self._data_nodes(), primary=self._read_primary(),
+                                 grace=self._cacheprofile['grace'])
+                header = parse_header(cache_data) if cache_data is not None else None
+                if header is not None:
+                    # Chunks are fetched one by one as they are iterated over
+                    cache_read.send(sender=self.model, func=None, hit=True)
+                    return self._iterate_chunks(cache_key, *header)
+                else:
+                    cache_read.send(sender=self.model, func=None, hit=cache_data is not None)
+                    if cache_data is not None:
+                        return iter(self._load_results(cache_key, cache_data))
 
         # Cache miss - fetch data from overriden implementation
+        if self._cacheprofile['chunk_size']:
+            # Not keeping results to limit memory usage
+            return self._iterate_to_chunks(cache_key)
+
         def iterate():
             # NOTE: we are using self._result_cache to avoid fetching-while-fetching bug #177
             self._result_cache = []
@@ -289,26 +732,35 @@ class QuerySetMixin(object):
     def _fetch_all(self):
         # If cache is not enabled or in transaction just fall back
         if not self._cacheprofile or 'fetch' not in self._cacheprofile['ops'] \
-                or transaction_state.is_dirty() or not settings.CACHEOPS_ENABLED:
+                or self._in_dirty_transaction() or not settings.CACHEOPS_ENABLED:
             return self._no_monkey._fetch_all(self)
 
-        if self._result_cache is None:
-            cache_key = self._cache_key()
-            lock = self._cacheprofile['lock']
-
-            if self._cacheprofile['write_only'] or self._for_write:
-                # TODO: remove .nocache() when iterator() is dropped
-                self._result_cache = list(self.nocache().iterator())
-                self._cache_results(cache_key, self._result_cache)
-            else:
-                with redis_client.getting(cache_key, lock=lock) as cache_data:
-                    cache_read.send(sender=self.model, func=None, hit=cache_data is not None)
-                    if cache_data is not None:
-                        self._result_cache = pickle.loads(cache_data)
-                    else:
-                        # TODO: remove .nocache() when iterator() is dropped
-                        self._result_cache = list(self.nocache().iterator())
-                        self._cache_results(cache_key, self._result_cache)
+        with metrics.labels(self.model, 'fetch'):
+            if self._result_cache is None:
+                cache_key = self._cache_key()
+                lock = self._cacheprofile['lock']
+
+                if self._cacheprofile['write_only'] or self._for_write:
+                    # TODO: remove .nocache() when iterator() is dropped
+                    self._result_cache = list(self.nocache().iterator())
+                    self._cache_results(cache_key, self._result_cache)
+                elif not self._local_cache_get(cache_key):
+                    epoch = local_cache.epoch()
+                    nodes, primary = self._data_nodes(), self._read_primary()
+                    grace, beta = self._cacheprofile['grace'], self._cacheprofile['xfetch_beta']
+                    with getting(cache_key, nodes, lock=lock, primary=primary,
+                                 grace=grace, beta=beta) as cache_data:
+                        results = self._load_results(cache_key, cache_data)
+                        cache_read.send(sender=self.model, func=None, hit=results is not None)
+                        if results is not None:
+                            self._result_cache = results
+                        else:
+                            start = time.time()
+                            # TODO: remove .nocache() when iterator() is dropped
+                            self._result_cache = list(self.nocache().iterator())
+                            self._cache_results(cache_key, self._result_cache,
+                                                duration=time.time() - start)
+                    self._local_cache_set(cache_key, epoch)
 
         self._no_monkey._fetch_all(self)
 
@@ -318,7 +770,7 @@ class QuerySetMixin(object):
             # if queryset cache is already filled just return its len
             if self._result_cache is not None:
                 return len(self._result_cache)
-            return cached_as(self)(lambda: self._no_monkey.count(self))()
+            return self._cached_op('count', lambda: self._no_monkey.count(self))
         else:
             return self._no_monkey.count(self)
 
@@ -360,26 +812,62 @@ class QuerySetMixin(object):
         if self._cacheprofile and 'exists' in self._cacheprofile['ops']:
             if self._result_cache is not None:
                 return bool(self._result_cache)
-            return cached_as(self)(lambda: self._no_monkey.exists(self))()
+            return self._cached_op('exists', lambda: self._no_monkey.exists(self))
         else:
             return self._no_monkey.exists(self)
 
+    def _cached_op(self, op, func):
+        """
+        Caches func result same way as this queryset, used for count() and exists().
+        """
+        func._metrics_labels = self.model, op
+        return cached_as(self)(func)()
+
     def bulk_create(self, objs, batch_size=None):
         objs = self._no_monkey.bulk_create(self, objs, batch_size=batch_size)
         if family_has_profile(self.model):
-            for obj in objs:
-                invalidate_obj(obj)
+            invalidate_many(self.model, objs)
         return objs
 
+    def fetch_many(self, *lookups):
+        """
+        Fetches several filtered variants of this queryset at once, see fetch_many().
+        Each lookup is either a dict of filter kwargs, a Q-object or a queryset.
+        """
+        def _queryset(lookup):
+            if isinstance(lookup, dict):
+                return self.filter(**lookup)
+            elif isinstance(lookup, Q):
+                return self.filter(lookup)
+            else:
+                return lookup
+        return fetch_many(*map(_queryset, lookups))
+
+    def update(self, **kwargs):
+        # Loaded objects snapshots could be outdated now, see ManagerMixin._pre_save()
+        db_table = non_proxy(self.model)._meta.db_table
+        _bulk_updates[db_table] = _bulk_updates.get(db_table, 0) + 1
+        return self._no_monkey.update(self, **kwargs)
+
     def invalidated_update(self, **kwargs):
         clone = self._clone().nocache()
         clone._for_write = True  # affects routing
 
-        objects = list(clone.iterator())  # bypass queryset cache
-        rows = clone.update(**kwargs)
-        objects.extend(clone.iterator())
-        for obj in objects:
-            invalidate_obj(obj)
+        # Only fields used in invalidation schemes matter, fetch their distinct values
+        fields = scheme_fields(self.model)
+        if fields is None:
+            return clone.update(**kwargs)
+        elif fields:
+            values = clone.values_list(*[f.attname for f in fields]).order_by().distinct()
+            states = list(values.iterator())  # bypass queryset cache
+            rows = clone.update(**kwargs)
+            states.extend(values.iterator())
+        else:
+            # Only unconditional queries are cached, any updated row invalidates them
+            rows = clone.update(**kwargs)
+            states = [()] if rows else []
+
+        invalidate_dicts(self.model, [get_values_dict(fields, state) for state in states])
         return rows
 
 
@@ -392,6 +880,56 @@ def connect_first(signal, receiver, sender):
 # We need to stash old object before Model.save() to invalidate on its properties
 _old_objs = threading.local()
 
+# Values of object concrete fields as they were loaded from db, kept in its __dict__,
+# but not pickled, so never cached. Spares fetching old object before save.
+# Opt-in with snapshot profile option: a save by another process in between is not seen,
+# so querysets with that intermediate state are left for timeout to expire.
+SNAPSHOT = '_cacheops_snapshot'
+# Django 1.7 has no hook to take snapshots at
+SNAPSHOTS_SUPPORTED = hasattr(Model, 'from_db')
+
+# Counts bulk updates of tables by this process, snapshots taken before one are outdated
+_bulk_updates = {}
+
+@memoize
+def _snapshots_enabled(cls):
+    profile = model_profile(cls)
+    return bool(profile and profile['snapshot'])
+
+def _take_snapshot(instance, values):
+    db_table = non_proxy(instance.__class__)._meta.db_table
+    instance.__dict__[SNAPSHOT] = _bulk_updates.get(db_table, 0), values
+
+def _snapshot_dict(model, instance):
+    """
+    Returns old object dict from its snapshot,
+    None if there is none, it's outdated or for other pk.
+    """
+    snapshot = instance.__dict__.get(SNAPSHOT)
+    if snapshot is None:
+        return None
+    updates, values = snapshot
+    if updates != _bulk_updates.get(model._meta.db_table, 0):
+        return None
+    by_attname = dict(zip((f.attname for f in model._meta.concrete_fields), values))
+    if by_attname.get(model._meta.pk.attname) != instance.pk:
+        return None
+    fields = [f for f in serializable_fields(model) if f.attname in by_attname]
+    return get_values_dict(fields, [by_attname[f.attname] for f in fields])
+
+def _update_snapshot(instance, update_fields=None):
+    """
+    Snapshots fields values after a save, drops snapshot if those could differ from db.
+    """
+    if update_fields or instance.get_deferred_fields():
+        instance.__dict__.pop(SNAPSHOT, None)
+        return
+    values = tuple(getattr(instance, f.attname) for f in instance._meta.concrete_fields)
+    if any(isinstance(value, (F, Expression)) for value in values):
+        instance.__dict__.pop(SNAPSHOT, None)
+    else:
+        _take_snapshot(instance, values)
+
 class ManagerMixin(object):
     @once_per('cls')
     def _install_cacheops(self, cls):
@@ -416,17 +954,23 @@ class ManagerMixin(object):
 
     def _pre_save(self, sender, instance, **kwargs):
         if instance.pk is not None and not no_invalidation.active:
-            try:
-                _old_objs.__dict__[sender, instance.pk] = sender.objects.get(pk=instance.pk)
-            except sender.DoesNotExist:
-                pass
+            model = non_proxy(sender)
+            old_dict = _snapshot_dict(model, instance)
+            if old_dict is None:
+                try:
+                    old_dict = get_obj_dict(model, sender.objects.get(pk=instance.pk))
+                except sender.DoesNotExist:
+                    pass
+            _old_objs.__dict__[sender, instance.pk] = old_dict
 
-    def _post_save(self, sender, instance, **kwargs):
+    def _post_save(self, sender, instance, update_fields=None, **kwargs):
         # Invoke invalidations for both old and new versions of saved object
-        old = _old_objs.__dict__.pop((sender, instance.pk), None)
-        if old:
-            invalidate_obj(old)
+        old_dict = _old_objs.__dict__.pop((sender, instance.pk), None)
+        if old_dict:
+            invalidate_dict(non_proxy(sender), old_dict)
         invalidate_obj(instance)
+        if SNAPSHOTS_SUPPORTED and _snapshots_enabled(instance.__class__):
+            _update_snapshot(instance, update_fields)
 
         if transaction_state.is_dirty() or not settings.CACHEOPS_ENABLED:
             return
@@ -481,9 +1025,18 @@ class ManagerMixin(object):
     def nocache(self):
         return self.get_queryset().nocache()
 
+    def update(self, **kwargs):
+        # Loaded objects snapshots could be outdated now, see ManagerMixin._pre_save()
+        db_table = non_proxy(self.model)._meta.db_table
+        _bulk_updates[db_table] = _bulk_updates.get(db_table, 0) + 1
+        return self._no_monkey.update(self, **kwargs)
+
     def invalidated_update(self, **kwargs):
         return self.get_queryset().inplace().invalidated_update(**kwargs)
 
+    def fetch_many(self, *args, **kwargs):
+        return self.get_queryset().fetch_many(*args, **kwargs)
+
 
 def invalidate_m2m(sender=None, instance=None, model=None, action=None, pk_set=None, reverse=None,
                    **kwargs):
@@ -500,24 +1053,19 @@ def invalidate_m2m(sender=None, instance=None, model=None, action=None, pk_set=N
     m2m = next(m2m for m2m in instance._meta.many_to_many + model._meta.many_to_many
                    if m2m.rel.through == sender)
 
-    # TODO: optimize several invalidate_objs/dicts at once
     if action == 'pre_clear':
         # TODO: always use column names here once Django 1.3 is dropped
         instance_field = m2m.m2m_reverse_field_name() if reverse else m2m.m2m_field_name()
         objects = sender.objects.filter(**{instance_field: instance.pk})
-        for obj in objects:
-            invalidate_obj(obj)
+        invalidate_many(sender, objects)
     elif action in ('post_add', 'pre_remove'):
         instance_column, model_column = m2m.m2m_column_name(), m2m.m2m_reverse_name()
         if reverse:
             instance_column, model_column = model_column, instance_column
         # NOTE: we don't need to query through objects here,
         #       cause we already know all their meaningfull attributes.
-        for pk in pk_set:
-            invalidate_dict(sender, {
-                instance_column: instance.pk,
-                model_column: pk
-            })
+        invalidate_dicts(sender, [{instance_column: instance.pk, model_column: pk}
+                                  for pk in pk_set])
 
 
 @once
@@ -538,6 +1086,34 @@ def install_cacheops():
             cls = getattr(query, cls_name)
             monkey_mix(cls, QuerySetMixin, ['iterator'])
 
+    # Snapshot loaded objects state to not fetch it on save, see ManagerMixin._pre_save()
+    if SNAPSHOTS_SUPPORTED:
+        from_db = Model.from_db.__func__
+
+        def snapshotting_from_db(cls, db, field_names, values):
+            instance = from_db(cls, db, field_names, values)
+            if len(values) == len(cls._meta.concrete_fields) and _snapshots_enabled(cls):
+                _take_snapshot(instance, values)
+            return instance
+        Model.from_db = classmethod(snapshotting_from_db)
+
+        @monkey(Model)
+        def __reduce__(self):
+            # Snapshots could get outdated, so these don't go to cache
+            reduced = __reduce__.original(self)
+            state = reduced[2]
+            if isinstance(state, dict) and SNAPSHOT in state:
+                state = state.copy()
+                del state[SNAPSHOT]
+                reduced = reduced[:2] + (state,) + reduced[3:]
+            return reduced
+
+        @monkey(Model)
+        def refresh_from_db(self, *args, **kwargs):
+            # Could be partial, so we can't just take a new snapshot
+            self.__dict__.pop(SNAPSHOT, None)
+            return refresh_from_db.original(self, *args, **kwargs)
+
     # Use app registry to introspect used apps
     from django.apps import apps
 
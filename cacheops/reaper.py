@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Reaping of invalidation structures left behind by evicted cache keys.
+
+With CACHEOPS_LRU conj sets and table indexes of them never expire, while cache keys they refer
+to are evicted by redis. Reaper goes through them removing references to missing keys,
+emptied sets are deleted by redis. Run it with `cacheops_reap` management command
+or in a background thread by setting CACHEOPS_REAP_INTERVAL, then a redis lock makes
+only one process reap per interval.
+"""
+import time
+import threading
+
+import redis
+from funcy import chunks
+
+from .conf import settings
+from .redis import load_script
+from .sharding import all_nodes
+
+
+__all__ = ('Reaper',)
+
+
+class Reaper(object):
+    """
+    Removes references to missing keys from conj sets and then from table indexes.
+        batch - members checked per script call, also SCAN and SSCAN count hint
+        pause - seconds to sleep after each call, limits load on redis
+    """
+    def __init__(self, batch=100, pause=0.01):
+        self.batch = batch
+        self.pause = pause
+
+    def reap(self):
+        """
+        Makes a single pass over all the nodes, returns a dict of counts.
+        """
+        stats = {'sets': 0, 'checked': 0, 'removed': 0}
+        for node in all_nodes():
+            # Conj sets go first, so that indexes lose ones emptied in the same pass
+            for pattern in ('conj:*', 'conjs:*'):
+                match = settings.CACHEOPS_NAMESPACE + pattern
+                for set_key in node.scan_iter(match=match, count=self.batch):
+                    stats['sets'] += 1
+                    self.reap_set(node, set_key, stats)
+        return stats
+
+    def reap_set(self, node, set_key, stats):
+        members = node.sscan_iter(set_key, count=self.batch)
+        for batch in chunks(self.batch, members):
+            stats['checked'] += len(batch)
+            stats['removed'] += load_script('reap')(keys=[set_key], args=batch, client=node)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def acquire(self, interval):
+        """
+        Tells whether this process should reap now, no other one does for the interval.
+        """
+        key = settings.CACHEOPS_NAMESPACE + 'reaper:lock'
+        return bool(all_nodes()[0].set(key, 1, nx=True, ex=max(1, int(interval))))
+
+    def run(self, interval):
+        """
+        Reaps every interval seconds, forever. With several processes running
+        only one of them reaps each interval.
+        """
+        while True:
+            try:
+                if self.acquire(interval):
+                    self.reap()
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+            time.sleep(interval)
+
+    def start(self, interval):
+        thread = threading.Thread(target=self.run, args=(interval,), name='cacheops-reaper')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,4 +1,7 @@
 from __future__ import absolute_import
+import random
+import threading
+import time
 import warnings
 from contextlib import contextmanager
 import six
@@ -7,6 +10,7 @@ from funcy import decorator, identity, memoize
 import redis
 
 from .conf import settings
+from .metrics import metrics
 
 
 if settings.CACHEOPS_DEGRADE_ON_FAILURE:
@@ -26,12 +30,42 @@ LOCK_TIMEOUT = 60
 
 
 class CacheopsRedis(redis.StrictRedis):
-    get = handle_connection_failure(redis.StrictRedis.get)
+    # Read-only replicas, see make_client()
+    replicas = ()
+
+    def reader(self, primary=False):
+        """
+        Returns a client to read cached data from: a random replica if there are any.
+        """
+        if primary or not self.replicas:
+            return self
+        return random.choice(self.replicas)
+
+    def read(self, func, primary=False):
+        """
+        Calls func with a client to read from, falls back to primary on replica failure.
+        """
+        reader = self.reader(primary)
+        try:
+            return func(reader)
+        except (redis.ConnectionError, redis.TimeoutError):
+            # A replica being down or slow shouldn't make cache unavailable
+            if reader is self:
+                raise
+            return func(self)
+
+    @handle_connection_failure
+    def get(self, key, primary=False):
+        start = time.time()
+        try:
+            return self.read(lambda client: redis.StrictRedis.get(client, key), primary)
+        finally:
+            metrics.observe('redis_seconds', time.time() - start)
 
     @contextmanager
-    def getting(self, key, lock=False):
+    def getting(self, key, lock=False, primary=False):
         if not lock:
-            yield self.get(key)
+            yield self.get(key, primary=primary)
         else:
             locked = False
             try:
@@ -44,17 +78,12 @@ class CacheopsRedis(redis.StrictRedis):
 
     @handle_connection_failure
     def _get_or_lock(self, key):
-        self._lock = getattr(self, '_lock', self.register_script("""
-            local locked = redis.call('set', KEYS[1], 'LOCK', 'nx', 'ex', ARGV[1])
-            if locked then
-                redis.call('del', KEYS[2])
-            end
-            return locked
-        """))
+        self._lock = getattr(self, '_lock', self.register_script(script_code('lock')))
         signal_key = key + ':signal'
 
         while True:
-            data = self.get(key)
+            # Lock state should be seen as is, so no replicas here
+            data = self.get(key, primary=True)
             if data is None:
                 if self._lock(keys=[key, signal_key], args=[LOCK_TIMEOUT]):
                     return None
@@ -62,28 +91,72 @@ class CacheopsRedis(redis.StrictRedis):
                 return data
 
             # No data and not locked, wait
+            start = time.time()
             self.brpoplpush(signal_key, signal_key, timeout=LOCK_TIMEOUT)
+            metrics.observe('lock_wait_seconds', time.time() - start)
 
     @handle_connection_failure
     def _release_lock(self, key):
-        self._unlock = getattr(self, '_unlock', self.register_script("""
-            if redis.call('get', KEYS[1]) == 'LOCK' then
-                redis.call('del', KEYS[1])
-            end
-            redis.call('lpush', KEYS[2], 1)
-            redis.call('expire', KEYS[2], 1)
-        """))
+        self._unlock = getattr(self, '_unlock', self.register_script(script_code('unlock')))
         signal_key = key + ':signal'
         self._unlock(keys=[key, signal_key])
 
 
+def make_client(conf, client_class=CacheopsRedis):
+    # Allow client connection settings to be specified by a URL.
+    if isinstance(conf, six.string_types):
+        return client_class.from_url(conf)
+    conf = conf.copy()
+    replicas = conf.pop('replicas', ())
+    client = client_class(**conf)
+    if replicas:
+        client.replicas = [make_client(replica, redis.StrictRedis) for replica in replicas]
+    return client
+
+
+class PrimaryWindow(object):
+    """
+    Tracks tables recently invalidated by this process, so that their caches are read
+    from primary while replicas could lag behind. See 'primary_window' profile option.
+    """
+    def __init__(self):
+        self._until = {}
+        self._mutex = threading.Lock()
+
+    def mark(self, db_table, seconds):
+        """
+        Marks a table, or all of them if it's None, as just invalidated.
+        """
+        if seconds:
+            with self._mutex:
+                self._until[db_table] = max(self._until.get(db_table, 0), time.time() + seconds)
+
+    def active(self):
+        if not self._until:
+            return False
+        with self._mutex:
+            now = time.time()
+            for db_table in [t for t, until in self._until.items() if until < now]:
+                del self._until[db_table]
+            return bool(self._until)
+
+    def covers(self, db_tables):
+        if not self.active():
+            return False
+        until = self._until.copy()
+        now = time.time()
+        return until.get(None, 0) > now or any(until.get(t, 0) > now for t in db_tables)
+
+primary_window = PrimaryWindow()
+
+
 class LazyRedis(object):
     def _setup(self):
-        # Allow client connection settings to be specified by a URL.
-        if isinstance(settings.CACHEOPS_REDIS, six.string_types):
-            client = CacheopsRedis.from_url(settings.CACHEOPS_REDIS)
-        else:
-            client = CacheopsRedis(**settings.CACHEOPS_REDIS)
+        conf = settings.CACHEOPS_REDIS
+        # The first node is the default one when sharding, see cacheops.sharding
+        if isinstance(conf, (list, tuple)):
+            conf = conf[0]
+        client = make_client(conf)
 
         object.__setattr__(self, '__class__', client.__class__)
         object.__setattr__(self, '__dict__', client.__dict__)
@@ -107,10 +180,14 @@ import os.path
 STRIP_RE = re.compile(r'TOSTRIP.*/TOSTRIP', re.S)
 
 @memoize
-def load_script(name, strip=False):
+def script_code(name, strip=False):
     filename = os.path.join(os.path.dirname(__file__), 'lua/%s.lua' % name)
     with open(filename) as f:
         code = f.read()
     if strip:
         code = STRIP_RE.sub('', code)
-    return redis_client.register_script(code)
+    return code
+
+@memoize
+def load_script(name, strip=False):
+    return redis_client.register_script(script_code(name, strip))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Refresh-ahead of registered hot querysets and cached_as() functions.
+
+A worker, run with `refresh_ahead` management command, recomputes them in background
+right after they are invalidated or when they are about to expire,
+so that no request has to wait for a cache miss.
+"""
+import time
+import threading
+
+import redis
+from six.moves import queue
+from django.db import close_old_connections
+from django.db.models.query import QuerySet
+
+from .local import InvalidationListener, publish_invalidations
+from .sharding import all_nodes
+from .signals import cache_refreshed
+
+
+__all__ = ('refresh_ahead', 'RefreshWorker')
+
+
+registry = []
+
+
+def refresh_ahead(qs_or_func, *args, **kwargs):
+    """
+    Registers a queryset or a cached_as() decorated function with given arguments
+    to be refreshed by a worker. Do this on startup of all processes, e.g. in AppConfig.ready(),
+    so that they publish invalidations for the worker to see.
+    """
+    if isinstance(qs_or_func, QuerySet):
+        entry = QuerySetEntry(qs_or_func)
+    elif hasattr(qs_or_func, 'refresh'):
+        entry = FuncEntry(qs_or_func, args, kwargs)
+    else:
+        raise TypeError('Pass a queryset or a function decorated with @cached_as()')
+    publish_invalidations()
+    registry.append(entry)
+    return entry
+
+
+class QuerySetEntry(object):
+    def __init__(self, qs):
+        qs._require_cacheprofile()
+        self.qs = qs
+        self.grace = qs._cacheprofile['grace']
+
+    def key(self):
+        return self.qs._cache_key()
+
+    def node(self):
+        return self.qs._data_nodes()[0]
+
+    def refresh(self):
+        list(self.qs._clone().cache(write_only=True))
+
+class FuncEntry(object):
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.grace = func._cache_grace
+
+    def key(self):
+        return self.func.cache_key(*self.args, **self.kwargs)
+
+    def node(self):
+        return self.func._cache_nodes[0]
+
+    def refresh(self):
+        self.func.refresh(*self.args, **self.kwargs)
+
+
+class RefreshWorker(object):
+    """
+    Refreshes registered caches with a pool of threads.
+        workers  - a number of refreshing threads, i.e. max concurrent db queries
+        interval - how often to check registered caches ttls, in seconds
+        ahead    - refresh caches this many seconds before they expire
+
+    Sends cache_refreshed signal after each refresh and keeps counters in .stats.
+    """
+    def __init__(self, workers=4, interval=1, ahead=10):
+        self.workers = workers
+        self.interval = interval
+        self.ahead = ahead
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.mutex = threading.Lock()
+        self.stats = {'invalidated': 0, 'expiring': 0, 'failed': 0}
+
+    def run(self):
+        for _ in range(self.workers):
+            self._start(self.work, 'cacheops-refresh-worker')
+        for node in all_nodes():
+            InvalidationListener(self, node).start()
+        while True:
+            try:
+                self.check()
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+            time.sleep(self.interval)
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+
+    def check(self):
+        """
+        Schedules refresh of caches missing or about to expire.
+        """
+        for entry in registry:
+            pttl = entry.node().pttl(entry.key())
+            # -2 is for a missing key, -1 for one not expiring
+            if pttl == -2 or 0 <= pttl < (self.ahead + (entry.grace or 0)) * 1000:
+                self.schedule(entry, 'expiring')
+
+    def schedule(self, entry, reason):
+        with self.mutex:
+            if entry in self.pending:
+                return
+            self.pending.add(entry)
+        self.queue.put((entry, reason))
+
+    def work(self):
+        while True:
+            self.refresh(*self.queue.get())
+            # Each thread has its own db connection, don't let it go stale
+            close_old_connections()
+
+    def refresh(self, entry, reason):
+        with self.mutex:
+            self.pending.discard(entry)
+        start = time.time()
+        try:
+            entry.refresh()
+            error = None
+        except Exception as e:
+            error = e
+        with self.mutex:
+            self.stats['failed' if error else reason] += 1
+        cache_refreshed.send(sender=None, entry=entry, reason=reason,
+                             duration=time.time() - start, error=error)
+
+    # Invalidation listener interface, same as local cache one
+
+    def clear(self):
+        for entry in registry:
+            self.schedule(entry, 'invalidated')
+
+    def delete_many(self, keys):
+        keys = set(keys)
+        for entry in registry:
+            if entry.key() in keys:
+                self.schedule(entry, 'invalidated')
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import marshal
+
+import six
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .cross import pickle
+from .compression import compress, decompress
+from .metrics import metrics
+
+
+__all__ = ('register_serializer', 'get_serializer', 'dumps', 'loads')
+
+
+class PickleSerializer(object):
+    """
+    Handles anything picklable, including model instances. The default one.
+    """
+    @staticmethod
+    def dumps(data):
+        return pickle.dumps(data, -1)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """
+    Compact and fast, but handles only builtin types,
+    e.g. .values_list() rows or model instances rows of numbers and strings.
+    """
+    @staticmethod
+    def dumps(data):
+        return marshal.dumps(data)
+
+    @staticmethod
+    def loads(data):
+        return marshal.loads(data)
+
+
+class JSONSerializer(object):
+    """
+    For .values() and plain data results.
+    NOTE: tuples are loaded as lists, except for .values_list() rows, which are restored.
+    """
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'marshal': MarshalSerializer,
+    'json': JSONSerializer,
+}
+
+def register_serializer(name, serializer):
+    """
+    Registers an object with .dumps(data) -> bytes and .loads(bytes) -> data methods
+    to be used in CACHEOPS_SERIALIZER setting or "serializer" profile option.
+    NOTE: serialized data should not start with header bytes \x01, \x02, \x03 or \x04,
+          used for compression, chunks and pickled data.
+    """
+    SERIALIZERS[name] = serializer
+
+def get_serializer(name):
+    """
+    Returns a serializer by its registered name or a dotted import path.
+    """
+    if not isinstance(name, six.string_types):
+        return name
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        pass
+    try:
+        SERIALIZERS[name] = import_string(name)
+    except ImportError:
+        raise ImproperlyConfigured('Unknown cacheops serializer "%s"' % name)
+    return SERIALIZERS[name]
+
+
+# Doesn't clash with compression and chunks headers
+PICKLED = b'\x04'
+
+
+def dumps(data, serializer):
+    """
+    Serializes data and compresses it if it's large enough.
+    Data serializer can't handle, i.e. dates or model instances for marshal, is pickled instead.
+    """
+    start = time.time()
+    serializer = get_serializer(serializer)
+    try:
+        payload = serializer.dumps(data)
+    except (TypeError, ValueError):
+        if serializer is PickleSerializer:
+            raise
+        payload = PICKLED + PickleSerializer.dumps(data)
+    result = compress(payload)
+    metrics.observe('serialize_seconds', time.time() - start)
+    metrics.observe('payload_bytes', len(result))
+    return result
+
+def loads(data, serializer):
+    start = time.time()
+    data = decompress(data)
+    if data[:1] == PICKLED:
+        result = PickleSerializer.loads(data[1:])
+    else:
+        result = get_serializer(serializer).loads(data)
+    metrics.observe('deserialize_seconds', time.time() - start)
+    return result
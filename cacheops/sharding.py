@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side sharding of cacheops between several redis nodes,
+enabled by passing a list of connection settings as CACHEOPS_REDIS.
+
+Each table is owned by a node chosen by consistent hashing, which keeps all table invalidators,
+schemes and generation. Cached data goes to the first node owning any of the tables it depends
+on, the other such nodes keep markers under the same key registered in their invalidators.
+So invalidation is done by a script on a single node, and a cache hit needs data and all
+the markers in place.
+"""
+import math
+import time
+import random
+from bisect import bisect
+from contextlib import contextmanager
+
+import six
+
+from .conf import settings
+from .cross import md5hex
+from .redis import redis_client, make_client, handle_connection_failure, LOCK_TIMEOUT
+from .metrics import metrics
+
+
+__all__ = ('is_sharded', 'node_for', 'all_nodes', 'data_nodes', 'split_dnfs',
+           'getting', 'get', 'get_meta', 'needs_refresh', 'markers_exist', 'mget')
+
+
+# Stored on secondary nodes of data
+MARKER = b''
+
+
+class HashRing(object):
+    """
+    Consistent hashing of tables to nodes, adding or removing a node moves only its share.
+    """
+    POINTS = 160
+
+    def __init__(self, confs):
+        self.confs = confs
+        self.nodes = [make_client(conf) for conf in confs]
+        points = sorted((_hash('%s-%d' % (_node_name(conf), i)), n)
+                        for n, conf in enumerate(confs) for i in range(self.POINTS))
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+        self._cache = {}
+
+    def get(self, db_table):
+        try:
+            return self._cache[db_table]
+        except KeyError:
+            i = bisect(self._hashes, _hash(db_table)) % len(self._hashes)
+            node = self._cache[db_table] = self.nodes[self._owners[i]]
+            return node
+
+def _hash(s):
+    return int(md5hex(s)[:8], 16)
+
+def _node_name(conf):
+    if isinstance(conf, six.string_types):
+        return conf
+    return ','.join('%s=%s' % item for item in sorted(conf.items()))
+
+
+_ring = None
+
+def get_ring():
+    global _ring
+    confs = settings.CACHEOPS_REDIS
+    if _ring is None or _ring.confs is not confs:
+        _ring = HashRing(confs)
+    return _ring
+
+
+def is_sharded():
+    return isinstance(settings.CACHEOPS_REDIS, (list, tuple))
+
+def node_for(db_table):
+    """
+    Returns a client for the node owning a table.
+    """
+    return get_ring().get(db_table) if is_sharded() else redis_client
+
+def all_nodes():
+    return get_ring().nodes if is_sharded() else [redis_client]
+
+def data_nodes(db_tables):
+    """
+    Returns clients for nodes to store data depending on given tables,
+    the one to keep data itself goes first and the rest keep markers.
+    """
+    if not is_sharded():
+        return [redis_client]
+    ring = get_ring()
+    nodes = []
+    for db_table in sorted(db_tables):
+        node = ring.get(db_table)
+        if not any(node is n for n in nodes):
+            nodes.append(node)
+    return nodes or ring.nodes[:1]
+
+def split_dnfs(cond_dnfs):
+    """
+    Groups conditions by nodes owning their tables as [(node, dnfs)], data node goes first.
+    """
+    if not is_sharded():
+        return [(redis_client, cond_dnfs)]
+    groups = [(node, []) for node in data_nodes(db_table for db_table, _ in cond_dnfs)]
+    for db_table, disj in cond_dnfs:
+        owner = node_for(db_table)
+        next(group for node, group in groups if node is owner).append((db_table, disj))
+    return groups
+
+
+@contextmanager
+def getting(cache_key, nodes, lock=False, primary=False, grace=None, beta=None):
+    """
+    Same as redis_client.getting(), but for data on given nodes.
+
+    Data written with a grace period stays readable for it after expiring or being invalidated.
+    Such stale data is returned to all callers but one, which gets None and is expected
+    to refresh the cache, others don't wait for it.
+
+    With beta, data written along with its compute time is also refreshed early,
+    with a probability growing as it nears expiration, see needs_refresh().
+    """
+    if grace or beta:
+        cache_data, ttl, delta = get_meta(cache_key, nodes, primary) or (None, None, None)
+        if cache_data is not None:
+            if not needs_refresh(ttl, delta, grace, beta) \
+                    or not _start_refresh(cache_key, nodes[0]):
+                yield cache_data
+            else:
+                try:
+                    yield None
+                finally:
+                    _end_refresh(cache_key, nodes[0])
+            return
+
+    with nodes[0].getting(cache_key, lock=lock, primary=primary) as cache_data:
+        if cache_data is not None and not markers_exist(cache_key, nodes, primary):
+            cache_data = None
+        yield cache_data
+
+def get(cache_key, nodes, primary=False, grace=None, beta=None):
+    with getting(cache_key, nodes, primary=primary, grace=grace, beta=beta) as cache_data:
+        return cache_data
+
+def delta_key(cache_key):
+    """
+    Key to keep time it took to compute data at, see cache_thing.lua.
+    """
+    return cache_key + ':delta'
+
+@handle_connection_failure
+def get_meta(cache_key, nodes, primary=False):
+    """
+    Gets data as (data, ttl, delta) triple, None on a miss.
+    ttl is the least of data and markers ones in seconds, None if they don't expire,
+    delta is the time it took to compute data, None if it wasn't stored.
+    """
+    start = time.time()
+    cache_data, pttl, delta = nodes[0].read(
+        lambda client: client.pipeline(transaction=False).get(cache_key).pttl(cache_key)
+                             .get(delta_key(cache_key)).execute(),
+        primary)
+    metrics.observe('redis_seconds', time.time() - start)
+    if cache_data is None or cache_data == b'LOCK':
+        return None
+    pttls = [pttl] + [node.read(lambda client: client.pttl(cache_key), primary)
+                      for node in nodes[1:]]
+    return meta_triple(cache_data, pttls, delta)
+
+def meta_triple(cache_data, pttls, delta):
+    # Missing marker means its node was flushed
+    if -2 in pttls:
+        return None
+    pttls = [t for t in pttls if t != -1]
+    ttl = min(pttls) / 1000.0 if pttls else None
+    return cache_data, ttl, float(delta) if delta else None
+
+def needs_refresh(ttl, delta, grace=None, beta=None):
+    """
+    Tells whether data read with get_meta() should be refreshed.
+
+    Data is stale once its ttl is down to grace, invalidation also marks it stale this way.
+    Fresh data is refreshed early by XFetch algorithm: the longer it takes to compute
+    and the closer it's to expiration the more likely. Larger beta makes it more eager.
+    """
+    if ttl is None:
+        return False
+    left = ttl - (grace or 0)
+    if left <= 0:
+        return True
+    return bool(beta and delta) and -delta * beta * math.log(1 - random.random()) >= left
+
+@handle_connection_failure
+def _start_refresh(cache_key, node):
+    return node.set(cache_key + ':refresh', 1, nx=True, ex=LOCK_TIMEOUT)
+
+@handle_connection_failure
+def _end_refresh(cache_key, node):
+    node.delete(cache_key + ':refresh')
+
+def markers_exist(cache_key, nodes, primary=False):
+    """
+    Checks that markers of data on given nodes are in place.
+    """
+    return len(nodes) == 1 or bool(_exist(cache_key, nodes[1:], primary))
+
+@handle_connection_failure
+def _exist(cache_key, nodes, primary):
+    return all(node.read(lambda client: client.exists(cache_key), primary) for node in nodes)
+
+
+@handle_connection_failure
+def mget(node_keys, primary=False):
+    """
+    Gets values for a list of (node, key) pairs with a single MGET per node.
+    Values are read from replicas unless primary is set.
+    """
+    start = time.time()
+    results = [None] * len(node_keys)
+    for node, indexes in group_by_node(node_keys):
+        keys = [node_keys[i][1] for i in indexes]
+        values = node.read(lambda client: client.mget(keys), primary)
+        for i, value in zip(indexes, values):
+            results[i] = value
+    metrics.observe('redis_seconds', time.time() - start)
+    return results
+
+def group_by_node(node_keys):
+    """
+    Groups indexes of (node, key) pairs by node as [(node, indexes)].
+    """
+    groups = []
+    for i, (node, _) in enumerate(node_keys):
+        group = next((group for n, group in groups if n is node), None)
+        if group is None:
+            group = []
+            groups.append((node, group))
+        group.append(i)
+    return groups
@@ -1,3 +1,9 @@
 import django.dispatch
 
 cache_read = django.dispatch.Signal(providing_args=["func", "hit"])
+cache_compressed = django.dispatch.Signal(
+    providing_args=["method", "size", "compressed_size", "duration"])
+cache_computed = django.dispatch.Signal(providing_args=["func", "duration"])
+cache_refreshed = django.dispatch.Signal(
+    providing_args=["entry", "reason", "duration", "error"])
+cache_warmed_up = django.dispatch.Signal(providing_args=["duration", "models_duration"])
@@ -5,8 +5,9 @@ from .cross import pickle, md5hex
 from funcy import wraps
 
 from .conf import settings
-from .utils import func_cache_key, cached_view_fab
+from .utils import func_cache_key, cached_view_fab, iscoroutinefunction
 from .redis import redis_client, handle_connection_failure
+from .serializers import get_serializer, dumps, loads
 
 
 __all__ = ('cache', 'cached', 'cached_view', 'file_cache', 'CacheMiss', 'FileCache', 'RedisCache')
@@ -36,6 +37,16 @@ class BaseCache(object):
     """
     Simple cache with time-based invalidation
     """
+    @property
+    def serializer(self):
+        return get_serializer(self._serializer or settings.CACHEOPS_SERIALIZER)
+
+    def _dumps(self, data):
+        return dumps(data, self.serializer)
+
+    def _loads(self, data):
+        return loads(data, self.serializer)
+
     def cached(self, timeout=None, extra=None, key_func=func_cache_key):
         """
         A decorator for caching function calls
@@ -45,27 +56,34 @@ class BaseCache(object):
             return self.cached(key_func=key_func)(timeout)
 
         def decorator(func):
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                if not settings.CACHEOPS_ENABLED:
-                    return func(*args, **kwargs)
-
-                cache_key = 'c:' + key_func(func, args, kwargs, extra)
-                try:
-                    result = self.get(cache_key)
-                except CacheMiss:
-                    result = func(*args, **kwargs)
-                    self.set(cache_key, result, timeout)
-
-                return result
+            def make_key(args, kwargs):
+                return settings.CACHEOPS_NAMESPACE + 'c:' + key_func(func, args, kwargs, extra)
+
+            if iscoroutinefunction(func):
+                from .aio import cached_coroutine  # aio depends on this module
+                wrapper = cached_coroutine(self, func, make_key, timeout)
+            else:
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not settings.CACHEOPS_ENABLED:
+                        return func(*args, **kwargs)
+
+                    cache_key = make_key(args, kwargs)
+                    try:
+                        result = self.get(cache_key)
+                    except CacheMiss:
+                        result = func(*args, **kwargs)
+                        self.set(cache_key, result, timeout)
+
+                    return result
 
             def invalidate(*args, **kwargs):
-                cache_key = 'c:' + key_func(func, args, kwargs, extra)
+                cache_key = make_key(args, kwargs)
                 self.delete(cache_key)
             wrapper.invalidate = invalidate
 
             def key(*args, **kwargs):
-                cache_key = 'c:' + key_func(func, args, kwargs, extra)
+                cache_key = make_key(args, kwargs)
                 return CacheKey.make(cache_key, cache=self, timeout=timeout)
             wrapper.key = key
 
@@ -79,22 +97,23 @@ class BaseCache(object):
 
 
 class RedisCache(BaseCache):
-    def __init__(self, conn):
+    def __init__(self, conn, serializer=None):
         self.conn = conn
+        self._serializer = serializer
 
     def get(self, cache_key):
         data = self.conn.get(cache_key)
         if data is None:
             raise CacheMiss
-        return pickle.loads(data)
+        return self._loads(data)
 
     @handle_connection_failure
     def set(self, cache_key, data, timeout=None):
-        pickled_data = pickle.dumps(data, -1)
+        serialized_data = self._dumps(data)
         if timeout is not None:
-            self.conn.setex(cache_key, timeout, pickled_data)
+            self.conn.setex(cache_key, timeout, serialized_data)
         else:
-            self.conn.set(cache_key, pickled_data)
+            self.conn.set(cache_key, serialized_data)
 
     @handle_connection_failure
     def delete(self, cache_key):
@@ -111,9 +130,10 @@ class FileCache(BaseCache):
     Uses mtimes in the future to designate expire time. This makes unnecessary
     reading stale files.
     """
-    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT):
+    def __init__(self, path, timeout=settings.FILE_CACHE_TIMEOUT, serializer=None):
         self._dir = path
         self._default_timeout = timeout
+        self._serializer = serializer
 
     def _key_to_filename(self, key):
         """
@@ -131,8 +151,8 @@ class FileCache(BaseCache):
                 raise CacheMiss
 
             with open(filename, 'rb') as f:
-                return pickle.load(f)
-        except (IOError, OSError, EOFError, pickle.PickleError):
+                return self._loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
             raise CacheMiss
 
     def set(self, key, data, timeout=None):
@@ -149,7 +169,7 @@ class FileCache(BaseCache):
             # Use open with exclusive rights to prevent data corruption
             f = os.open(filename, os.O_EXCL | os.O_WRONLY | os.O_CREAT)
             try:
-                os.write(f, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+                os.write(f, self._dumps(data))
             finally:
                 os.close(f)
 
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import re
 import six
 import threading
+from collections import OrderedDict
 
 from funcy import wraps, once
 from django.db.backends.utils import CursorWrapper
@@ -9,8 +11,8 @@ from django.db.transaction import get_connection, Atomic
 from .utils import monkey_mix
 
 
-__all__ = ('queue_when_in_transaction', 'install_cacheops_transaction_support',
-           'transaction_state')
+__all__ = ('queue_when_in_transaction', 'batch_when_in_transaction',
+           'install_cacheops_transaction_support', 'transaction_state')
 
 
 class TransactionState(threading.local):
@@ -19,18 +21,23 @@ class TransactionState(threading.local):
         self._stack = []
 
     def begin(self):
-        self._stack.append({'cbs': [], 'dirty': False})
+        self._stack.append({'cbs': [], 'batches': OrderedDict(), 'dirty': set()})
 
     def commit(self):
         context = self._stack.pop()
         if self._stack:
             # savepoint
             self._stack[-1]['cbs'].extend(context['cbs'])
-            self._stack[-1]['dirty'] = self._stack[-1]['dirty'] or context['dirty']
+            for func, batches in context['batches'].items():
+                for key, items in batches.items():
+                    self.append_batched(func, key, items)
+            self._stack[-1]['dirty'].update(context['dirty'])
         else:
             # transaction
             for func, args, kwargs in context['cbs']:
                 func(*args, **kwargs)
+            for func, batches in context['batches'].items():
+                func(batches)
 
     def rollback(self):
         self._stack.pop()
@@ -38,14 +45,30 @@ class TransactionState(threading.local):
     def append(self, item):
         self._stack[-1]['cbs'].append(item)
 
+    def append_batched(self, func, key, items):
+        batches = self._stack[-1]['batches'].setdefault(func, OrderedDict())
+        batches.setdefault(key, []).extend(items)
+
     def in_transaction(self):
         return bool(self._stack)
 
-    def mark_dirty(self):
-        self._stack[-1]['dirty'] = True
-
-    def is_dirty(self):
-        return any(context['dirty'] for context in self._stack)
+    def mark_dirty(self, db_tables=None):
+        """
+        Marks given tables as changed in current transaction, all of them if None.
+        """
+        # None stands for all tables
+        self._stack[-1]['dirty'].update([None] if db_tables is None else db_tables)
+
+    def is_dirty(self, db_tables=None):
+        """
+        Tells whether transaction has changes to any of given tables, to any table if None.
+        """
+        if not any(context['dirty'] for context in self._stack):
+            return False
+        if db_tables is None:
+            return True
+        dirty = set().union(*(context['dirty'] for context in self._stack))
+        return None in dirty or any(db_table.lower() in dirty for db_table in db_tables)
 
 transaction_state = TransactionState()
 
@@ -60,6 +83,21 @@ def queue_when_in_transaction(func):
     return wrapper
 
 
+def batch_when_in_transaction(func):
+    """
+    Turns func(batches), taking a dict of key -> items, into a function of (key, items).
+    In a transaction items are collected per key till commit, including ones from savepoints,
+    and then passed to func with a single call.
+    """
+    @wraps(func)
+    def wrapper(key, items):
+        if transaction_state.in_transaction():
+            transaction_state.append_batched(func, key, items)
+        else:
+            func({key: list(items)})
+    return wrapper
+
+
 class AtomicMixIn(object):
     def __enter__(self):
         transaction_state.begin()
@@ -85,23 +123,49 @@ class CursorWrapperMixin(object):
     def execute(self, sql, params=None):
         result = self._no_monkey.execute(self, sql, params)
         if transaction_state.in_transaction() and is_sql_dirty(sql):
-            transaction_state.mark_dirty()
+            transaction_state.mark_dirty(sql_dirty_tables(sql))
         return result
 
     def executemany(self, sql, param_list):
         result = self._no_monkey.executemany(self, sql, param_list)
         if transaction_state.in_transaction() and is_sql_dirty(sql):
-            transaction_state.mark_dirty()
+            transaction_state.mark_dirty(sql_dirty_tables(sql))
         return result
 
 
+# Statements Django reads with or manages transactions, these never write anything
+READ_SQL_RE = re.compile(r'\s*(?:select|savepoint|release|rollback)\b', re.I)
+DIRTY_SQL_RE = re.compile(r'\b(?:insert|update|delete|replace|merge)\b', re.I)
+
 def is_sql_dirty(sql):
     # This should not happen as using bytes in Python 3 is against db protocol,
     # but some people will pass it anyway
     if six.PY3 and isinstance(sql, six.binary_type):
         sql = sql.decode()
-    sql = sql.lower()
-    return 'update' in sql or 'insert' in sql or 'delete' in sql
+    if READ_SQL_RE.match(sql) and not _several_statements(sql):
+        return False
+    # Whole words only, not to take columns like updated_at or is_deleted for writes
+    return bool(DIRTY_SQL_RE.search(sql))
+
+
+# A single statement writing a table as Django makes them, name is in one of 4 groups
+WRITE_SQL_RE = re.compile(r'\s*(?:insert\s+into|update|delete\s+from)\s+'
+                          r'(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|(\w+))(\S?)', re.I)
+
+def sql_dirty_tables(sql):
+    """
+    Returns lowercased names of tables dirty sql writes to, None if can't tell.
+    """
+    if six.PY3 and isinstance(sql, six.binary_type):
+        sql = sql.decode()
+    match = WRITE_SQL_RE.match(sql)
+    # Schema qualified names and several statements are not parsed
+    if not match or match.group(5) == '.' or _several_statements(sql):
+        return None
+    return [next(name for name in match.groups()[:4] if name).lower()]
+
+def _several_statements(sql):
+    return ';' in sql.strip().rstrip(';')
 
 
 @once
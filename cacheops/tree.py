@@ -26,6 +26,11 @@ try:
 except ImportError:
     class Join(object):
         pass
+try:
+    from django.db.models.expressions import RawSQL
+except ImportError:
+    class RawSQL(object):
+        pass
 
 from .utils import NOT_SERIALIZED_FIELDS
 
@@ -121,19 +126,100 @@ def dnfs(qs):
         # To keep all schemes the same we sort conjunctions
         return map(sorted, cleaned)
 
-    def table_for(alias):
-        if alias == main_alias:
-            return model._meta.db_table
-        # Django 1.7 and earlier used tuples to encode joins
-        join = qs.query.alias_map[alias]
-        return join.table_name if isinstance(join, Join) else join[0]
+    dnf = _dnf(qs.query.where)
+    return [(_table_for(qs, alias), clean_dnf(dnf, alias)) for alias in _aliases(qs)]
 
-    where = qs.query.where
-    model = qs.model
-    main_alias = model._meta.db_table
 
-    dnf = _dnf(where)
+def query_tables(qs):
+    """
+    Returns tables queryset depends on, same ones dnfs() are calculated for.
+    """
+    return {_table_for(qs, alias) for alias in _aliases(qs)}
+
+def _aliases(qs):
+    main_alias = qs.model._meta.db_table
     # NOTE: we exclude content_type as it never changes and will hold dead invalidation info
-    aliases = {alias for alias, cnt in qs.query.alias_refcount.items() if cnt} \
-            | {main_alias} - {'django_content_type'}
-    return [(table_for(alias), clean_dnf(dnf, alias)) for alias in aliases]
+    return {alias for alias, cnt in qs.query.alias_refcount.items() if cnt} \
+        | {main_alias} - {'django_content_type'}
+
+def _table_for(qs, alias):
+    if alias == qs.model._meta.db_table:
+        return alias
+    # Django 1.7 and earlier used tuples to encode joins
+    join = qs.query.alias_map[alias]
+    return join.table_name if isinstance(join, Join) else join[0]
+
+
+def read_tables(qs):
+    """
+    Returns all tables queryset reads, including ones of subqueries and select_related(),
+    None if it can't tell, i.e. with extra() or raw SQL.
+    Unlike query_tables() these are not for invalidation, but to check transaction changes.
+    """
+    return _query_read_tables(qs.query)
+
+def _query_read_tables(query):
+    if query.extra or query.extra_tables:
+        return None
+    model = query.model
+    tables = {model._meta.db_table}
+    for join in query.alias_map.values():
+        # Django 1.7 and earlier used tuples to encode joins
+        tables.add(getattr(join, 'table_name', None) or join[0])
+    if query.select_related:
+        related = _related_tables(model, query.select_related)
+        if related is None:
+            return None
+        tables |= related
+    nodes = [query.where] + list(query.annotations.values()) \
+        + list(getattr(query, 'combined_queries', ()))
+    for node in nodes:
+        node_tables = _node_tables(node)
+        if node_tables is None:
+            return None
+        tables |= node_tables
+    return tables
+
+def _node_tables(node):
+    if isinstance(node, (ExtraWhere, RawSQL)):
+        return None
+    if isinstance(node, QuerySet):
+        node = node.query
+    if isinstance(node, Query):
+        return _query_read_tables(node)
+    if isinstance(node, SubqueryConstraint):
+        return _node_tables(node.query_object)
+    # Subquery() and Exists() expressions
+    if hasattr(node, 'queryset'):
+        return _node_tables(node.queryset)
+
+    if isinstance(node, Lookup):
+        children = [node.lhs, node.rhs]
+    elif hasattr(node, 'children'):
+        children = node.children
+    elif hasattr(node, 'get_source_expressions'):
+        children = node.get_source_expressions()
+    else:
+        return set()
+    tables = set()
+    for child in children:
+        child_tables = _node_tables(child)
+        if child_tables is None:
+            return None
+        tables |= child_tables
+    return tables
+
+def _related_tables(model, select_related):
+    # select_related() with no fields follows all non-null foreign keys, don't bother
+    if select_related is True:
+        return None
+    tables = set()
+    for name, nested in select_related.items():
+        related_model = model._meta.get_field(name).related_model
+        tables.add(related_model._meta.db_table)
+        if nested:
+            nested_tables = _related_tables(related_model, nested)
+            if nested_tables is None:
+                return None
+            tables |= nested_tables
+    return tables
@@ -12,6 +12,10 @@ from django.http import HttpRequest
 from .conf import model_profile
 
 
+# Appeared in Python 3.5
+iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+
+
 # NOTE: we don't serialize this fields since their values could be very long
 #       and one should not filter by their equality anyway.
 NOT_SERIALIZED_FIELDS = (
@@ -64,9 +68,11 @@ def monkey_mix(cls, mixin, methods=None):
             ... do smth else before
             self._no_monkey.do_smth(self, arg)
             ... do smth else after
+
+    Several mixins could go into the same class as long as they patch different methods.
     """
-    assert '_no_monkey' not in cls.__dict__, 'Multiple monkey mix not supported'
-    cls._no_monkey = MonkeyProxy(cls)
+    if '_no_monkey' not in cls.__dict__:
+        cls._no_monkey = MonkeyProxy(cls)
 
     if methods is None:
         methods = [(name, m) for name, m in mixin.__dict__.items() if inspect.isfunction(m)]
@@ -74,6 +80,7 @@ def monkey_mix(cls, mixin, methods=None):
         methods = [(m, mixin.__dict__[m]) for m in methods]
 
     for name, method in methods:
+        assert cls.__dict__.get(name) is not method, 'Multiple monkey mix of %s' % name
         if hasattr(cls, name):
             setattr(cls._no_monkey, name, getattr(cls, name))
         setattr(cls, name, method)
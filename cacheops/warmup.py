@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Eager warm-up of things cacheops otherwise does lazily on first requests:
+model profiles and fields descriptions, Lua scripts and redis connections.
+"""
+import time
+from django.apps import apps
+
+from .conf import settings, prepare_profiles
+from .utils import non_proxy, family_has_profile, stamp_fields
+from .redis import handle_connection_failure, script_code, load_script
+from .invalidation import serializable_fields
+from .sharding import all_nodes
+from .signals import cache_warmed_up
+
+
+__all__ = ('warm_up',)
+
+
+SCRIPTS = ('cache_thing', 'invalidate', 'invalidate_model', 'lock', 'unlock')
+
+
+def warm_up():
+    """
+    Fills caches and opens connections, returns time it took in seconds.
+    Call it in each worker process, e.g. from gunicorn post_fork hook.
+    """
+    start = time.time()
+    warm_up_models()
+    models_duration = time.time() - start
+    warm_up_redis()
+    duration = time.time() - start
+
+    cache_warmed_up.send(sender=None, duration=duration, models_duration=models_duration)
+    return duration
+
+def warm_up_models():
+    prepare_profiles()
+    for model in apps.get_models(include_auto_created=True):
+        if family_has_profile(model):
+            stamp_fields(model)
+            serializable_fields(non_proxy(model))
+
+@handle_connection_failure
+def warm_up_redis():
+    for name in SCRIPTS:
+        strip = name == 'cache_thing' and settings.CACHEOPS_LRU
+        load_script(name, strip)
+        # Scripts are loaded on each node, so that first calls don't get NOSCRIPT
+        for node in all_nodes():
+            node.script_load(script_code(name, strip))
+
+    # Script loading already opened a connection to each primary, ping replicas
+    for node in all_nodes():
+        for replica in node.replicas:
+            replica.ping()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# NOTE: this is imported from tests.py for Python 3.5+ only
+import asyncio
+import threading
+from unittest import mock
+
+from django.test import override_settings
+
+from cacheops import cached_as, cached, ainvalidate_obj, async_client, invalidate_model
+
+from .models import Category, Post
+from .tests import BaseTestCase
+
+
+class AsyncTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(AsyncTests, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(async_client().connection_pool.disconnect())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(AsyncTests, self).tearDown()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_fetch(self):
+        with self.assertNumQueries(1):
+            posts = self.run_async(Post.objects.cache().filter(category=1).afetch())
+            self.assertEqual(posts, list(Post.objects.cache().filter(category=1)))
+
+    def test_fetch_shares_cache(self):
+        posts = list(Post.objects.cache())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.run_async(Post.objects.cache().afetch()), posts)
+
+    def test_fetch_chunks(self):
+        posts = list(Post.objects.cache(chunk_size=2))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.run_async(Post.objects.cache(chunk_size=2).afetch()), posts)
+
+    def test_fetch_nocache(self):
+        with self.assertNumQueries(2):
+            self.run_async(Post.objects.nocache().afetch())
+            self.run_async(Post.objects.nocache().afetch())
+
+    def test_count(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.run_async(Category.objects.cache().acount()), 5)
+            self.assertEqual(self.run_async(Category.objects.cache().acount()), 5)
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            post = self.run_async(Post.objects.cache().aget(pk=1))
+            self.assertEqual(self.run_async(Post.objects.cache().aget(pk=1)), post)
+
+        with self.assertRaises(Post.DoesNotExist):
+            self.run_async(Post.objects.cache().aget(pk=100))
+        with self.assertRaises(Post.MultipleObjectsReturned):
+            self.run_async(Post.objects.cache().aget(category=3))
+
+    def test_lock(self):
+        with self.assertNumQueries(1):
+            self.run_async(Post.objects.cache(lock=True).afetch())
+            self.run_async(Post.objects.cache(lock=True).afetch())
+
+    def test_invalidation(self):
+        post = self.run_async(Post.objects.cache().aget(pk=1))
+        post.title = 'Changed'
+        Post.objects.filter(pk=1).update(title='Changed')
+        self.run_async(ainvalidate_obj(post))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.run_async(Post.objects.cache().aget(pk=1)).title, 'Changed')
+
+    @override_settings(CACHEOPS_GENERATIONS=True)
+    def test_generations(self):
+        self.run_async(Post.objects.cache().afetch())
+        invalidate_model(Post)
+
+        with self.assertNumQueries(1):
+            self.run_async(Post.objects.cache().afetch())
+            self.run_async(Post.objects.cache().afetch())
+
+    @override_settings(CACHEOPS_GENERATIONS=True)
+    def test_replica_down(self):
+        from cacheops.redis import make_client
+        from cacheops.sharding import node_for
+        from .tests import REPLICATED
+
+        with override_settings(CACHEOPS_REDIS=REPLICATED):
+            node = node_for('tests_post')
+            replicas, node.replicas = node.replicas, [make_client(dict(port=6399))]
+            try:
+                qs = Post.objects.cache(grace=10).filter(category=1)
+                posts = self.run_async(qs._clone().afetch())
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.run_async(qs._clone().afetch()), posts)
+                    self.assertEqual(
+                        self.run_async(Post.objects.cache().filter(category=1).afetch()), posts)
+            finally:
+                node.replicas = replicas
+
+    def test_grace(self):
+        qs = Post.objects.cache(grace=10).filter(category=1)
+        self.run_async(qs.afetch())
+        Post.objects.create(title='New Post', category_id=1)
+        node = qs._data_nodes()[0]
+
+        node.set(qs._cache_key() + ':refresh', 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.run_async(qs._clone().afetch())), 1)
+        node.delete(qs._cache_key() + ':refresh')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.run_async(qs._clone().afetch())), 2)
+            self.assertEqual(len(self.run_async(qs._clone().afetch())), 2)
+
+    def test_cached_as(self):
+        calls = []
+
+        @cached_as(Post)
+        async def get_titles():
+            calls.append(1)
+            return [p.title for p in await Post.objects.nocache().afetch()]
+
+        titles = self.run_async(get_titles())
+        self.assertEqual(self.run_async(get_titles()), titles)
+        self.assertEqual(len(calls), 1)
+
+        Post.objects.create(title='New Post', category_id=1)
+        self.assertIn('New Post', self.run_async(get_titles()))
+
+    def test_cached_plain_client(self):
+        import redis
+        from cacheops.simple import RedisCache
+        from .tests import SHARDS
+
+        cache = RedisCache(redis.StrictRedis(**SHARDS[0]))
+        calls = []
+
+        @cache.cached(timeout=60)
+        async def double(x):
+            calls.append(x)
+            return x * 2
+
+        try:
+            self.assertEqual(self.run_async(double(2)), 4)
+            self.assertEqual(self.run_async(double(2)), 4)
+            self.assertEqual(calls, [2])
+        finally:
+            cache.conn.flushdb()
+            self.run_async(async_client(cache.conn).connection_pool.disconnect())
+
+    def test_run_sync(self):
+        from cacheops.aio import run_sync
+        ident = threading.get_ident
+
+        with mock.patch('cacheops.aio.sync_to_async', None):
+            # Test transaction is seen by running db queries in it
+            self.assertEqual(self.run_async(run_sync(ident)), ident())
+
+            # Otherwise these go to a single thread, which reuses its connection
+            with mock.patch('cacheops.aio.connections.all', return_value=[]):
+                idents = {self.run_async(run_sync(ident)) for _ in range(3)}
+            self.assertEqual(len(idents), 1)
+            self.assertNotEqual(idents.pop(), ident())
+
+    def test_run_sync_asgiref(self):
+        from cacheops.aio import run_sync
+        calls = []
+
+        def sync_to_async(func, thread_sensitive=False):
+            async def wrapper():
+                calls.append(thread_sensitive)
+                return func()
+            return wrapper
+
+        # Never run on event loop thread, even in a transaction
+        with mock.patch('cacheops.aio.sync_to_async', sync_to_async):
+            self.assertEqual(self.run_async(run_sync(lambda: 42)), 42)
+        self.assertEqual(calls, [True])
+
+    def test_install_keeps_originals(self):
+        from django.db.models.query import QuerySet
+        from cacheops.aio import AsyncQuerySetMixin
+
+        self.assertIs(QuerySet.afetch, AsyncQuerySetMixin.afetch)
+        # Django 4.1+ has its own async methods, these are still reachable
+        if hasattr(QuerySet._no_monkey, 'aget'):
+            self.assertIsNot(QuerySet._no_monkey.aget, AsyncQuerySetMixin.aget)
+
+    def test_cached(self):
+        calls = []
+
+        @cached(timeout=60)
+        async def double(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual(self.run_async(double(2)), 4)
+        self.assertEqual(self.run_async(double(2)), 4)
+        self.assertEqual(calls, [2])
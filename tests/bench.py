@@ -1,6 +1,7 @@
 from cacheops import invalidate_obj, invalidate_model
 from cacheops.redis import redis_client
 from cacheops.cross import pickle
+from cacheops.serializers import get_serializer
 from cacheops.tree import dnfs
 
 from .models import Category, Post, Extra
@@ -16,6 +17,16 @@ def do_unpickle():
     pickle.loads(posts_pickle)
 
 
+rows = list(Post.objects.values_list())
+serialized_rows = {name: get_serializer(name).dumps(rows) for name in ('pickle', 'marshal')}
+
+def serialize_rows(name):
+    return lambda: get_serializer(name).dumps(rows)
+
+def deserialize_rows(name):
+    return lambda: get_serializer(name).loads(serialized_rows[name])
+
+
 get_key = Category.objects.filter(pk=1).order_by()._cache_key()
 def invalidate_get():
     redis_client.delete(get_key)
@@ -148,6 +159,10 @@ def do_invalidate_model(obj):
 TESTS = [
     ('pickle', {'run': do_pickle}),
     ('unpickle', {'run': do_unpickle}),
+    ('pickle_rows', {'run': serialize_rows('pickle')}),
+    ('unpickle_rows', {'run': deserialize_rows('pickle')}),
+    ('marshal_rows', {'run': serialize_rows('marshal')}),
+    ('unmarshal_rows', {'run': deserialize_rows('marshal')}),
 
     ('get_no_cache', {'run': do_get_no_cache}),
     ('get_hit', {'prepare_once': do_get, 'run': do_get}),
@@ -191,6 +191,11 @@ class PremiumBrand(Brand):
 class Local(models.Model):
     tag = models.IntegerField(null=True)
 
+# local_cache
+class LocalCached(models.Model):
+    tag = models.IntegerField(null=True)
+    category = models.ForeignKey(Category, null=True)
+
 
 # 45
 class CacheOnSaveModel(models.Model):
@@ -90,13 +90,19 @@ CACHEOPS_REDIS = {
     'db': 13,
     'socket_timeout': 3,
 }
+# Shard cache between several local redis servers, e.g. CACHEOPS_SHARDS=6379,6380,6381
+if os.environ.get('CACHEOPS_SHARDS'):
+    CACHEOPS_REDIS = [dict(CACHEOPS_REDIS, port=int(port))
+                      for port in os.environ['CACHEOPS_SHARDS'].split(',')]
 CACHEOPS_DEFAULTS = {
     'timeout': 60*60
 }
 CACHEOPS = {
     'tests.local': {'local_get': True},
+    'tests.localcached': {'ops': 'all', 'local_cache': True},
     'tests.cacheonsavemodel': {'cache_on_save': True},
     'tests.dbbinded': {'db_agnostic': False},
+    'tests.post': {'snapshot': True},
     'tests.*': {},
     'tests.noncachedvideoproxy': None,
     'tests.noncachedmedia': None,
@@ -1,20 +1,27 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import sys
+import json
 import unittest
 
 from django.db import connection, connections
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.template import Context, Template
-from django.db.models import F
+from django.db.models import F, Q
 
-from cacheops import invalidate_all, invalidate_model, invalidate_obj, no_invalidation, \
-                     cached, cached_view, cached_as, cached_view_as
-from cacheops import invalidate_fragment
+from cacheops import invalidate_all, invalidate_model, invalidate_obj, invalidate_many, \
+                     no_invalidation, cached, cached_view, cached_as, cached_view_as, fetch_many
+from cacheops import invalidate_fragment, flush_invalidations
 from cacheops.templatetags.cacheops import register
 from cacheops.transaction import transaction_state
 from cacheops.signals import cache_read
+from cacheops.redis import redis_client, make_client, primary_window
+from cacheops.sharding import node_for, all_nodes
+from cacheops.fingerprint import sql_template, Unfingerprintable
 
 decorator_tag = register.decorator_tag
 from .models import *  # noqa
@@ -179,6 +186,104 @@ class ValuesTests(BaseTestCase):
             len(Category.objects.cache().values_list(flat=True))
 
 
+class CacheKeyTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_fingerprint(self):
+        qs = Post.objects.filter(category__title='Django', pk__in=[1, 2]).order_by('title')
+        template, params = sql_template(qs.query, qs.db)
+        self.assertEqual(params, ['django.db.models.lookups.Exact', 'Django',
+                                  'django.db.models.lookups.In', [1, 2]])
+        self.assertEqual(qs.query.get_compiler(qs.db).as_sql()[0], template)
+
+    def test_varies_on_values(self):
+        self.assertEqual(Post.objects.filter(pk=1)._cache_key(),
+                         Post.objects.filter(pk=1)._cache_key())
+        self.assertNotEqual(Post.objects.filter(pk=1)._cache_key(),
+                            Post.objects.filter(pk=2)._cache_key())
+        self.assertNotEqual(Post.objects.filter(pk=1)._cache_key(),
+                            Post.objects.filter(pk=1)[:1]._cache_key())
+
+    def test_varies_on_lookups(self):
+        lookups = ['exact', 'iexact', 'contains', 'icontains', 'startswith', 'endswith']
+        keys = {Post.objects.filter(**{'title__' + lookup: 'a'})._cache_key()
+                for lookup in lookups}
+        self.assertEqual(len(keys), len(lookups))
+
+        Post.objects.create(title='xq9', category_id=1)
+        Post.objects.create(title='q9b', category_id=1)
+        self.assertEqual({p.title for p in Post.objects.cache().filter(title__contains='q9')},
+                         {'xq9', 'q9b'})
+        self.assertEqual([p.title for p in Post.objects.cache().filter(title__startswith='q9')],
+                         ['q9b'])
+
+    def test_varies_on_extra(self):
+        qs = Post.objects.filter(pk=1)
+        self.assertNotEqual(qs.extra(select={'x': '%s'}, select_params=(1,))._cache_key(),
+                            qs.extra(select={'x': '%s'}, select_params=(2,))._cache_key())
+        self.assertNotEqual(qs.extra(where=['id > 0'])._cache_key(),
+                            qs.extra(where=['id > 1'])._cache_key())
+
+        post = qs.cache().extra(select={'x': '%s'}, select_params=(1,)).get()
+        self.assertEqual(post.x, 1)
+        post = qs.cache().extra(select={'x': '%s'}, select_params=(2,)).get()
+        self.assertEqual(post.x, 2)
+
+    def test_isnull(self):
+        Extra.objects.create(post_id=3, tag=7)
+        with self.assertNumQueries(2):
+            self.assertEqual(Extra.objects.cache().filter(to_tag__isnull=True).count(), 1)
+            self.assertEqual(Extra.objects.cache().filter(to_tag__isnull=False).count(), 2)
+
+    def test_in_duplicates(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(len(Post.objects.cache().filter(pk__in=[1, 1])), 1)
+            self.assertEqual(len(Post.objects.cache().filter(pk__in=[1, 2])), 2)
+
+    def test_complex_fallback(self):
+        qs = Post.objects.filter(visible=F('visible'))
+        self.assertRaises(Unfingerprintable, sql_template, qs.query, qs.db)
+        with self.assertNumQueries(1):
+            list(qs.cache())
+            list(Post.objects.filter(visible=F('visible')).cache())
+
+
+class FetchManyTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_it_works(self):
+        with self.assertNumQueries(2):
+            result = fetch_many(Category.objects.cache(), Post.objects.cache().filter(category=1))
+        self.assertEqual(result, [list(Category.objects.all()),
+                                  list(Post.objects.filter(category=1))])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                fetch_many(Category.objects.cache(), Post.objects.cache().filter(category=1)),
+                result)
+
+    def test_partial_hit(self):
+        list(Category.objects.cache())
+
+        with self.assertNumQueries(2):
+            fetch_many(Category.objects.cache(), Post.objects.cache(), Post.objects.nocache())
+
+    def test_invalidation(self):
+        fetch_many(Post.objects.cache().filter(category=1))
+        Post.objects.create(title='New Post', category_id=1)
+
+        with self.assertNumQueries(1):
+            posts, = fetch_many(Post.objects.cache().filter(category=1))
+        self.assertIn('New Post', [p.title for p in posts])
+
+    def test_lookups(self):
+        with self.assertNumQueries(2):
+            c1, c2 = Category.objects.cache().fetch_many({'pk': 1}, Q(title='Django'))
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.objects.cache().fetch_many({'pk': 1}, Q(title='Django')),
+                             [c1, c2])
+
+
 class NoInvalidationTests(BaseTestCase):
     fixtures = ['basic']
 
@@ -207,6 +312,776 @@ class NoInvalidationTests(BaseTestCase):
         self._template(invalidate)
 
 
+class InvalidateManyTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_invalidate_many(self):
+        posts = list(Post.objects.filter(pk__in=[1, 2]))
+        for post in posts:
+            Post.objects.cache().get(pk=post.pk)
+        Post.objects.cache().get(pk=3)
+        invalidate_many(Post, posts)
+
+        with self.assertNumQueries(2):
+            Post.objects.cache().get(pk=1)
+            Post.objects.cache().get(pk=2)
+            Post.objects.cache().get(pk=3)
+
+    def test_empty(self):
+        Post.objects.cache().get(pk=1)
+        invalidate_many(Post, [])
+
+        with self.assertNumQueries(0):
+            Post.objects.cache().get(pk=1)
+
+    def test_batched_in_transaction(self):
+        from django.db import transaction
+
+        list(Category.objects.cache())
+        with transaction.atomic():
+            for category in Category.objects.all():
+                invalidate_obj(category)
+            self.assertEqual(len(transaction_state._stack[-1]['cbs']), 0)
+            batches, = transaction_state._stack[-1]['batches'].values()
+            self.assertEqual(list(batches), [Category])
+
+        with self.assertNumQueries(1):
+            list(Category.objects.cache())
+
+    def test_merged_on_commit(self):
+        from django.db import transaction
+
+        list(Category.objects.cache())
+        list(Post.objects.cache())
+        calls = _evalsha_calls()
+        with transaction.atomic():
+            category = Category.objects.get(pk=1)
+            invalidate_obj(category)
+            invalidate_obj(Post.objects.get(pk=1))
+            with transaction.atomic():
+                invalidate_obj(category)
+                invalidate_many(Category, [category])
+            self.assertEqual(_evalsha_calls(), calls)
+        # A single script call per table with duplicates dropped
+        self.assertEqual(_evalsha_calls() - calls, 2)
+
+        with self.assertNumQueries(2):
+            list(Category.objects.cache())
+            list(Post.objects.cache())
+
+    def test_rolled_back_savepoint(self):
+        from django.db import transaction
+
+        list(Category.objects.cache())
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    invalidate_obj(Category.objects.get(pk=1))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(transaction_state._stack[-1]['batches'], {})
+
+
+def _evalsha_calls():
+    return sum(node.info('commandstats').get('cmdstat_evalsha', {}).get('calls', 0)
+               for node in all_nodes())
+
+
+@override_settings(CACHEOPS_ASYNC_INVALIDATION=True, CACHEOPS_ASYNC_INVALIDATION_DELAY=60)
+class AsyncInvalidationTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def tearDown(self):
+        flush_invalidations()
+        super(AsyncInvalidationTests, self).tearDown()
+
+    def test_flush(self):
+        post = Post.objects.cache().get(pk=1)
+        post.title = 'Changed'
+        post.save()
+
+        with self.assertNumQueries(0):
+            self.assertNotEqual(Post.objects.cache().get(pk=1).title, 'Changed')
+        flush_invalidations()
+        with self.assertNumQueries(1):
+            self.assertEqual(Post.objects.cache().get(pk=1).title, 'Changed')
+
+    def test_background(self):
+        import time
+        from cacheops.dispatch import InvalidationDispatcher
+
+        sent = []
+        dispatcher = InvalidationDispatcher(sent.append)
+        with override_settings(CACHEOPS_ASYNC_INVALIDATION_DELAY=0.01):
+            dispatcher.put({'a': [1]})
+            dispatcher.put({'a': [2], 'b': [3]})
+            for _ in range(100):
+                if sum(len(items) for batch in sent for items in batch.values()) == 3:
+                    break
+                time.sleep(0.01)
+        batches = {}
+        for batch in sent:
+            for key, items in batch.items():
+                batches.setdefault(key, []).extend(items)
+        self.assertEqual(batches, {'a': [1, 2], 'b': [3]})
+
+    def test_retry(self):
+        import time
+        import redis
+        from cacheops.dispatch import InvalidationDispatcher
+
+        sent = []
+
+        def send(batches):
+            if not sent:
+                sent.append(None)
+                raise redis.ConnectionError('Down')
+            sent.append(batches)
+
+        dispatcher = InvalidationDispatcher(send)
+        with override_settings(CACHEOPS_ASYNC_INVALIDATION_DELAY=0.01):
+            dispatcher.put({'a': [1]})
+            for _ in range(100):
+                if len(sent) == 2:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(sent, [None, {'a': [1]}])
+
+    def test_overflow(self):
+        import cacheops.dispatch
+        posts = list(Post.objects.cache().filter(category=3))
+        max_items = cacheops.dispatch.MAX_QUEUED_ITEMS
+        cacheops.dispatch.MAX_QUEUED_ITEMS = 1
+        try:
+            for post in posts:
+                post.save()
+            flush_invalidations()
+        finally:
+            cacheops.dispatch.MAX_QUEUED_ITEMS = max_items
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=3))
+
+    def test_fork(self):
+        from cacheops.dispatch import InvalidationDispatcher
+
+        sent = []
+        dispatcher = InvalidationDispatcher(sent.append)
+        dispatcher.put({'a': [1]})
+        # As if forked while another thread held the lock
+        dispatcher._mutex.acquire()
+        dispatcher._pid = -1
+        dispatcher.put({'b': [2]})
+        dispatcher.flush()
+        self.assertEqual(sent, [{'b': [2]}])
+
+
+class InvalidateModelTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _cache_posts(self):
+        for pk in range(1, 4):
+            Post.objects.cache().get(pk=pk)
+        list(Post.objects.cache().filter(category=3))
+        list(Category.objects.cache())
+
+    def test_invalidate_model(self):
+        self._cache_posts()
+        invalidate_model(Post)
+
+        self.assertFalse(node_for('tests_post').exists('conjs:tests_post'))
+        with self.assertNumQueries(4):
+            self._cache_posts()
+
+    def test_batches(self):
+        import cacheops.invalidation
+        self._cache_posts()
+        batch_size = cacheops.invalidation.INVALIDATE_BATCH_SIZE
+        cacheops.invalidation.INVALIDATE_BATCH_SIZE = 2
+        try:
+            invalidate_model(Post)
+        finally:
+            cacheops.invalidation.INVALIDATE_BATCH_SIZE = batch_size
+
+        with self.assertNumQueries(4):
+            self._cache_posts()
+
+    def test_unindexed(self):
+        from cacheops.invalidation import _indexed_tables
+        _indexed_tables.discard('tests_post')
+        self._cache_posts()
+        # As written by an older version
+        node_for('tests_post').delete('conjs:tests_post')
+
+        invalidate_model(Post)
+        self.assertNotIn('tests_post', _indexed_tables)
+        with self.assertNumQueries(4):
+            self._cache_posts()
+
+        # Nothing unindexed left, so no more scans
+        invalidate_model(Post)
+        self.assertIn('tests_post', _indexed_tables)
+
+    def test_index_cleaned_on_invalidate(self):
+        self._cache_posts()
+        conjs = node_for('tests_post').scard('conjs:tests_post')
+        invalidate_obj(Post.objects.get(pk=1))
+        self.assertEqual(node_for('tests_post').scard('conjs:tests_post'), conjs - 1)
+
+
+class InvalidatedUpdateTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_invalidated_update(self):
+        list(Post.objects.cache().filter(visible=True))
+        list(Post.objects.cache().filter(visible=False))
+        list(Post.objects.cache().filter(category=1))
+        Post.objects.filter(category=3).invalidated_update(visible=True)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(len(Post.objects.cache().filter(visible=True)), 3)
+            self.assertEqual(len(Post.objects.cache().filter(visible=False)), 0)
+            list(Post.objects.cache().filter(category=1))
+
+    def test_fetches_scheme_fields(self):
+        list(Post.objects.cache().filter(category=1))
+        with CaptureQueriesContext(connection) as context:
+            Post.objects.filter(pk=1).invalidated_update(title='New')
+
+        selects = [q['sql'] for q in context.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 2)
+        self.assertTrue(all('title' not in sql and 'category_id' in sql for sql in selects))
+
+    def test_nothing_cached(self):
+        with self.assertNumQueries(1):
+            Post.objects.filter(pk=1).invalidated_update(title='New')
+
+    def test_unconditional(self):
+        list(Post.objects.cache())
+        with self.assertNumQueries(1):
+            Post.objects.filter(pk=1).invalidated_update(title='New')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Post.objects.cache().get(pk=1).title, 'New')
+
+
+@override_settings(CACHEOPS_NAMESPACE='ns:')
+class NamespaceTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_keys(self):
+        list(Post.objects.cache().filter(category=1))
+        node = node_for('tests_post')
+        self.assertTrue(node.keys('ns:q:*'))
+        self.assertTrue(node.keys('ns:conj:tests_post:*'))
+        self.assertTrue(node.exists('ns:schemes:tests_post'))
+        self.assertFalse(node.keys('q:*'))
+
+    def test_invalidate_obj(self):
+        post = Post.objects.cache().get(pk=1)
+        invalidate_obj(post)
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_invalidate_all_keeps_other_keys(self):
+        list(Post.objects.cache())
+        redis_client.set('other', 'value')
+        invalidate_all()
+
+        self.assertFalse(node_for('tests_post').keys('ns:*'))
+        self.assertEqual(redis_client.get('other'), b'value')
+        redis_client.delete('other')
+
+
+@override_settings(CACHEOPS_GENERATIONS=True)
+class GenerationsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_invalidate_model(self):
+        list(Post.objects.cache().filter(category=1))
+        list(Category.objects.cache())
+        invalidate_model(Post)
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+            list(Category.objects.cache())
+
+    def test_invalidate_model_joined(self):
+        list(Post.objects.cache().filter(category__title='Django'))
+        invalidate_model(Category)
+
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category__title='Django'))
+
+    def test_invalidate_all(self):
+        list(Post.objects.cache())
+        redis_client.set('other', 'value')
+        invalidate_all()
+
+        self.assertEqual(redis_client.get('other'), b'value')
+        redis_client.delete('other')
+        with self.assertNumQueries(1):
+            list(Post.objects.cache())
+
+    def test_invalidate_obj(self):
+        post = Post.objects.cache().get(pk=1)
+        invalidate_obj(post)
+        with self.assertNumQueries(1):
+            Post.objects.cache().get(pk=1)
+
+    def test_cached_as(self):
+        calls = []
+
+        @cached_as(Post)
+        def count():
+            calls.append(1)
+            return Post.objects.count()
+
+        count()
+        count()
+        invalidate_model(Post)
+        count()
+        self.assertEqual(len(calls), 2)
+
+
+SHARDS = [dict(host='localhost', port=6379, db=db, socket_timeout=3) for db in (13, 14)]
+
+@override_settings(CACHEOPS_REDIS=SHARDS)
+class ShardingTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_placement(self):
+        list(Post.objects.cache().filter(category=1))
+
+        post_node, category_node = node_for('tests_post'), node_for('tests_category')
+        self.assertIsNot(post_node, category_node)
+        self.assertTrue(post_node.exists('schemes:tests_post'))
+        self.assertFalse(category_node.exists('schemes:tests_post'))
+
+    def test_join(self):
+        qs = Post.objects.cache().filter(category__title='Django')
+        list(qs)
+        # Data goes to category node, post node keeps a marker
+        self.assertEqual(node_for('tests_post').get(qs._cache_key()), b'')
+        self.assertNotEqual(node_for('tests_category').get(qs._cache_key()), b'')
+
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category__title='Django'))
+
+    def test_join_invalidation(self):
+        qs = Post.objects.cache().filter(category__title='Django')
+        list(qs)
+        invalidate_obj(Category.objects.get(title='Django'))
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category__title='Django'))
+
+        Post.objects.create(title='New', category_id=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Post.objects.cache().filter(category__title='Django')), 2)
+
+    def test_invalidate_all(self):
+        list(Post.objects.cache().filter(category__title='Django'))
+        invalidate_all()
+        self.assertEqual(node_for('tests_post').dbsize(), 0)
+        self.assertEqual(node_for('tests_category').dbsize(), 0)
+
+    def test_consistent_hashing(self):
+        from cacheops.sharding import HashRing
+        tables = ['table_%d' % i for i in range(100)]
+        ring = HashRing(SHARDS)
+        bigger_ring = HashRing(SHARDS + [dict(SHARDS[0], db=15)])
+
+        moved = [t for t in tables
+                 if ring.nodes.index(ring.get(t)) != bigger_ring.nodes.index(bigger_ring.get(t))]
+        self.assertTrue(moved)
+        self.assertTrue(all(bigger_ring.nodes.index(bigger_ring.get(t)) == 2 for t in moved))
+
+
+REPLICATED = [dict(SHARDS[0], replicas=[SHARDS[1]])]
+
+@override_settings(CACHEOPS_REDIS=REPLICATED)
+class ReplicaTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+        self.primary = node_for('tests_post')
+        self.replica = self.primary.replicas[0]
+        self.replica.flushdb()
+        # Marked by invalidate_all() above
+        primary_window._until.clear()
+
+    def tearDown(self):
+        primary_window._until.clear()
+        super(ReplicaTests, self).tearDown()
+
+    def _replicate(self, key):
+        self.replica.set(key, self.primary.get(key, primary=True))
+
+    def test_reads_from_replica(self):
+        qs = Post.objects.cache().filter(category=1)
+        list(qs)
+        self.assertIsNotNone(self.primary.get(qs._cache_key(), primary=True))
+        # Not replicated yet
+        with self.assertNumQueries(1):
+            list(Post.objects.cache().filter(category=1))
+
+        self._replicate(qs._cache_key())
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category=1))
+
+    def test_primary_window(self):
+        list(Post.objects.cache().filter(category=1))
+        primary_window.mark('tests_post', 10)
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category=1))
+        # Other tables are still read from replica
+        self.assertFalse(primary_window.covers(['tests_extra']))
+
+    def test_window_on_invalidation(self):
+        from django.conf import settings
+        from cacheops.conf import prepare_profiles
+
+        profiles = dict(settings.CACHEOPS, **{'tests.category': {'primary_window': 5}})
+        with override_settings(CACHEOPS=profiles):
+            prepare_profiles.memory.clear()
+            try:
+                invalidate_obj(Post.objects.get(pk=1))
+                self.assertFalse(primary_window.active())
+
+                invalidate_obj(Category.objects.get(pk=1))
+                self.assertTrue(primary_window.covers(['tests_category']))
+                self.assertFalse(primary_window.covers(['tests_post']))
+            finally:
+                prepare_profiles.memory.clear()
+
+    def test_replica_down(self):
+        client = make_client(dict(SHARDS[0], replicas=[dict(port=6399)]))
+        client.set('key', 'value')
+        self.assertEqual(client.get('key'), b'value')
+        client.delete('key')
+
+    @override_settings(CACHEOPS_GENERATIONS=True)
+    def test_replica_down_reads(self):
+        self.primary.replicas = [make_client(dict(port=6399))]
+        try:
+            posts = list(Post.objects.cache().filter(category=1))
+            chunked = list(Post.objects.cache(chunk_size=1, grace=10))
+            with self.assertNumQueries(0):
+                self.assertEqual(list(Post.objects.cache().filter(category=1)), posts)
+                self.assertEqual(fetch_many(Post.objects.cache().filter(category=1)), [posts])
+                self.assertEqual(list(Post.objects.cache(chunk_size=1, grace=10)), chunked)
+        finally:
+            self.primary.replicas = [self.replica]
+
+    def test_replica_timeout(self):
+        import redis
+
+        def timeout(*args, **kwargs):
+            raise redis.TimeoutError('Timeout reading from socket')
+
+        client = make_client(REPLICATED[0])
+        client.replicas[0].execute_command = timeout
+        client.set('key', 'value')
+        self.assertEqual(client.get('key'), b'value')
+        client.delete('key')
+
+
+class WarmUpTests(BaseTestCase):
+    def test_warm_up(self):
+        from cacheops import warm_up
+        from cacheops.redis import load_script
+        from cacheops.signals import cache_warmed_up
+
+        calls = []
+
+        def receiver(sender, **kwargs):
+            calls.append(kwargs)
+        cache_warmed_up.connect(receiver)
+        try:
+            redis_client.script_flush()
+            duration = warm_up()
+        finally:
+            cache_warmed_up.disconnect(receiver)
+
+        self.assertEqual(calls, [{'signal': cache_warmed_up, 'duration': duration,
+                                  'models_duration': calls[0]['models_duration']}])
+        sha = load_script('invalidate').sha
+        self.assertEqual(redis_client.script_exists(sha), [True])
+
+
+class GraceTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(GraceTests, self).setUp()
+        self.qs = Post.objects.cache(grace=10).filter(category=1)
+        self.node = self.qs._data_nodes()[0]
+        self.refresh_key = self.qs._cache_key() + ':refresh'
+
+    def test_keeps_data(self):
+        list(self.qs._clone())
+        self.assertGreater(self.node.ttl(self.qs._cache_key()), 60 * 60)
+
+        Post.objects.create(title='New', category_id=1)
+        ttl = self.node.ttl(self.qs._cache_key())
+        self.assertTrue(0 < ttl <= 10)
+
+    def test_serves_stale_while_refreshing(self):
+        list(self.qs._clone())
+        Post.objects.create(title='New', category_id=1)
+
+        # Someone else is refreshing
+        self.node.set(self.refresh_key, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.qs._clone()), 1)
+        self.node.delete(self.refresh_key)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.qs._clone()), 2)
+            self.assertEqual(len(self.qs._clone()), 2)
+        self.assertFalse(self.node.exists(self.refresh_key))
+
+    def test_expired(self):
+        list(self.qs._clone())
+        self.node.expire(self.qs._cache_key(), 5)
+        with self.assertNumQueries(1):
+            list(self.qs._clone())
+            list(self.qs._clone())
+
+    def test_count(self):
+        self.qs.count()
+        Post.objects.create(title='New', category_id=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.qs.count(), 2)
+            self.assertEqual(self.qs.count(), 2)
+
+    def test_invalidate_model(self):
+        list(self.qs._clone())
+        list(Post.objects.cache().filter(category=2))
+        invalidate_model(Post)
+        self.assertTrue(self.node.exists(self.qs._cache_key()))
+        self.assertFalse(self.node.exists(Post.objects.cache().filter(category=2)._cache_key()))
+        with self.assertNumQueries(1):
+            list(self.qs._clone())
+
+
+class XFetchTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(XFetchTests, self).setUp()
+        self.qs = Post.objects.cache(xfetch_beta=1).filter(category=1)
+        self.node = self.qs._data_nodes()[0]
+        self.delta_key = self.qs._cache_key() + ':delta'
+
+    def test_stores_delta(self):
+        from cacheops.signals import cache_computed
+
+        calls = []
+
+        def receiver(sender, **kwargs):
+            calls.append(kwargs)
+        cache_computed.connect(receiver)
+        try:
+            list(self.qs._clone())
+        finally:
+            cache_computed.disconnect(receiver)
+
+        self.assertEqual(len(calls), 1)
+        self.assertAlmostEqual(float(self.node.get(self.delta_key)), calls[0]['duration'], 5)
+
+    def test_needs_refresh(self):
+        from cacheops.sharding import needs_refresh
+
+        self.assertFalse(needs_refresh(None, 1e6, beta=1))
+        self.assertFalse(needs_refresh(60, None, beta=1))
+        self.assertFalse(needs_refresh(60, 0.001, beta=1e-6))
+        self.assertTrue(needs_refresh(1, 1e6, beta=1))
+        # Stale
+        self.assertTrue(needs_refresh(5, None, grace=10))
+
+    def test_early_refresh(self):
+        list(self.qs._clone())
+        with self.assertNumQueries(0):
+            list(self.qs._clone())
+
+        # Pretend it takes forever to compute
+        self.node.set(self.delta_key, 1e6)
+        with self.assertNumQueries(1):
+            list(self.qs._clone())
+        self.assertLess(float(self.node.get(self.delta_key)), 1e6)
+        self.assertFalse(self.node.exists(self.qs._cache_key() + ':refresh'))
+
+
+class RefreshAheadTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        super(RefreshAheadTests, self).setUp()
+        from cacheops.refresh import RefreshWorker
+        self.worker = RefreshWorker(ahead=10)
+
+    def tearDown(self):
+        import cacheops.local
+        from cacheops.refresh import registry
+        del registry[:]
+        cacheops.local._publish = False
+        super(RefreshAheadTests, self).tearDown()
+
+    def _process(self):
+        while not self.worker.queue.empty():
+            self.worker.refresh(*self.worker.queue.get_nowait())
+
+    def test_queryset(self):
+        from cacheops import refresh_ahead
+        from cacheops.local import invalidation_channel
+
+        qs = Post.objects.cache().filter(category=1)
+        refresh_ahead(qs)
+        self.assertTrue(invalidation_channel())
+
+        self.worker.check()
+        self._process()
+        self.assertEqual(self.worker.stats['expiring'], 1)
+        with self.assertNumQueries(0):
+            list(Post.objects.cache().filter(category=1))
+
+        Post.objects.create(title='New', category_id=1)
+        self.worker.delete_many([qs._cache_key()])
+        self._process()
+        self.assertEqual(self.worker.stats['invalidated'], 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Post.objects.cache().filter(category=1)), 2)
+
+    def test_expiring(self):
+        from cacheops import refresh_ahead
+
+        qs = Post.objects.cache().filter(category=1)
+        refresh_ahead(qs)
+        list(qs._clone())
+        self.worker.check()
+        self.assertTrue(self.worker.queue.empty())
+
+        qs._data_nodes()[0].expire(qs._cache_key(), 5)
+        self.worker.check()
+        self.worker.check()
+        self.assertEqual(self.worker.queue.qsize(), 1)
+
+    def test_cached_as(self):
+        from cacheops import refresh_ahead
+
+        calls = []
+
+        @cached_as(Post)
+        def count(category_id):
+            calls.append(1)
+            return Post.objects.filter(category=category_id).count()
+
+        refresh_ahead(count, 1)
+        self.worker.check()
+        self._process()
+        self.assertEqual(count(1), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_failure(self):
+        from cacheops import refresh_ahead
+
+        @cached_as(Post)
+        def fail():
+            raise ValueError
+
+        refresh_ahead(fail)
+        self.worker.check()
+        self._process()
+        self.assertEqual(self.worker.stats['failed'], 1)
+
+
+class SnapshotTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_no_refetch(self):
+        post = Post.objects.get(pk=1)
+        post.title = 'Changed'
+        with self.assertNumQueries(1):
+            post.save()
+        # A new snapshot is taken on save
+        with self.assertNumQueries(1):
+            post.save()
+
+    def test_not_cached(self):
+        import pickle
+        from cacheops.query import SNAPSHOT
+
+        post = Post.objects.get(pk=1)
+        self.assertNotIn(SNAPSHOT, pickle.loads(pickle.dumps(post)).__dict__)
+        self.assertIn(SNAPSHOT, post.__dict__)
+
+        # Snapshots could be outdated by the time cached object is read
+        Post.objects.cache().get(pk=1)
+        post = Post.objects.cache().get(pk=1)
+        with self.assertNumQueries(2):
+            post.save()
+
+    def test_bulk_update(self):
+        post = Post.objects.get(pk=1)
+        list(Post.objects.cache().filter(category=3))
+        Post.objects.filter(pk=1).invalidated_update(category=3)
+        list(Post.objects.cache().filter(category=3))
+
+        # Current state is fetched, so that caches with it are invalidated
+        with self.assertNumQueries(2):
+            post.save()
+        with self.assertNumQueries(1):
+            self.assertNotIn(post, list(Post.objects.cache().filter(category=3)))
+
+    def test_invalidates_old_state(self):
+        list(Post.objects.cache().filter(category=1))
+        post = Post.objects.get(pk=1)
+        post.category_id = 2
+        post.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(category=1)), [])
+
+    def test_fallback(self):
+        list(Post.objects.cache().filter(category=1))
+        with self.assertNumQueries(2):
+            Post(pk=1, title='Changed', category_id=2).save()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache().filter(category=1)), [])
+
+    def test_opt_in(self):
+        from cacheops.query import SNAPSHOT
+
+        category = Category.objects.get(pk=1)
+        self.assertNotIn(SNAPSHOT, category.__dict__)
+
+        # Another process saves it in between, then someone caches its new state
+        Category.objects.filter(pk=1).update(title='Other')
+        list(Category.objects.cache().filter(title='Other'))
+
+        # Current state is fetched, so that caches with it are invalidated
+        category.title = 'Changed'
+        with self.assertNumQueries(2):
+            category.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Category.objects.cache().filter(title='Other')), [])
+
+    def test_update_fields(self):
+        post = Post.objects.get(pk=1)
+        post.category_id = 2
+        post.save(update_fields=['title'])
+        with self.assertNumQueries(2):
+            post.save()
+
+    def test_refresh_from_db(self):
+        post = Post.objects.get(pk=1)
+        post.refresh_from_db(fields=['title'])
+        with self.assertNumQueries(2):
+            post.save()
+
+
 class DecoratorTests(BaseTestCase):
     def test_cached_as_model(self):
         get_calls = _make_inc(cached_as(Category))
@@ -546,6 +1421,113 @@ class LocalGetTests(BaseTestCase):
         Local.objects.cache().get(pk__in=[1, 2])
 
 
+class LocalCacheTests(BaseTestCase):
+    def setUp(self):
+        from cacheops.local import local_cache
+        self.obj = LocalCached.objects.create(tag=1)
+        super(LocalCacheTests, self).setUp()
+        local_cache.clear()
+        # Can't cache locally until invalidations are listened to
+        local_cache._listening()
+        for listener in local_cache._listeners:
+            self.assertTrue(listener.subscribed.wait(3))
+        self._settle()
+
+    def _settle(self):
+        # Handled invalidations make local cache discard data read before them,
+        # so let listeners handle ones published so far, a message per node goes after these
+        import time
+        from cacheops.local import local_cache, INVALIDATION_CHANNEL
+        from cacheops.sharding import all_nodes
+        epoch = local_cache.epoch()
+        for node in all_nodes():
+            node.publish(INVALIDATION_CHANNEL, '[]')
+        for _ in range(300):
+            if local_cache.epoch() >= epoch + len(all_nodes()):
+                return
+            time.sleep(0.01)
+        self.fail('Invalidations were not handled')
+
+    def test_fetch(self):
+        qs = LocalCached.objects.filter(tag=1)
+        list(qs)
+        redis_client.flushdb()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(LocalCached.objects.filter(tag=1)), [self.obj])
+
+    def test_invalidation(self):
+        list(LocalCached.objects.filter(tag=1))
+        LocalCached.objects.create(tag=1)
+
+        # Dropped synchronously in invalidating process
+        with self.assertNumQueries(1):
+            self.assertEqual(len(LocalCached.objects.filter(tag=1)), 2)
+
+    def test_stale_set(self):
+        from cacheops.local import local_cache
+        from cacheops.simple import CacheMiss
+        qs = LocalCached.objects.filter(tag=1)
+        epoch = local_cache.epoch()
+        # Invalidation is handled while data read before it is still on its way
+        local_cache.delete_many(['unrelated'])
+        local_cache.set(qs._cache_key(), (self.obj,), 60, {'tests_localcached'}, epoch)
+
+        with self.assertRaises(CacheMiss):
+            local_cache.get(qs._cache_key())
+
+    def test_copies(self):
+        category = Category.objects.create(title='Old')
+        self.obj.category = category
+        self.obj.save()
+        self._settle()
+
+        obj = LocalCached.objects.get(pk=self.obj.pk)
+        self.assertEqual(obj.category.title, 'Old')
+        other = LocalCached.objects.get(pk=self.obj.pk)
+        self.assertIsNot(obj, other)
+
+        category.title = 'New'
+        category.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(LocalCached.objects.get(pk=self.obj.pk).category.title, 'New')
+
+    def test_select_related_copies(self):
+        self.obj.category = Category.objects.create(title='Old')
+        self.obj.save()
+        self._settle()
+
+        qs = LocalCached.objects.select_related('category').filter(pk=self.obj.pk)
+        obj = qs.get()
+        with self.assertNumQueries(0):
+            other = qs.get()
+            self.assertEqual(other.category.title, 'Old')
+        self.assertIsNot(obj.category, other.category)
+
+    def test_cached_as_copies(self):
+        @cached_as(LocalCached, local_cache=True)
+        def get_tags():
+            return {'tags': [1]}
+
+        get_tags()['tags'].append(2)
+        get_tags()['tags'].append(3)
+        self.assertEqual(get_tags(), {'tags': [1]})
+
+    def test_count(self):
+        LocalCached.objects.count()
+        redis_client.flushdb()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(LocalCached.objects.count(), 1)
+
+    def test_invalidate_all(self):
+        list(LocalCached.objects.filter(tag=1))
+        invalidate_all()
+
+        with self.assertNumQueries(1):
+            list(LocalCached.objects.filter(tag=1))
+
+
 class RelatedTests(BaseTestCase):
     fixtures = ['basic']
 
@@ -843,6 +1825,226 @@ class SimpleCacheTests(BaseTestCase):
         self.assertEqual(get_calls(r1), 4) # miss
 
 
+class SerializerTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_values_list(self):
+        def make_qs():
+            qs = Category.objects.cache().values_list('id', 'title')
+            qs._cacheprofile['serializer'] = 'marshal'
+            return qs
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(make_qs()), list(make_qs()))
+        self.assertEqual(list(make_qs()), list(Category.objects.values_list('id', 'title')))
+        # Differently serialized data doesn't mix up
+        with self.assertNumQueries(1):
+            list(Category.objects.cache().values_list('id', 'title'))
+
+    def _qs(self, qs, serializer):
+        qs._cacheprofile['serializer'] = serializer
+        return qs
+
+    def test_models(self):
+        from cacheops.serializers import PICKLED
+
+        for serializer in ('marshal', 'json'):
+            invalidate_all()
+            make_qs = lambda: self._qs(Category.objects.cache(), serializer)
+            with self.assertNumQueries(1):
+                categories = list(make_qs())
+                self.assertEqual(list(make_qs()), categories)
+            self.assertEqual([c.title for c in categories],
+                             [c.title for c in Category.objects.all()])
+            self.assertFalse(categories[0]._state.adding)
+            # Stored as rows, not pickled
+            qs = make_qs()
+            self.assertNotEqual(qs._data_nodes()[0].get(qs._cache_key())[:1], PICKLED)
+
+    def test_fallback(self):
+        from cacheops.serializers import PICKLED
+        Weird.objects.create()
+
+        make_qs = lambda: self._qs(Weird.objects.cache(), 'json')
+        with self.assertNumQueries(1):
+            weirds = list(make_qs())
+            self.assertEqual(list(make_qs()), weirds)
+        self.assertEqual(weirds[0].date_field, date(2000, 1, 1))
+        qs = make_qs()
+        self.assertEqual(qs._data_nodes()[0].get(qs._cache_key())[:1], PICKLED)
+
+        # Related objects could not be rebuilt from rows
+        make_qs = lambda: self._qs(Post.objects.cache().select_related('category'), 'marshal')
+        with self.assertNumQueries(1):
+            posts = list(make_qs())
+            self.assertEqual([p.category.title for p in make_qs()],
+                             [p.category.title for p in posts])
+
+    def test_values_list_json(self):
+        make_qs = lambda: self._qs(Category.objects.cache().values_list('id', 'title'), 'json')
+        with self.assertNumQueries(1):
+            list(make_qs())
+            rows = list(make_qs())
+        self.assertEqual(rows, list(Category.objects.values_list('id', 'title')))
+
+    def test_cached_as(self):
+        calls = [0]
+
+        @cached_as(Category, serializer='json')
+        def get_data():
+            calls[0] += 1
+            return {'calls': calls[0]}
+
+        self.assertEqual(get_data(), {'calls': 1})
+        self.assertEqual(get_data(), {'calls': 1})
+
+    def test_simple_cache(self):
+        import shutil, tempfile
+        from cacheops.simple import RedisCache, FileCache
+
+        cache = RedisCache(redis_client, serializer='marshal')
+        cache.set('key', (1, 'two'))
+        self.assertEqual(cache.get('key'), (1, 'two'))
+
+        path = tempfile.mkdtemp()
+        try:
+            cache = FileCache(path, serializer='json')
+            cache.set('key', [1, 'two'])
+            self.assertEqual(cache.get('key'), [1, 'two'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_register(self):
+        from cacheops.serializers import register_serializer, get_serializer, SERIALIZERS
+
+        class ReprSerializer(object):
+            dumps = staticmethod(lambda data: repr(data).encode())
+            loads = staticmethod(lambda data: eval(data))
+
+        register_serializer('repr', ReprSerializer)
+        try:
+            self.assertIs(get_serializer('repr'), ReprSerializer)
+            self.assertEqual(get_serializer('cacheops.serializers.JSONSerializer'),
+                             SERIALIZERS['json'])
+        finally:
+            del SERIALIZERS['repr']
+
+
+class ChunksTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_fetch(self):
+        qs = Post.objects.cache(chunk_size=2)
+        posts = list(qs)
+        self.assertEqual(qs._data_nodes()[0].get(qs._cache_key())[:3], b'\x032:')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts)
+            self.assertEqual(list(Post.objects.cache(chunk_size=2).iterator()), posts)
+
+    def test_iterator(self):
+        posts = list(Post.objects.cache(chunk_size=2).iterator())
+        self.assertEqual(posts, list(Post.objects.all()))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2).iterator()), posts)
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts)
+
+    def test_invalidation(self):
+        list(Post.objects.cache(chunk_size=2))
+        Post.objects.create(title='New Post', category_id=1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Post.objects.cache(chunk_size=2)), 4)
+
+    def test_missing_chunk(self):
+        qs = Post.objects.cache(chunk_size=2)
+        posts = list(qs)
+        qs._data_nodes()[0].delete(qs._cache_key() + ':1')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2).iterator()), posts)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts)
+
+        qs._data_nodes()[0].delete(qs._cache_key() + ':0')
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts)
+
+    def test_foreign_chunk(self):
+        qs = Post.objects.cache(chunk_size=2)
+        posts = list(qs)
+        node, key = qs._data_nodes()[0], qs._cache_key() + ':1'
+
+        def replace_token():
+            node.set(key, b'0' * 16 + node.get(key)[16:])
+
+        # Chunk of another write is not mixed with the rest
+        replace_token()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts)
+
+        replace_token()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2).iterator()), posts)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2).iterator()), posts)
+
+    def test_invalidated_midway(self):
+        posts = list(Post.objects.cache(chunk_size=2))
+        it = Post.objects.cache(chunk_size=2).iterator()
+        first = next(it)
+        post = Post.objects.create(title='New Post', category_id=1)
+
+        # Chunks are fetched one by one, the rest comes from db
+        with self.assertNumQueries(1):
+            self.assertEqual([first] + list(it), posts + [post])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache(chunk_size=2)), posts + [post])
+
+
+class CompressionTests(BaseTestCase):
+    fixtures = ['basic']
+
+    @override_settings(CACHEOPS_COMPRESSION='zlib', CACHEOPS_COMPRESSION_THRESHOLD=0)
+    def test_queryset(self):
+        qs = Post.objects.cache()
+        posts = list(qs)
+        self.assertEqual(qs._data_nodes()[0].get(qs._cache_key())[:1], b'\x01')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Post.objects.cache()), posts)
+
+    def test_coexist(self):
+        from cacheops import cache
+
+        cache.set('key', 'plain')
+        with override_settings(CACHEOPS_COMPRESSION='zlib', CACHEOPS_COMPRESSION_THRESHOLD=0):
+            cache.set('compressed', 'compressed' * 10)
+            self.assertEqual(cache.get('key'), 'plain')
+        self.assertEqual(cache.get('compressed'), 'compressed' * 10)
+
+    @override_settings(CACHEOPS_COMPRESSION='zlib', CACHEOPS_COMPRESSION_THRESHOLD=100)
+    def test_threshold_and_signal(self):
+        from cacheops import cache
+        from cacheops.signals import cache_compressed
+
+        calls = []
+
+        def receiver(sender, **kwargs):
+            calls.append(kwargs)
+        cache_compressed.connect(receiver)
+        try:
+            cache.set('small', 'x')
+            self.assertEqual(calls, [])
+            cache.set('large', 'x' * 1000)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(calls[0]['method'], 'zlib')
+            self.assertLess(calls[0]['compressed_size'], calls[0]['size'])
+        finally:
+            cache_compressed.disconnect(receiver)
+
+
 class DbAgnosticTests(BaseTestCase):
     def test_db_agnostic_by_default(self):
         list(DbAgnostic.objects.cache())
@@ -910,6 +2112,175 @@ class SignalsTests(BaseTestCase):
         self.assertEqual(self.signal_calls, [{'sender': None, 'func': func, 'hit': True}])
 
 
+@override_settings(CACHEOPS_METRICS=True)
+class MetricsTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def setUp(self):
+        from cacheops.metrics import metrics
+        super(MetricsTests, self).setUp()
+        self.metrics = metrics
+        metrics.reset()
+
+    def test_reads(self):
+        Category.objects.cache().get(pk=1)
+        Category.objects.cache().get(pk=1)
+        Post.objects.cache().count()
+
+        values = self.metrics.snapshot()
+        self.assertEqual(values['hits', 'tests.category', 'fetch'], 1)
+        self.assertEqual(values['misses', 'tests.category', 'fetch'], 1)
+        self.assertEqual(values['misses', 'tests.post', 'count'], 1)
+        # One write and two reads
+        self.assertEqual(sum(values['redis_seconds', 'tests.category', 'fetch'][:-1]), 3)
+        self.assertEqual(sum(values['payload_bytes', 'tests.category', 'fetch'][:-1]), 1)
+        self.assertEqual(sum(values['deserialize_seconds', 'tests.category', 'fetch'][:-1]), 1)
+
+    def test_invalidations(self):
+        invalidate_obj(Category.objects.get(pk=1))
+        invalidate_model(Post)
+
+        values = self.metrics.snapshot()
+        self.assertEqual(values['invalidations', 'tests.category', 'invalidate'], 1)
+        self.assertEqual(values['invalidations', 'tests.post', 'invalidate_model'], 1)
+
+    def test_fanout(self):
+        from django.core.management import call_command
+        from six import StringIO
+
+        list(Post.objects.cache())
+        list(Post.objects.cache().filter(category=1))
+        list(Post.objects.cache().filter(category=1).order_by('-pk'))
+        list(Post.objects.cache().filter(category=1, visible=True))
+        Post.objects.cache().get(pk=1)
+        invalidate_obj(Post.objects.get(pk=1))
+
+        values = self.metrics.snapshot()
+        self.assertEqual(values['invalidated_conjs', 'tests_post', 'category_id'], 1)
+        self.assertEqual(values['invalidated_keys', 'tests_post', 'category_id'][-1], 2)
+        self.assertEqual(values['invalidated_keys', 'tests_post', ''][-1], 1)
+
+        out = StringIO()
+        call_command('cacheops_fanout', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[1].split()[:5], ['tests_post', 'category_id', '1', '1', '2'])
+
+    def test_export(self):
+        from django.core.management import call_command
+        from six import StringIO
+        from cacheops.metrics import metrics_view
+
+        Category.objects.cache().get(pk=1)
+        Category.objects.cache().get(pk=1)
+
+        response = metrics_view(RequestFactory().get('/metrics'))
+        self.assertIn(b'cacheops_hits_total{model="tests.category",op="fetch"} 1\n',
+                      response.content)
+        self.assertIn(b'cacheops_redis_seconds_count{model="tests.category",op="fetch"} 3\n',
+                      response.content)
+
+        out = StringIO()
+        call_command('cacheops_stats', stdout=out)
+        row = next(line for line in out.getvalue().splitlines() if 'tests.category' in line)
+        self.assertEqual(row.split()[:5], ['tests.category', 'fetch', '1', '1', '50.0'])
+
+    def test_collect(self):
+        import time
+        from cacheops.metrics import _registry_key, PUBLISH_TTL
+
+        node = all_nodes()[0]
+        node.set('metrics:other:1', json.dumps([['hits', 'tests.category', 'fetch', 2]]))
+        node.hset(_registry_key(), 'metrics:other:1', time.time())
+        node.hset(_registry_key(), 'metrics:gone:1', time.time() - PUBLISH_TTL - 1)
+        Category.objects.cache().get(pk=1)
+        Category.objects.cache().get(pk=1)
+
+        values = self.metrics.collect()
+        self.assertEqual(values['hits', 'tests.category', 'fetch'], 3)
+        self.assertFalse(node.hexists(_registry_key(), 'metrics:gone:1'))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs fork')
+    def test_fork(self):
+        Category.objects.cache().get(pk=1)
+        self.assertTrue(self.metrics.snapshot())
+
+        pid = os.fork()
+        if not pid:
+            os._exit(1 if self.metrics.snapshot() else 0)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+
+class InspectTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def _inspect(self, *args):
+        import json
+        from django.core.management import call_command
+        from six import StringIO
+
+        out = StringIO()
+        call_command('cacheops_inspect', *args, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_inspect(self):
+        list(Post.objects.cache().filter(category=1))
+        list(Post.objects.cache().filter(category=2))
+        list(Post.objects.cache().filter(visible=True))
+        Category.objects.cache().get(pk=1)
+
+        report = self._inspect()
+        self.assertEqual(report['kinds']['q']['keys'], 4)
+        self.assertGreater(report['kinds']['q']['memory'], 0)
+        self.assertEqual(report['kinds']['conj']['keys'], 4)
+        post = report['tables']['tests_post']
+        self.assertEqual((post['conj_keys'], post['cache_keys'], post['schemes']), (3, 3, 2))
+        self.assertEqual(report['conj_cardinality']['sets'], 4)
+        self.assertEqual(report['conj_cardinality']['distribution']['<=1'], 4)
+
+    def test_limit(self):
+        for pk in range(1, 4):
+            Post.objects.cache().get(pk=pk)
+
+        report = self._inspect('--limit', '2', '--batch', '1')
+        self.assertEqual(report['keys']['scanned'], 2)
+        self.assertGreater(report['keys']['scale'], 1)
+
+
+class ReaperTests(BaseTestCase):
+    fixtures = ['basic']
+
+    def test_reap(self):
+        from cacheops import Reaper
+
+        posts = Post.objects.cache().filter(category=1)
+        list(posts)
+        Post.objects.cache().get(pk=1)
+        node = node_for('tests_post')
+        conj_key = 'conj:tests_post:category_id=1'
+        self.assertTrue(node.exists(conj_key))
+
+        # Emulate eviction
+        node.delete(posts._cache_key())
+        stats = Reaper(batch=10, pause=0).reap()
+
+        self.assertFalse(node.exists(conj_key))
+        self.assertFalse(node.sismember('conjs:tests_post', conj_key))
+        self.assertEqual(node.scard('conj:tests_post:id=1'), 1)
+        self.assertEqual(stats['removed'], 2)
+        with self.assertNumQueries(0):
+            Post.objects.cache().get(pk=1)
+
+    def test_acquire(self):
+        from cacheops import Reaper
+
+        self.assertTrue(Reaper().acquire(60))
+        self.assertFalse(Reaper().acquire(60))
+        redis_client.delete('reaper:lock')
+        self.assertTrue(Reaper().acquire(60))
+
+
 class LockingTests(BaseTestCase):
     def test_lock(self):
         import random
@@ -955,6 +2326,33 @@ class PolymorphicTests(BaseTestCase):
         self.assertEqual(type(z2.a), PolymorphicB)
 
 
+class MonkeyMixTests(TestCase):
+    def test_several_mixins(self):
+        from cacheops.utils import monkey_mix
+
+        class Base(object):
+            def foo(self):
+                return 'foo'
+
+            def bar(self):
+                return 'bar'
+
+        class FooMixin(object):
+            def foo(self):
+                return 'mixed ' + self._no_monkey.foo(self)
+
+        class BarMixin(object):
+            def bar(self):
+                return 'mixed ' + self._no_monkey.bar(self)
+
+        monkey_mix(Base, FooMixin)
+        monkey_mix(Base, BarMixin)
+        self.assertEqual(Base().foo(), 'mixed foo')
+        self.assertEqual(Base().bar(), 'mixed bar')
+        with self.assertRaises(AssertionError):
+            monkey_mix(Base, FooMixin)
+
+
 # Utilities
 
 def _make_inc(deco=lambda x: x):
@@ -967,3 +2365,11 @@ def _make_inc(deco=lambda x: x):
 
     inc.get = lambda: calls[0]
     return inc
+
+
+# asyncio tests need Python 3.5+ syntax and redis-py 4.2+
+if sys.version_info >= (3, 5):
+    try:
+        from .aio import AsyncTests  # noqa
+    except ImportError:
+        pass
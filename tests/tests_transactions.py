@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
 from django.db.transaction import atomic
 from django.test import TransactionTestCase
 
-from .models import Category
+from .models import Category, Post
 from .utils import run_in_thread
 
 
@@ -87,3 +88,57 @@ class TransactionSupportTests(TransactionTestCase):
             get_category()
             with self.assertNumQueries(1):
                 get_category()
+
+    def test_dirty_tables(self):
+        list(Post.objects.cache())
+        with atomic():
+            Category.objects.create(title='New')
+            with self.assertNumQueries(0):
+                list(Post.objects.cache())
+            # Category itself and any query joining it are not cached
+            get_category()
+            with self.assertNumQueries(2):
+                get_category()
+                list(Post.objects.cache().filter(category__title='New'))
+
+    def test_unparsed_sql_dirties_all(self):
+        list(Post.objects.cache())
+        with atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('WITH t AS (SELECT 1) UPDATE tests_category SET title = title')
+            with self.assertNumQueries(1):
+                list(Post.objects.cache())
+
+    def test_reads_are_not_dirty(self):
+        from cacheops.transaction import is_sql_dirty, sql_dirty_tables
+
+        self.assertFalse(is_sql_dirty('SELECT "t"."updated_at" FROM "t"'))
+        self.assertFalse(is_sql_dirty('SELECT "id" FROM "t" WHERE "is_deleted" FOR UPDATE'))
+        self.assertFalse(is_sql_dirty('SAVEPOINT "s1"'))
+        self.assertTrue(is_sql_dirty('UPDATE "t" SET "updated_at" = 1'))
+        self.assertEqual(sql_dirty_tables('UPDATE "t" SET "updated_at" = 1'), ['t'])
+        self.assertTrue(is_sql_dirty('SELECT 1; DELETE FROM "t"'))
+        self.assertIsNone(sql_dirty_tables('SELECT 1; DELETE FROM "t"'))
+
+        list(Post.objects.cache())
+        with atomic():
+            list(Category.objects.extra(select={'updated_at': '1', 'is_deleted': '0'}))
+            with self.assertNumQueries(0):
+                list(Post.objects.cache())
+
+    def test_dirty_subquery(self):
+        category = Category.objects.create(title='Old')
+        post = Post.objects.create(title='Post', category=category)
+        subquery = Category.objects.filter(title='New')
+        self.assertEqual(list(Post.objects.cache().filter(category__in=subquery)), [])
+        with atomic():
+            Category.objects.filter(pk=category.pk).update(title='New')
+            self.assertEqual(list(Post.objects.cache().filter(category__in=subquery)), [post])
+
+    def test_dirty_extra(self):
+        qs = Post.objects.cache().extra(tables=['tests_category'])
+        list(qs.all())
+        with atomic():
+            Category.objects.create(title='New')
+            with self.assertNumQueries(1):
+                list(qs.all())